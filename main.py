@@ -3,12 +3,17 @@
 # === Standard library imports ===
 import os
 import time
+import inspect
 import sys
 import paho.mqtt.client as mqtt  # MQTT client library
 
 # === Local modules ===
 import main_console                            # Console output utilities
 from modbus_gateway import ModbusGateway       # Abstraction for Modbus communication gateway
+from modbus_arbiter import BusArbiter, PRIORITY_WRITE  # Single owner of the gateway, queues MQTT commands
+from mqtt_discovery import registry as discovery  # Home Assistant discovery configs, announced once
+from main_links import MqttSupervisor           # MQTT connection state and background reconnects
+import modbus_planner                          # Merges per-battery register reads into fewer transactions
 
 # --- Main script entry point ---
 if __name__ == '__main__':
@@ -51,25 +56,40 @@ if __name__ == '__main__':
     else:
         modbus_eeprom = None
 
+    # Compile the register schema for the configured battery model: queries, lanes, decoders and MQTT entities
+    import modbus_schema
+    modbus_schema.load(modbus_registers, config.get('battery_model', 'BAT-5KWH-51.2V'))
+
+    # Spike filter settings (history lengths, mean/median/hampel) shared by the aggregator and publisher
+    import main_filters
+    main_filters.configure(config)
+
+    # Publish state only on change beyond the entity's deadband, plus a heartbeat
+    import mqtt_deadband
+    mqtt_deadband.configure(config, get_optional_attr(main_settings, "PUBLISH_DEADBANDS", warn_if_missing=False))
+
     # === Now import dependent modules ===
     from mqtt_core import (
         publish_summary_sensors,                        # Publish aggregated battery data to MQTT
+        publish_link_sensors,                           # Gateway / MQTT uptime and reconnect counters
         publish_inverter_protocol,                      # Publish inverter protocol info to MQTT
-        delete_battery_cell_topics_on_zeropad_change    # Cleanup MQTT topics if zero padding setting changes
+        delete_battery_cell_topics_on_zeropad_change,   # Cleanup MQTT topics if zero padding setting changes
+        configure_state_documents                       # Per-sensor state topics or one JSON document per device
     )
-
-    from main_arrays import (                           # Global state arrays and constants
-        last_valid_voltage,
-        last_valid_current,
-        last_valid_power,
-        last_valid_soc,
-        last_n_socs,
-        last_n_voltages,
-        last_n_env,
-        last_n_mos,
-        history_len,
-        pause_polling_until
+    configure_state_documents(config)
+
+    from main_aggregate import EssAggregator            # Spike-filtered ESS summary per cycle
+    from main_pipeline import BatteryPipeline           # Optional bus -> decode -> publish stages
+    from mqtt_publisher import MqttPublisher, DEFAULT_QUEUE_SIZE as DEFAULT_PUBLISH_QUEUE_SIZE  # Optional publish queue
+    from mqtt_spool import (                            # Optional disk spool for broker outages
+        MqttSpool,
+        DEFAULT_MAX_BYTES as DEFAULT_SPOOL_MAX_BYTES,
+        DEFAULT_MAX_AGE as DEFAULT_SPOOL_MAX_AGE,
+        DEFAULT_REPLAY_RATE as DEFAULT_SPOOL_REPLAY_RATE,
     )
+    from parser_cells import cell_stack                 # Stack-wide cell voltage array and statistics
+    from main_filters import filter_state               # Robust filter counters for the console
+    from main_scheduler import CycleScheduler, LaneSchedule, get_query_intervals  # Wall-clock aligned cycles, multi-rate lanes
     
     # Safely get optional functions from modules, they might be missing
     filter_spikes = get_optional_attr(parser_battery, "filter_spikes")
@@ -82,6 +102,9 @@ if __name__ == '__main__':
     # Instantiate the Modbus gateway interface with config and register definitions
     gateway = ModbusGateway(config, modbus_registers)
 
+    # Only the polling loop uses the gateway; MQTT handlers queue their bus work here
+    arbiter = BusArbiter(gateway)
+
     # Get battery model name from config or use default
     battery_model = config.get('battery_model', 'BAT-5KWH-51.2V')
 
@@ -104,17 +127,59 @@ if __name__ == '__main__':
         config.get('mqtt_username', 'homeassistant'),
         config.get('mqtt_password', 'mqtt_password_here')
     )
-    client.connect(
-        config.get('mqtt_broker', 'core-mosquitto'),
-        config.get('mqtt_port', 1883),
-        60
-    )
-    # Auto-reconnect callback on disconnect
-    client.on_disconnect = lambda c, u, rc: c.reconnect()
-    client.loop_start()
+    # Connection state, jittered reconnect backoff and renewed subscriptions; paho reconnects
+    # in the background, so the poller keeps collecting while the broker is away
+    mqtt_supervisor = MqttSupervisor(client)
+    mqtt_address = (config.get('mqtt_broker', 'core-mosquitto'), config.get('mqtt_port', 1883), 60)
+    try:
+        client.connect(*mqtt_address)
+    except Exception as e:
+        print(f"[WARN] MQTT broker not reachable ({e}), connecting in the background")
+        client.connect_async(*mqtt_address)
+
+    # Discovery configs are announced once; Home Assistant's birth message re-announces them
+    # discovery_mode device: one config per battery and one for the ESS instead of one per entity
+    discovery.configure(config)
+    discovery.subscribe(client)
 
     # Print current config settings nicely to console
     main_console.print_config_table(config)
+
+    # Optional asyncio engine: gateway, MQTT and polling on one event loop
+    if config.get('async_engine', False):
+        import main_async
+        modules = {
+            'main_settings': main_settings,
+            'modbus_registers': modbus_registers,
+            'modbus_battery': modbus_battery,
+            'parser_battery': parser_battery,
+            'parser_temperature': parser_temperature,
+            'modbus_inverter': modbus_inverter,
+            'modbus_eeprom': modbus_eeprom,
+        }
+        if main_async.run(config, client, modules, pad_state_path, mqtt_supervisor):
+            sys.exit(0)
+
+    client.loop_start()
+
+    # Optional bounded publish queue: paho gets the messages in bursts from its own thread,
+    # coalesced per topic when the broker falls behind; it stands in for the client from here on
+    # With mqtt_spool, messages published while the broker is away go to /data and are replayed later
+    publisher = None
+    spool = None
+    if config.get('mqtt_spool', False):
+        spool = MqttSpool(
+            max_bytes=config.get('mqtt_spool_max_mb', DEFAULT_SPOOL_MAX_BYTES // (1024 * 1024)) * 1024 * 1024,
+            max_age=config.get('mqtt_spool_max_age', DEFAULT_SPOOL_MAX_AGE),
+            mode=config.get('mqtt_spool_replay', 'latest'),
+            rate=config.get('mqtt_spool_rate', DEFAULT_SPOOL_REPLAY_RATE),
+        )
+    if config.get('publish_queue', False) or spool:
+        publisher = MqttPublisher(client, config.get('publish_queue_size', DEFAULT_PUBLISH_QUEUE_SIZE), spool)
+        publisher.start()
+        client = publisher
+        print(f"[INFO] MQTT publish queue enabled ({publisher.maxsize} messages"
+              f"{', spool ' + spool.path if spool else ''})")
     
     # Open connection to Modbus gateway device
     try:
@@ -139,6 +204,38 @@ if __name__ == '__main__':
 
     battery_ids = list(range(1, num_batteries + 1))
 
+    # Multi-rate polling lanes: slow queries are read every few cycles (lane of each REGISTER_SCHEMA block,
+    # or QUERY_INTERVALS of a modbus_battery override, unless a poll_interval_* option is set); off by default
+    handle_battery_params = inspect.signature(handle_battery).parameters
+    query_intervals = get_query_intervals(
+        config,
+        get_optional_attr(modbus_battery, "QUERY_INTERVALS", warn_if_missing=False)
+        or modbus_schema.active_schema().intervals)
+    lanes = None
+    if query_intervals and 'due' in handle_battery_params:
+        lanes = LaneSchedule(query_intervals, read_timeout, battery_ids)
+        if lanes.every:
+            print(f"[INFO] Polling lanes: {lanes.describe(read_timeout)}, everything else every {read_timeout}s")
+        else:
+            lanes = None
+
+    # Merge register blocks into fewer bus transactions: adjacent ones by default, read_merge_gap n
+    # (or -1, auto) also reads through up to n unmapped registers between them (see modbus_planner)
+    max_gap, max_count = modbus_planner.get_merge_settings(config, queries_delay)
+    read_plans = {
+        i: modbus_planner.build_plan_for_battery(i, queries[i], modbus_registers, max_gap, max_count,
+                                                 query_intervals if lanes else None)
+        for i in battery_ids
+    }
+    if 'read_plan' in handle_battery_params:
+        print()
+        main_console.print_read_plan_table(
+            modbus_planner.plan_report(queries[1], read_plans[1], num_batteries, max_gap, max_count,
+                                       config, queries_delay))
+    else:
+        # Custom handle_battery overrides written before the planner keep separate queries
+        read_plans = dict.fromkeys(battery_ids)
+
     # Setup and publish inverter protocols if enabled and module present
     refresh_inverter_protocol = None
     if enable_modbus_inverter and modbus_inverter is not None:
@@ -147,7 +244,8 @@ if __name__ == '__main__':
             gateway,
             battery_ids,
             modbus_registers,
-            on_write=lambda: globals().__setitem__('pause_polling_until', time.time() + 10)
+            on_write=lambda: arbiter.pause_polling(10),
+            arbiter=arbiter
         )
 
         # Print known inverter protocols statically defined in registers file
@@ -182,130 +280,157 @@ if __name__ == '__main__':
         delete_battery_cell_topics_on_zeropad_change(client, num_batteries, zero_pad_cells)
         save_zeropad_state(zero_pad_cells, pad_state_path)
 
+    # Per-cycle ESS summary with spike filtering
+    aggregator = EssAggregator(
+        num_batteries, filter_spikes, filter_temperature_spikes,
+        main_settings.temp_min_limit, main_settings.temp_max_limit
+    )
+
+    # Optional staged pipeline: the polling thread only moves frames, decoding and MQTT run on workers
+    pipeline = None
+    if config.get('pipeline', False):
+        read_battery_frames = get_optional_attr(parser_battery, "read_battery_frames")
+        process_battery_frames = get_optional_attr(parser_battery, "process_battery_frames")
+        if read_battery_frames and process_battery_frames:
+            def process_frames(target, index, bv, cv, tv, et):
+                return process_battery_frames(
+                    target, index, bv, cv, tv, et, battery_model, zero_pad_cells,
+                    main_settings.cell_min_limit, main_settings.cell_max_limit,
+                    main_settings.volt_min_limit, main_settings.volt_max_limit,
+                    main_settings.temp_min_limit, main_settings.temp_max_limit,
+                    warnings_enabled=warnings_enabled,
+                    console_output_enabled=console_output_enabled
+                )
+            pipeline = BatteryPipeline(client, process_frames, aggregator, publish_summary_sensors,
+                                       publish_link_sensors, num_batteries)
+            pipeline.start()
+            print("[INFO] Staged pipeline enabled: bus -> decode -> publish")
+        else:
+            print("[WARN] parser_battery has no read_battery_frames/process_battery_frames, pipeline disabled")
+
+    # Per-cycle sink: the pipeline when enabled, the aggregator directly otherwise
+    cycle_sink = pipeline or aggregator
+
     # Print separator line
     print("-" * 112)
     
     # === Main polling loop ===
+    # Cycles start on wall-clock multiples of read_timeout, however long polling takes
+    scheduler = CycleScheduler(read_timeout)
     try:
         while True:
-            # Pause polling if instructed (e.g. after inverter protocol write)
-            if time.time() < pause_polling_until:
-                time.sleep(0.1)
+            # Pause polling if instructed (e.g. after inverter protocol write);
+            # queued commands and confirmation reads still run
+            if arbiter.polling_paused():
+                arbiter.wait(0.1)
                 continue
 
-            # Wait configured timeout before each full polling iteration
-            time.sleep(read_timeout)
-
-            # Reopen Modbus gateway connection as a workaround to keep it stable
-            try:
-                gateway.close()
-                time.sleep(0.2)
-                gateway.open()
-            except Exception as e:
-                print(f"[ERROR] Failed to reopen gateway: {e}")
+            # Wait for the next tick of the polling period, serving queued bus jobs meanwhile
+            arbiter.wait(scheduler.next_delay())
+            if arbiter.polling_paused():
+                continue
+            scheduler.begin_cycle()
+
+            # Gateway link is persistent; it is only reopened (with backoff) after
+            # a transaction reported it dead or desynchronised
+            links = (gateway.link, mqtt_supervisor.state)
+            if not gateway.ensure_connected():
+                if pipeline:
+                    pipeline.publish_links(links)
+                else:
+                    publish_link_sensors(client, links)
+                scheduler.end_cycle()
                 continue
 
-            # Initialize accumulators for current and power sums
-            sum_current = 0.0
-            sum_power = 0.0
-
-            # Lists to accumulate filtered valid values for SOC, voltages, temperatures
-            valid_socs = []
-            valid_voltages = []
-            valid_env = []
-            valid_mos = []
-
-            # Poll each battery sequentially
-            for i in range(1, num_batteries + 1):
-                # Delay between battery polls to avoid gateway overload
-                if i > 1:
+            cycle_sink.start_cycle()
+
+            # Poll each battery sequentially, starting with any deferred last cycle
+            order = scheduler.order(battery_ids)
+            for n, i in enumerate(order):
+                # MQTT commands (writes) go before the next battery poll
+                arbiter.run_pending(PRIORITY_WRITE)
+                if n > 0:
+                    # Leave the rest for the next cycle rather than stretching the period
+                    # (or for after the pause a write asked for)
+                    if not scheduler.fits() or arbiter.polling_paused():
+                        scheduler.defer(order[n:])
+                        for j in order[n:]:
+                            cycle_sink.add_deferred(j)
+                        break
+                    # Delay between battery polls to avoid gateway overload
                     time.sleep(next_battery_delay)
-
-                # Query and parse battery data; returns MOS and environmental temperatures
-                mos_t, env_t = handle_battery(
-                    client, i, queries, gateway, battery_model, zero_pad_cells, queries_delay,
-                    main_settings.cell_min_limit, main_settings.cell_max_limit,
-                    main_settings.volt_min_limit, main_settings.volt_max_limit,
-                    main_settings.temp_min_limit, main_settings.temp_max_limit,
-                    warnings_enabled=warnings_enabled,
-                    console_output_enabled=console_output_enabled
-                ) or (None, None)
-
-                # --- SOC spike filtering ---
-                if filter_spikes and i in last_valid_soc:
-                    filtered_soc = filter_spikes(last_valid_soc[i], last_n_socs, max_delta=5)
-                    if filtered_soc is not None:
-                        last_n_socs.append(filtered_soc)
-                        if len(last_n_socs) > history_len:
-                            last_n_socs.pop(0)
-                        valid_socs.append(filtered_soc)
-
-                # --- Voltage spike filtering ---
-                if filter_spikes and i in last_valid_voltage:
-                    filtered_voltage = filter_spikes(last_valid_voltage[i], last_n_voltages, max_delta=2.0)
-                    if filtered_voltage is not None:
-                        last_n_voltages.append(filtered_voltage)
-                        if len(last_n_voltages) > history_len:
-                            last_n_voltages.pop(0)
-                        valid_voltages.append(filtered_voltage)
-
-                # --- Accumulate current and power for summary ---
-                current = last_valid_current.get(i)
-                power = last_valid_power.get(i)
-                if current is not None:
-                    sum_current += current
-                if power is not None:
-                    sum_power += power
-
-                # --- MOS temperature spike filtering ---
-                if filter_temperature_spikes and mos_t is not None:
-                    if i not in last_n_mos:
-                        last_n_mos[i] = []
-                    filtered_mos_list = filter_temperature_spikes(
-                        [mos_t], last_n_mos[i],
-                        main_settings.temp_min_limit, main_settings.temp_max_limit,
-                        delta_limit=2.0
-                    )
-                    filtered_mos = filtered_mos_list[0]
-                    if filtered_mos is not None:
-                        last_n_mos[i].append(filtered_mos)
-                        if len(last_n_mos[i]) > history_len:
-                            last_n_mos[i].pop(0)
-                        valid_mos.append(filtered_mos)
-
-                # --- Environmental temperature spike filtering ---
-                if filter_temperature_spikes and env_t is not None:
-                    if i not in last_n_env:
-                        last_n_env[i] = []
-                    filtered_env_list = filter_temperature_spikes(
-                        [env_t], last_n_env[i],
+                started = time.monotonic()
+
+                # Optional arguments only passed to handle_battery versions that take them
+                extra = {}
+                if read_plans[i]:
+                    extra['read_plan'] = read_plans[i]
+                if lanes:
+                    extra['due'] = lanes.due(i, queries[i], scheduler.tick)
+
+                if pipeline:
+                    # Bus stage only: read the frames and hand them to the decode stage
+                    pipeline.add_frames(i, read_battery_frames(
+                        i, queries, gateway, queries_delay, warnings_enabled, **extra))
+                else:
+                    # Query and parse battery data; returns MOS and environmental temperatures
+                    mos_t, env_t = handle_battery(
+                        client, i, queries, gateway, battery_model, zero_pad_cells, queries_delay,
+                        main_settings.cell_min_limit, main_settings.cell_max_limit,
+                        main_settings.volt_min_limit, main_settings.volt_max_limit,
                         main_settings.temp_min_limit, main_settings.temp_max_limit,
-                        delta_limit=2.0
-                    )
-                    filtered_env = filtered_env_list[0]
-                    if filtered_env is not None:
-                        last_n_env[i].append(filtered_env)
-                        if len(last_n_env[i]) > history_len:
-                            last_n_env[i].pop(0)
-                        valid_env.append(filtered_env)
-
-            # Calculate averages of filtered values or None if no data
-            soc_avg = round(sum(valid_socs) / len(valid_socs), 1) if valid_socs else None
-            volt_avg = round(sum(valid_voltages) / len(valid_voltages), 2) if valid_voltages else None
-            mos_avg = round(sum(valid_mos) / len(valid_mos), 1) if len(valid_mos) >= num_batteries else None
-            env_avg = round(sum(valid_env) / len(valid_env), 1) if len(valid_env) >= num_batteries else None
-
-            # Optionally you could use median instead of average for robustness
-            # from statistics import median
-            # mos_avg = round(median(valid_mos), 1) if valid_mos else None
-            # env_avg = round(median(valid_env), 1) if valid_env else None
-
-            # Publish aggregated battery metrics via MQTT
-            publish_summary_sensors(client, soc_avg, volt_avg, sum_current, sum_power, mos_avg, env_avg)
+                        warnings_enabled=warnings_enabled,
+                        console_output_enabled=console_output_enabled,
+                        **extra
+                    ) or (None, None)
+
+                    # Spike-filter and accumulate this battery into the ESS summary
+                    aggregator.add_battery(i, mos_t, env_t)
+                scheduler.unit_done(time.monotonic() - started + next_battery_delay)
+                if lanes:
+                    lanes.polled(i, extra['due'], scheduler.tick)
+            else:
+                scheduler.defer([])
+
+            # Publish aggregated battery metrics and link sensors via MQTT, one ESS state document per cycle
+            if pipeline:
+                pipeline.finish_cycle(links)
+            else:
+                publish_summary_sensors(client, *aggregator.finish_cycle(), links=links)
+            scheduler.end_cycle()
+
+            if console_output_enabled:
+                stats = gateway.stats()
+                print(f"Gateway link: connects {stats['connects']}, reconnects {stats['reconnects']}, "
+                      f"timeouts {stats['timeout']}, bad CRC {stats['crc']}, wrong slave {stats['slave']}, I/O errors {stats['io']}")
+                print(f"Links: {gateway.link.summary()}; {mqtt_supervisor.state.summary()}")
+                print(scheduler.summary())
+                cells = cell_stack().summary(main_settings.cell_min_limit, main_settings.cell_max_limit)
+                if cells:
+                    print(cells)
+                filters = filter_state()
+                if filters.mode == 'hampel':
+                    print(f"Hampel filter: {filters.outliers()} samples replaced by the window median")
+                print(discovery.summary())
+                print(mqtt_deadband.change_filter().summary())
+                if pipeline:
+                    print(pipeline.summary())
+                if publisher:
+                    print(publisher.summary())
+                if spool:
+                    print(spool.summary())
+                jobs = arbiter.stats()
+                if jobs['done'] or jobs['failed']:
+                    print(f"Bus jobs: done {jobs['done']}, failed {jobs['failed']}, pending {jobs['pending']}, "
+                          f"longest queue wait {jobs['max_wait']:.2f}s")
 
     except Exception as e:
         print(f"[ERROR] Exception in main loop: {e}")
     finally:
         # Clean up MQTT client loop and close gateway on exit
+        if pipeline:
+            pipeline.stop()
+        if publisher:
+            publisher.stop()
         client.loop_stop()
         gateway.close()
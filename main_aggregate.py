@@ -0,0 +1,139 @@
+# main_aggregate.py
+
+from main_state import battery_store                # Last valid values per battery
+from main_filters import filter_state               # Per battery, per signal spike filter state
+
+
+class EssAggregator:
+    """
+    Collects the per-battery results of one polling cycle into the Ritar ESS
+    summary values (SOC/voltage averages, current/power totals, MOS/ENV
+    temperature averages). With spike_filter mean every battery has its own
+    filter history per signal here; with median/hampel parser_battery has
+    already filtered the values once before caching them, so they are used
+    as they are. Only values read since the battery's last cycle go through
+    a filter: deferred batteries, and values a slow lane did not read this
+    cycle, count with their last filtered values and leave the histories alone.
+
+    Used by both the blocking main loop and the asyncio engine in main_async.
+    """
+
+    def __init__(self, num_batteries, filter_spikes, filter_temperature_spikes,
+                 temp_min_limit, temp_max_limit, filters=None):
+        self.num_batteries = num_batteries
+        self.filter_spikes = filter_spikes
+        self.filter_temperature_spikes = filter_temperature_spikes
+        self.temp_min_limit = temp_min_limit
+        self.temp_max_limit = temp_max_limit
+        self.filters = filters or filter_state()
+
+        # Last filtered MOS/ENV temperatures per battery, for cycles that did not read them
+        self.last_temperatures = {}
+        # BatteryState.updated seen per battery, to tell read core values from cached ones
+        self.last_updated = {}
+        self.start_cycle()
+
+    def start_cycle(self):
+        # Initialize accumulators for current and power sums
+        self.sum_current = 0.0
+        self.sum_power = 0.0
+
+        # Lists to accumulate filtered valid values for SOC, voltages, temperatures
+        self.valid_socs = []
+        self.valid_voltages = []
+        self.valid_env = []
+        self.valid_mos = []
+
+    def _filter_temperature(self, signal, i, value):
+        if self.filters.robust_enabled:
+            # Filtered by parser_battery already
+            return value if self.temp_min_limit <= value <= self.temp_max_limit else None
+        # Compared with the newest accepted reading of the same sensor
+        history = self.filters.history(signal, i)
+        last = history.last()
+        filtered = self.filter_temperature_spikes(
+            [value], [] if last is None else [last],
+            self.temp_min_limit, self.temp_max_limit,
+            delta_limit=2.0
+        )[0]
+        if filtered is not None:
+            history.append(filtered)
+        return filtered
+
+    def _filter(self, signal, i, value, max_delta, fresh=True):
+        if self.filters.robust_enabled:
+            return value        # filtered by parser_battery already
+        history = self.filters.history(signal, i)
+        if not fresh:
+            # Cached value: the last filtered one, without feeding it into the history again
+            last = history.last()
+            return value if last is None else last
+        filtered = self.filter_spikes(value, history, max_delta=max_delta)
+        if filtered is not None:
+            history.append(filtered)
+        return filtered
+
+    def add_battery(self, i, mos_t, env_t):
+        """Fold battery i (cached values from parser_battery plus its MOS/ENV temperatures) into the cycle."""
+        filter_spikes = self.filter_spikes
+
+        # One read of the battery's stored values; fresh if parser_battery stored any since the last cycle
+        state = battery_store().get(i)
+        soc, voltage, current, power = state.snapshot()
+        fresh = state.updated != self.last_updated.get(i)
+        self.last_updated[i] = state.updated
+
+        # --- SOC spike filtering ---
+        if filter_spikes and soc is not None:
+            filtered_soc = self._filter('soc', i, soc, 5, fresh)
+            if filtered_soc is not None:
+                self.valid_socs.append(filtered_soc)
+
+        # --- Voltage spike filtering ---
+        if filter_spikes and voltage is not None:
+            filtered_voltage = self._filter('voltage', i, voltage, 2.0, fresh)
+            if filtered_voltage is not None:
+                self.valid_voltages.append(filtered_voltage)
+
+        # --- Accumulate current and power for summary ---
+        if current is not None:
+            self.sum_current += current
+        if power is not None:
+            self.sum_power += power
+
+        # --- MOS / environmental temperature spike filtering ---
+        if self.filter_temperature_spikes:
+            last_mos, last_env = self.last_temperatures.get(i, (None, None))
+            # Not read this cycle (slow lane or deferred battery): the last filtered values
+            mos = last_mos if mos_t is None else self._filter_temperature('mos', i, mos_t)
+            env = last_env if env_t is None else self._filter_temperature('env', i, env_t)
+            self.last_temperatures[i] = (last_mos if mos is None else mos, last_env if env is None else env)
+            if mos is not None:
+                self.valid_mos.append(mos)
+            if env is not None:
+                self.valid_env.append(env)
+
+    def add_deferred(self, i):
+        """Fold in battery i with its last known values when the scheduler left it out of this cycle."""
+        self.add_battery(i, None, None)
+
+    def finish_cycle(self):
+        """
+        Returns:
+            tuple: (soc_avg, volt_avg, sum_current, sum_power, mos_avg, env_avg) for publish_summary_sensors.
+        """
+        valid_socs, valid_voltages = self.valid_socs, self.valid_voltages
+        valid_mos, valid_env = self.valid_mos, self.valid_env
+
+        # Calculate averages of filtered values or None if no data
+        soc_avg = round(sum(valid_socs) / len(valid_socs), 1) if valid_socs else None
+        volt_avg = round(sum(valid_voltages) / len(valid_voltages), 2) if valid_voltages else None
+        mos_avg = round(sum(valid_mos) / len(valid_mos), 1) if len(valid_mos) >= self.num_batteries else None
+        env_avg = round(sum(valid_env) / len(valid_env), 1) if len(valid_env) >= self.num_batteries else None
+
+        # Optionally you could use median instead of average for robustness
+        # from statistics import median
+        # mos_avg = round(median(valid_mos), 1) if valid_mos else None
+        # env_avg = round(median(valid_env), 1) if valid_env else None
+
+        return soc_avg, volt_avg, self.sum_current, self.sum_power, mos_avg, env_avg
@@ -1,20 +1,18 @@
 # main_arrays.py
 
-# === Polling throttle flag ===
-pause_polling_until = 0
-
 # === History and smoothing buffers ===
-last_n_socs = []
-last_n_voltages = []
-last_n_env = {}
-last_n_mos = {}
-history_len = 10  # number of values to keep for smoothing
+# Spike filter histories are per battery rings in main_filters.FilterState
+history_len = 10  # default number of values to keep for smoothing (config: history_len, history_len_<signal>)
 
 # === Persistent fallback cache ===
-last_valid_cycle_count = {}
-last_valid_temps = {}
-last_valid_extra = {}
-last_valid_soc = {}
-last_valid_voltage = {}
-last_valid_current = {}
-last_valid_power = {}
+# Values live in main_state.battery_store(); these are dict-style views on it
+# for modules (and United BMS overrides) that still use the per-field dicts
+from main_state import StateView
+
+last_valid_cycle_count = StateView('cycle')
+last_valid_temps = StateView('temps')
+last_valid_extra = StateView('extra')
+last_valid_soc = StateView('soc')
+last_valid_voltage = StateView('voltage')
+last_valid_current = StateView('current')
+last_valid_power = StateView('power')
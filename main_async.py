@@ -0,0 +1,443 @@
+# main_async.py
+#
+# asyncio engine, enabled with the async_engine option. The Modbus gateway,
+# the MQTT client, the polling loop, the EEPROM reader, the inverter protocol
+# command handler and periodic jobs all run as tasks on one event loop, so a
+# slow battery or an inverter protocol write never blocks the others.
+
+import json
+import time
+import signal
+import asyncio
+import threading
+
+import main_console
+from main_helpers import validate_delay, has_zeropad_changed, save_zeropad_state, get_optional_attr
+from main_aggregate import EssAggregator
+from main_scheduler import CycleScheduler, LaneSchedule, get_query_intervals
+from modbus_gateway_async import AsyncModbusGateway
+from modbus_schema import active_schema
+from parser_cells import cell_stack
+from main_filters import filter_state
+from mqtt_discovery import registry as discovery
+from mqtt_deadband import change_filter
+from main_links import subscribe
+import modbus_planner
+from mqtt_core import (
+    publish_summary_sensors,
+    publish_inverter_protocol_config,
+    publish_inverter_protocol_state,
+    publish_link_sensors,
+    delete_battery_cell_topics_on_zeropad_change,
+    INVERTER_PROTOCOLS_REVERSE,
+)
+
+# Seconds polling stays paused after an inverter protocol write, as in the blocking engine
+INVERTER_WRITE_PAUSE = 10
+
+# Seconds between link statistics lines on the console
+STATS_INTERVAL = 60
+
+# Seconds an MQTT reconnect may take to be acknowledged before the next attempt
+MQTT_CONNACK_WAIT = 10
+
+# Options of the blocking engine's worker threads (publish queue, MQTT spool,
+# staged pipeline); this engine publishes from the loop and does not use them
+BLOCKING_ENGINE_OPTIONS = ('publish_queue', 'mqtt_spool', 'pipeline')
+
+
+class MqttAsyncAdapter:
+    """
+    Drive a paho MQTT client from the event loop instead of loop_start()'s thread.
+
+    The client socket is watched with add_reader/add_writer and loop_misc()
+    runs once a second for keepalive, so message callbacks execute on the loop
+    thread and can schedule gateway tasks directly. Socket callbacks from
+    another thread (reconnect() runs in an executor) are handed to the loop.
+    """
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self._misc = None
+        self._loop_thread = None
+
+    def _call(self, fn, *args):
+        if threading.get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def attach(self):
+        self._loop_thread = threading.get_ident()
+        client = self.client
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        # connect() already ran in main.py, so the first socket is picked up here
+        sock = client.socket()
+        if sock is not None:
+            self._on_socket_open(client, None, sock)
+            if client.want_write():
+                self._on_socket_register_write(client, None, sock)
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def detach(self):
+        if self._misc:
+            self._misc.cancel()
+        sock = self.client.socket()
+        if sock is not None:
+            self._on_socket_close(self.client, None, sock)
+
+    # File descriptors rather than sockets: a deferred call may run after the socket closed
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        fd = sock.fileno()
+        self._call(self.loop.remove_reader, fd)
+        self._call(self.loop.remove_writer, fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock.fileno())
+
+    async def _misc_loop(self):
+        while True:
+            await asyncio.sleep(1)
+            self.client.loop_misc()
+
+
+class AsyncEngine:
+    def __init__(self, config, client, modules, pad_state_path, mqtt_supervisor=None):
+        self.config = config
+        self.client = client
+        self.mqtt_supervisor = mqtt_supervisor
+        self.main_settings = modules['main_settings']
+        self.modbus_registers = modules['modbus_registers']
+        self.modbus_battery = modules['modbus_battery']
+        self.modbus_inverter = modules.get('modbus_inverter')
+        self.modbus_eeprom = modules.get('modbus_eeprom')
+        self.process_battery_frames = get_optional_attr(modules['parser_battery'], "process_battery_frames")
+        self.filter_spikes = get_optional_attr(modules['parser_battery'], "filter_spikes")
+        self.filter_temperature_spikes = get_optional_attr(modules['parser_temperature'], "filter_temperature_spikes")
+        self.pad_state_path = pad_state_path
+
+        self.gateway = AsyncModbusGateway(config, self.modbus_registers)
+        self.battery_model = config.get('battery_model', 'BAT-5KWH-51.2V')
+        self.read_timeout = config.get('read_timeout', 15)
+        self.zero_pad_cells = config.get('zero_pad_cells', False)
+        self.queries_delay, self.next_battery_delay = validate_delay(config)
+        self.console_output_enabled = config.get('console_output_enabled', False)
+        self.warnings_enabled = config.get('warnings_enabled', False)
+        self.num_batteries = config.get('num_batteries', 1)
+        self.battery_ids = list(range(1, self.num_batteries + 1))
+
+        self.queries = {
+            i: self.modbus_battery.get_all_queries_for_battery(i, self.modbus_registers)
+            for i in self.battery_ids
+        }
+        # Multi-rate polling lanes (REGISTER_SCHEMA lanes, or QUERY_INTERVALS of a modbus_battery override)
+        query_intervals = get_query_intervals(
+            config,
+            get_optional_attr(self.modbus_battery, "QUERY_INTERVALS", warn_if_missing=False)
+            or active_schema().intervals)
+        self.lanes = LaneSchedule(query_intervals, self.read_timeout, self.battery_ids)
+        if not self.lanes.every:
+            self.lanes = None
+            query_intervals = None
+
+        max_gap, max_count = modbus_planner.get_merge_settings(config, self.queries_delay)
+        self.read_plans = {
+            i: modbus_planner.build_plan_for_battery(i, self.queries[i], self.modbus_registers, max_gap, max_count,
+                                                     query_intervals)
+            for i in self.battery_ids
+        }
+        self.plan_rows = modbus_planner.plan_report(
+            self.queries[1], self.read_plans[1], self.num_batteries, max_gap, max_count, config, self.queries_delay)
+
+        # Cycles start on wall-clock multiples of read_timeout, however long polling takes
+        self.scheduler = CycleScheduler(self.read_timeout)
+        self.pause_polling_until = 0.0
+        self._command_lock = None
+        self._tasks = set()
+
+    def supported(self) -> bool:
+        """The asyncio engine drives parser_battery.process_battery_frames; older overrides only have handle_battery."""
+        return self.process_battery_frames is not None
+
+    def spawn(self, coro, name):
+        """Run coro as a task that is cancelled on shutdown; errors are logged, not lost."""
+        task = asyncio.get_running_loop().create_task(coro, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[ERROR] Task {task.get_name()} failed: {task.exception()!r}")
+
+    # === Inverter protocol ===
+    async def setup_inverter_protocol(self):
+        inverter = self.modbus_inverter
+        topic_state, topic_cmd = publish_inverter_protocol_config(self.client)
+
+        types = []
+        for bat in self.battery_ids:
+            val = await inverter.read_inverter_protocol_async(self.gateway, bat, self.modbus_registers)
+            if val is not None:
+                types.append(val)
+            else:
+                print(f"[WARN] No inverter protocol read from battery {bat}")
+            await asyncio.sleep(0.5)
+        publish_inverter_protocol_state(self.client, topic_state, types, warn=True)
+
+        def on_message(client, userdata, msg):
+            # Runs on the loop thread (MqttAsyncAdapter), the write itself is a task
+            self.spawn(self.change_inverter_protocol(topic_state, msg.payload.decode().strip()),
+                       "inverter-protocol")
+
+        subscribe(self.client, topic_cmd, on_message)
+
+        print("\n[INFO] Supported inverter protocols from modbus_registers:\n")
+        main_console.print_inverter_protocols_table(self.modbus_registers.INVERTER_PROTOCOLS)
+        protocols_list = await inverter.read_all_inverter_protocols_async(
+            self.gateway, self.battery_ids, self.modbus_registers)
+        print("\n[INFO] Inverter protocols currently set in batteries:\n")
+        main_console.print_inverter_protocols_table_batteries(protocols_list)
+
+    def _pause_polling(self):
+        self.pause_polling_until = time.time() + INVERTER_WRITE_PAUSE
+
+    async def change_inverter_protocol(self, topic_state, payload):
+        if self._command_lock is None:
+            self._command_lock = asyncio.Lock()
+        value = INVERTER_PROTOCOLS_REVERSE.get(payload)
+        if value is None:
+            print(f"[WARN] Unknown inverter protocol: {payload}")
+            print("-" * 112)
+            return
+
+        async with self._command_lock:
+            print(f"[MQTT] Changing inverter protocol to: {payload} ({value})")
+            self._pause_polling()
+            for bat in self.battery_ids:
+                await self.modbus_inverter.write_inverter_protocol_async(
+                    self.gateway, bat, value, self.modbus_registers, on_write=self._pause_polling)
+                await asyncio.sleep(2)
+            self.client.publish(topic_state, json.dumps({"state": payload}), retain=True)
+
+            print("[INFO] Please wait result confirmation...")
+            updated_protocols = await self.modbus_inverter.read_all_inverter_protocols_async(
+                self.gateway, self.battery_ids, self.modbus_registers)
+            main_console.print_inverter_protocols_table_batteries(updated_protocols)
+            # Report what the batteries actually use now
+            publish_inverter_protocol_state(
+                self.client, topic_state, [val for _, val, _ in updated_protocols if val is not None])
+            print("[INFO] Next change available after 10 seconds !")
+            print("-" * 112)
+
+    # === Battery polling ===
+    async def poll_batteries(self):
+        settings = self.main_settings
+        aggregator = EssAggregator(
+            self.num_batteries, self.filter_spikes, self.filter_temperature_spikes,
+            settings.temp_min_limit, settings.temp_max_limit
+        )
+        scheduler = self.scheduler
+        while True:
+            # Pause polling if instructed (e.g. after inverter protocol write)
+            if time.time() < self.pause_polling_until:
+                await asyncio.sleep(0.1)
+                continue
+
+            await asyncio.sleep(scheduler.next_delay())
+            scheduler.begin_cycle()
+
+            if not await self.gateway.ensure_connected():
+                self.publish_links()
+                scheduler.end_cycle()
+                continue
+
+            aggregator.start_cycle()
+            order = scheduler.order(self.battery_ids)
+            for n, i in enumerate(order):
+                if n > 0:
+                    # Leave the rest for the next cycle rather than stretching the period
+                    if not scheduler.fits():
+                        scheduler.defer(order[n:])
+                        for j in order[n:]:
+                            aggregator.add_deferred(j)
+                        break
+                    await asyncio.sleep(self.next_battery_delay)
+                started = time.monotonic()
+
+                due = self.lanes.due(i, self.queries[i], scheduler.tick) if self.lanes else None
+                responses = await modbus_planner.execute_plan_async(
+                    self.gateway, i, self.read_plans[i], self.queries[i],
+                    self.queries_delay, self.warnings_enabled, due)
+                mos_t, env_t = self.process_battery_frames(
+                    self.client, i,
+                    responses.get('get_block_voltage'), responses.get('get_cells_voltage'),
+                    responses.get('get_temperature'), responses.get('get_extra_temperature'),
+                    self.battery_model, self.zero_pad_cells,
+                    settings.cell_min_limit, settings.cell_max_limit,
+                    settings.volt_min_limit, settings.volt_max_limit,
+                    settings.temp_min_limit, settings.temp_max_limit,
+                    warnings_enabled=self.warnings_enabled,
+                    console_output_enabled=self.console_output_enabled
+                ) or (None, None)
+                scheduler.unit_done(time.monotonic() - started + self.next_battery_delay)
+                if self.lanes:
+                    self.lanes.polled(i, due, scheduler.tick)
+                aggregator.add_battery(i, mos_t, env_t)
+            else:
+                scheduler.defer([])
+
+            # One ESS state document per cycle: link sensors go with the summary
+            publish_summary_sensors(self.client, *aggregator.finish_cycle(), links=self.links())
+            scheduler.end_cycle()
+
+    def links(self) -> list:
+        links = [self.gateway.link]
+        if self.mqtt_supervisor is not None:
+            links.append(self.mqtt_supervisor.state)
+        return links
+
+    def publish_links(self):
+        publish_link_sensors(self.client, self.links())
+
+    # === Periodic jobs ===
+    async def mqtt_reconnect(self):
+        """
+        Reconnect MQTT with the supervisor's jittered backoff. There is no paho
+        network thread in this engine; the blocking connect runs in an executor
+        so the loop keeps polling meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(1)
+            if self.client.is_connected():
+                continue
+            delay = self.mqtt_supervisor.next_retry_delay()
+            print(f"[WARN] MQTT disconnected, reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            try:
+                await loop.run_in_executor(None, self.client.reconnect)
+            except Exception as e:
+                print(f"[WARN] MQTT reconnect failed: {e}")
+                continue
+            # Wait for the CONNACK before judging the attempt
+            for _ in range(MQTT_CONNACK_WAIT):
+                if self.client.is_connected():
+                    break
+                await asyncio.sleep(1)
+
+    async def print_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            stats = self.gateway.stats()
+            print(f"Gateway link: connects {stats['connects']}, reconnects {stats['reconnects']}, "
+                  f"timeouts {stats['timeout']}, bad CRC {stats['crc']}, wrong slave {stats['slave']}, I/O errors {stats['io']}")
+            links = [self.gateway.link.summary()]
+            if self.mqtt_supervisor is not None:
+                links.append(self.mqtt_supervisor.state.summary())
+            print(f"Links: {'; '.join(links)}")
+            print(self.scheduler.summary())
+            cells = cell_stack().summary(self.main_settings.cell_min_limit, self.main_settings.cell_max_limit)
+            if cells:
+                print(cells)
+            filters = filter_state()
+            if filters.mode == 'hampel':
+                print(f"Hampel filter: {filters.outliers()} samples replaced by the window median")
+            print(discovery.summary())
+            print(change_filter().summary())
+
+    # === Startup / shutdown ===
+    async def startup(self):
+        """One-off reads in the same order as the blocking engine, then start polling."""
+        if self.modbus_inverter is not None:
+            await self.setup_inverter_protocol()
+        else:
+            print("[INFO] modbus_inverter disabled; skipping inverter protocols read")
+
+        if self.modbus_eeprom is not None:
+            print("Please wait for BMS EEPROM reading...")
+            await self.modbus_eeprom.read_and_process_presets_async(
+                self.client, self.gateway, self.battery_ids, self.modbus_registers)
+        else:
+            print("[INFO] EEPROM presets read skipped due to configuration")
+
+        # Let MQTT topics settle
+        await asyncio.sleep(5)
+
+        if has_zeropad_changed(self.zero_pad_cells, self.pad_state_path):
+            print("[INFO] zero_pad_cells setting changed — cleaning old cell MQTT topics...")
+            delete_battery_cell_topics_on_zeropad_change(self.client, self.num_batteries, self.zero_pad_cells)
+            save_zeropad_state(self.zero_pad_cells, self.pad_state_path)
+
+        print("-" * 112)
+        self.spawn(self.poll_batteries(), "poll-batteries")
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        mqtt_adapter = MqttAsyncAdapter(self.client, loop)
+        mqtt_adapter.attach()
+        try:
+            try:
+                await self.gateway.open()
+            except Exception as e:
+                print(f"[ERROR] Cannot open gateway: {e}")
+                return
+
+            if self.lanes:
+                print(f"[INFO] Polling lanes: {self.lanes.describe(self.read_timeout)}, "
+                      f"everything else every {self.read_timeout}s")
+            print()
+            main_console.print_read_plan_table(self.plan_rows)
+
+            self.spawn(self.startup(), "startup")
+            if self.mqtt_supervisor is not None:
+                self.spawn(self.mqtt_reconnect(), "mqtt-reconnect")
+            if self.console_output_enabled:
+                self.spawn(self.print_stats(), "gateway-stats")
+
+            await stop.wait()
+            print("[INFO] Shutting down...")
+        finally:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.gateway.wait_closed()
+            # Clean MQTT disconnect, without the supervisor's disconnect callback
+            self.client.on_disconnect = None
+            self.client.disconnect()
+            mqtt_adapter.detach()
+
+
+def run(config, client, modules, pad_state_path, mqtt_supervisor=None) -> bool:
+    """
+    Run the asyncio engine until SIGTERM/SIGINT.
+
+    Returns:
+        bool: False if the loaded parser_battery cannot be driven by this engine,
+              so the caller falls back to the blocking main loop.
+    """
+    engine = AsyncEngine(config, client, modules, pad_state_path, mqtt_supervisor)
+    if not engine.supported():
+        print("[WARN] parser_battery has no process_battery_frames(); async_engine needs it, using the blocking engine")
+        return False
+    print("[INFO] Using asyncio engine")
+    ignored = [key for key in BLOCKING_ENGINE_OPTIONS if config.get(key, False)]
+    if ignored:
+        print(f"[WARN] {', '.join(ignored)} not supported by async_engine, ignored")
+    asyncio.run(engine.main())
+    return True
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# main_benchmarks.py
+#
+# Microbenchmarks for the hot paths of the addon. Run inside the addon
+# container (or any box with the same Python) to compare implementations:
+#
+#   python3 main_benchmarks.py            # run everything
+#   python3 main_benchmarks.py crc        # run a single benchmark (crc, decode, cells, robust, state, publish)
+
+import sys
+import struct
+import timeit
+import binascii
+
+from modbus_crc import modbus_crc16, crc16_update, crc16_check, CRC16_INIT
+
+
+# === Recorded-style Ritar frames (battery 1) ===
+def _frame(payload: bytes) -> bytes:
+    return payload + modbus_crc16(payload)
+
+# 0x0000 x16: current -2.50 A, 53.12 V, SOC 87.5 %, SOH 100 %, ..., 123 cycles
+BLOCK_FRAME = _frame(bytes([0x01, 0x03, 0x20]) + struct.pack(
+    '>hHHHHHHH8H', -250, 5312, 875, 1000, 8750, 10000, 10000, 123, *([0] * 8)))
+
+# 0x0028 x16: cell voltages in mV
+CELLS_FRAME = _frame(bytes([0x01, 0x03, 0x20]) + struct.pack(
+    '>16H', *(3318 + (i % 5) for i in range(16))))
+
+# 0x0078 x4: cell temperature sensors (raw 750 ~ 25.0 °C)
+TEMP_FRAME = _frame(bytes([0x01, 0x03, 0x08]) + struct.pack('>4H', 748, 750, 752, 751))
+
+# 0x0091 x10: MOS, ENV temperature and extremes
+EXTRA_FRAME = _frame(bytes([0x01, 0x03, 0x14]) + struct.pack(
+    '>10H', 760, 745, 3322, 3, 3316, 11, 752, 2, 748, 1))
+
+SAMPLE_FRAMES = {
+    'block (37 B)': BLOCK_FRAME,
+    'cells (37 B)': CELLS_FRAME,
+    'temperature (13 B)': TEMP_FRAME,
+    'extra temperature (25 B)': EXTRA_FRAME,
+}
+
+
+def _report(name, seconds, iterations):
+    per_call_us = seconds / iterations * 1e6
+    print(f"  {name:<44} {per_call_us:9.2f} µs/call")
+    return per_call_us
+
+
+# === CRC16: legacy bit loop vs table-driven engine ===
+def _crc16_bitwise(data: bytes) -> bytes:
+    """The original 8-shifts-per-byte implementation, kept as the baseline."""
+    crc = 0xFFFF
+    for pos in data:
+        crc ^= pos
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+def bench_crc(iterations=20000):
+    print("CRC16 over Ritar frames")
+    for label, frame in SAMPLE_FRAMES.items():
+        body = frame[:-2]
+        assert _crc16_bitwise(body) == modbus_crc16(body) == frame[-2:]
+        view = memoryview(frame)
+        mid = len(frame) // 2
+
+        print(f" {label}")
+        old = _report("bitwise loop (TX: crc of body)",
+                      timeit.timeit(lambda: _crc16_bitwise(body), number=iterations), iterations)
+        new = _report("table modbus_crc16 (TX: crc of body)",
+                      timeit.timeit(lambda: modbus_crc16(body), number=iterations), iterations)
+        _report("bitwise loop (RX: slice + compare)",
+                timeit.timeit(lambda: _crc16_bitwise(frame[:-2]) == frame[-2:], number=iterations), iterations)
+        _report("table crc16_check (RX: memoryview, no copy)",
+                timeit.timeit(lambda: crc16_check(view), number=iterations), iterations)
+        _report("table crc16_update (RX: 3 incremental chunks)",
+                timeit.timeit(lambda: crc16_update(crc16_update(crc16_update(
+                    CRC16_INIT, view, 0, 3), view, 3, mid), view, mid, len(frame)) == 0,
+                    number=iterations), iterations)
+        print(f"  {'speedup':<44} {old / new:9.1f} x")
+
+
+# === Frame decoding: hexlify-and-slice vs struct on memoryview ===
+# Limits as in main_settings defaults
+LIMITS = (2450, 4750, 40, 60, -20, 55)
+
+
+def _decode_hexlify(block_buf, cells_buf, temp_buf, extra_buf):
+    """The original string based decode of one battery, kept as the baseline."""
+    hb = binascii.hexlify(block_buf).decode()
+    cur_raw = int(hb[6:10], 16)
+    if cur_raw >= 0x8000:
+        cur_raw -= 0x10000
+    current = round(cur_raw / 100, 2)
+    voltage = round(int(hb[10:14], 16) / 100, 2)
+    soc = round(int(hb[14:18], 16) / 10, 1)
+    cycle = int(hb[34:38], 16)
+    power = round(current * voltage, 2)
+
+    hv = binascii.hexlify(cells_buf).decode()
+    raw_cells = [int(hv[6 + 4*i:10 + 4*i], 16) for i in range(16)]
+    cells = [v if 2450 <= v <= 4750 else None for v in raw_cells]
+
+    hx = binascii.hexlify(temp_buf).decode()
+    pairs = [hx[i:i+2] for i in range(0, len(hx), 2)][3:-2]
+    temps = [round((int(pairs[i] + pairs[i+1], 16) - 726) * 0.1 + 22.6, 1) for i in range(0, len(pairs), 2)]
+
+    he = binascii.hexlify(extra_buf).decode()
+    mos = round((int(he[6:10], 16) - 726) * 0.1 + 22.6, 1)
+    env = round((int(he[10:14], 16) - 726) * 0.1 + 22.6, 1)
+    return current, voltage, soc, cycle, power, cells, temps, mos, env
+
+
+def bench_decode(iterations=20000):
+    from parser_battery import process_battery_data
+    from parser_temperature import process_extra_temperature
+
+    views = [memoryview(f) for f in (BLOCK_FRAME, CELLS_FRAME, TEMP_FRAME, EXTRA_FRAME)]
+    cell_min, cell_max, volt_min, volt_max, temp_min, temp_max = LIMITS
+
+    def decode_struct(block_buf, cells_buf, temp_buf, extra_buf):
+        data = process_battery_data(1, block_buf, cells_buf, temp_buf, *LIMITS)
+        mos, env = process_extra_temperature(extra_buf, temp_min, temp_max)
+        return (data['current'], data['voltage'], data['soc'], data['cycle'], data['power'],
+                data['cells'], data['temps'], mos, env)
+
+    assert _decode_hexlify(*views) == decode_struct(*views)
+
+    print("Decode one battery (block, cells, temperatures, extra temperature)")
+    old = _report("hexlify + slice + int(x, 16)",
+                  timeit.timeit(lambda: _decode_hexlify(*views), number=iterations), iterations)
+    new = _report("struct.unpack_from on memoryview",
+                  timeit.timeit(lambda: decode_struct(*views), number=iterations), iterations)
+    print(f"  {'speedup':<44} {old / new:9.1f} x")
+
+
+# === Cell voltages of a 15 battery stack: per battery lists vs one (batteries x cells) array ===
+def _stack_cells_frames(batteries=15):
+    frames = []
+    for bat_id in range(1, batteries + 1):
+        frames.append(memoryview(_frame(bytes([bat_id, 0x03, 0x20]) + struct.pack(
+            '>16H', *(3300 + (bat_id * 7 + i * 3) % 40 for i in range(16))))))
+    return frames
+
+
+def bench_cells(iterations=5000):
+    from parser_cells import CellStack, NumpyCellStack, np
+
+    frames = _stack_cells_frames()
+    cell_min, cell_max = LIMITS[0], LIMITS[1]
+
+    stacks = [("pure Python rows", CellStack())]
+    if np is not None:
+        stacks.append(("NumPy uint16 array", NumpyCellStack()))
+    for _, stack in stacks:
+        for bat_id, frame in enumerate(frames, start=1):
+            stack.decode(bat_id, frame, cell_min, cell_max)
+    expected = stacks[0][1].stats(cell_min, cell_max)
+
+    print(f"Cells of {len(frames)} batteries x 16 cells")
+    for name, stack in stacks:
+        assert stack.stats(cell_min, cell_max) == expected
+        _report(f"{name}: decode + validate per battery",
+                timeit.timeit(lambda: [stack.decode(b, f, cell_min, cell_max) for b, f in enumerate(frames, start=1)],
+                              number=iterations), iterations)
+    times = [_report(f"{name}: stack statistics",
+                     timeit.timeit(lambda: stack.stats(cell_min, cell_max), number=iterations), iterations)
+             for name, stack in stacks]
+    if len(times) > 1:
+        print(f"  {'statistics speedup':<44} {times[0] / times[1]:9.1f} x")
+    else:
+        print("  (NumPy not installed, vectorised statistics skipped)")
+
+
+# === Robust filters: windowed median / Hampel per sample vs re-sorting the window ===
+def _noisy_samples(count=4096):
+    """Slowly drifting voltage with quantisation noise and an occasional bad frame."""
+    samples = []
+    for n in range(count):
+        value = 52.0 + (n % 400) / 1000 + ((n * 7919) % 5 - 2) / 100
+        if n % 97 == 0:
+            value += 25.0
+        samples.append(value)
+    return samples
+
+
+def bench_robust(windows=(10, 30, 60, 120), iterations=20000):
+    import statistics
+    from collections import deque
+    from main_filters import SlidingMedian, HampelFilter, MAD_SCALE, HAMPEL_THRESHOLD
+
+    samples = _noisy_samples()
+    mask = len(samples) - 1
+
+    def per_sample(make_filter):
+        flt = make_filter()
+        for v in samples:                       # fill the window first
+            flt(v)
+        pos = [0]
+
+        def step():
+            pos[0] = (pos[0] + 1) & mask
+            flt(samples[pos[0]])
+        return timeit.timeit(step, number=iterations) / iterations * 1e6
+
+    def naive_hampel(size):
+        window = deque(maxlen=size)
+
+        def flt(v):
+            result = v
+            if len(window) >= 3:
+                median = statistics.median(window)
+                mad = statistics.median([abs(x - median) for x in window])
+                if abs(v - median) > HAMPEL_THRESHOLD * MAD_SCALE * mad:
+                    result = median
+            window.append(v)
+            return result
+        return flt
+
+    def naive_median(size):
+        window = deque(maxlen=size)
+
+        def flt(v):
+            window.append(v)
+            return statistics.median(window)
+        return flt
+
+    print("Robust filters, per sample (window = samples kept per battery and signal)")
+    print(f"  {'window':<10} {'median':>10} {'re-sort':>10} {'hampel':>10} {'re-sort':>10}  µs/sample")
+    for size in windows:
+        median = per_sample(lambda: SlidingMedian(size).filter)
+        median_naive = per_sample(lambda: naive_median(size))
+        hampel = per_sample(lambda: HampelFilter(size).filter)
+        hampel_naive = per_sample(lambda: naive_hampel(size))
+        print(f"  {size:<10} {median:10.2f} {median_naive:10.2f} {hampel:10.2f} {hampel_naive:10.2f}")
+
+
+# === Per battery state: BatteryState store vs the former per-field dicts ===
+# Upper bound for the BatteryStore of 15 batteries (measured about 10 KB); bench_state fails above it
+STATE_MEMORY_LIMIT = 16 * 1024
+
+def _measure(build):
+    """Bytes allocated by build() and still held by its result."""
+    import tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return kept, size
+
+
+def bench_state(batteries=15, iterations=20000):
+    from main_state import BatteryStore
+
+    def values(bat_id):
+        cells = [3300 + (bat_id * 7 + i * 3) % 40 for i in range(16)]
+        temps = [24.5 + bat_id / 10 + i / 10 for i in range(4)]
+        return 53.0 + bat_id / 100, -2.5 - bat_id / 10, -132.5 - bat_id, 80.0 + bat_id / 10, 100 + bat_id, cells, temps
+
+    def build_dicts():
+        fields = {name: {} for name in ('voltage', 'current', 'power', 'soc', 'cycle', 'cells', 'temps', 'extra')}
+        for bat_id in range(1, batteries + 1):
+            voltage, current, power, soc, cycle, cells, temps = values(bat_id)
+            fields['voltage'][bat_id] = voltage
+            fields['current'][bat_id] = current
+            fields['power'][bat_id] = power
+            fields['soc'][bat_id] = soc
+            fields['cycle'][bat_id] = cycle
+            fields['cells'][bat_id] = list(cells)
+            fields['temps'][bat_id] = list(temps)
+            fields['extra'][bat_id] = (temps[0] + 1.0, temps[1] - 1.0)
+        return fields
+
+    def build_store():
+        store = BatteryStore(16, 4, batteries)
+        for state in store:
+            voltage, current, power, soc, cycle, cells, temps = values(state.bat_id)
+            state.voltage, state.current, state.power, state.soc, state.cycle = voltage, current, power, soc, cycle
+            state.cells = cells
+            state.temps = temps
+            state.extra = (temps[0] + 1.0, temps[1] - 1.0)
+        return store
+
+    fields, dict_bytes = _measure(build_dicts)
+    store, store_bytes = _measure(build_store)
+    print(f"Per battery state of {batteries} batteries (16 cells, 4 sensors, timestamps)")
+    print(f"  {'per-field dicts (main_arrays before)':<44} {dict_bytes:9d} bytes")
+    print(f"  {'BatteryStore (__slots__, array fields)':<44} {store_bytes:9d} bytes")
+    if store_bytes > STATE_MEMORY_LIMIT:
+        sys.exit(f"[ERROR] BatteryStore of {batteries} batteries takes {store_bytes} bytes, "
+                 f"limit {STATE_MEMORY_LIMIT}")
+
+    ids = list(range(1, batteries + 1))
+    soc, voltage, current, power = fields['soc'], fields['voltage'], fields['current'], fields['power']
+
+    def read_dicts():
+        for i in ids:
+            if i in soc and i in voltage:
+                soc[i], voltage[i], current.get(i), power.get(i)
+
+    def read_store():
+        get = store.get
+        for i in ids:
+            get(i).snapshot()
+
+    _report("aggregation read, per-field dicts", timeit.timeit(read_dicts, number=iterations), iterations)
+    _report("aggregation read, BatteryState.snapshot()", timeit.timeit(read_store, number=iterations), iterations)
+
+
+# === MQTT publish path: per-call topic/config/json building vs precomputed tables ===
+class _NullClient:
+    def __init__(self):
+        self.messages = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+
+
+def _legacy_publish_sensors(client, index, data, model):
+    """The pre-table publisher: topics, device info and both payloads rebuilt for every sensor."""
+    import json
+    from mqtt_core import (BATTERY_BASE_TOPIC_TEMPLATE, BATTERY_DEVICE_IDENTIFIERS_TEMPLATE,
+                           BATTERY_DEVICE_MODEL_TEMPLATE, BATTERY_UNIQUE_ID_TEMPLATE,
+                           BATTERY_OBJECT_ID_TEMPLATE, MANUFACTURER)
+    base = BATTERY_BASE_TOPIC_TEMPLATE.format(index=index)
+
+    def pub(suffix, name, dev_class, unit, value):
+        device_info = {
+            'identifiers': [id_.format(index=index) for id_ in BATTERY_DEVICE_IDENTIFIERS_TEMPLATE],
+            'name': BATTERY_DEVICE_MODEL_TEMPLATE.format(index=index),
+            'model': model,
+            'manufacturer': MANUFACTURER
+        }
+        cfg = {
+            'name': name,
+            'state_topic': f"{base}/{suffix}",
+            'unique_id': BATTERY_UNIQUE_ID_TEMPLATE.format(index=index, suffix=suffix),
+            'object_id': BATTERY_OBJECT_ID_TEMPLATE.format(index=index, suffix=suffix),
+            'device_class': dev_class,
+            'unit_of_measurement': unit,
+            'value_template': '{{ value_json.state }}',
+            'device': device_info
+        }
+        client.publish(f"{base}/{suffix}/config", json.dumps(cfg), retain=True)
+        client.publish(f"{base}/{suffix}", json.dumps({'state': value}), retain=True)
+
+    pub('voltage', 'Voltage', 'voltage', 'V', data['voltage'])
+    pub('soc', 'SOC', 'battery', '%', data['soc'])
+    pub('current', 'Current', 'current', 'A', data['current'])
+    pub('power', 'Power', 'power', 'W', data['power'])
+    pub('cycle', 'Cycle', None, None, data['cycle'])
+    for i, v in enumerate(data['cells'], 1):
+        pub(f"cell_{i}", f"Cell {i}", 'voltage', 'mV', v)
+    for i, t in enumerate(data['temps'], 1):
+        pub(f"temp_{i}", f"Temp {i}", 'temperature', '°C', t)
+    pub('temp_mos', 'T MOS', 'temperature', '°C', data['mos'])
+    pub('temp_env', 'T ENV', 'temperature', '°C', data['env'])
+
+
+def bench_publish(batteries=15, cycles=200):
+    import mqtt_core
+    import mqtt_deadband
+    from mqtt_core import publish_sensors, publish_summary_sensors
+
+    def battery_data(bat_id, cycle):
+        # Cells wander by a few mV and temperatures by a tenth, as at rest
+        cells = [3300 + (bat_id * 7 + i * 3 + cycle % 3) % 40 for i in range(16)]
+        temps = [round(24.5 + bat_id / 10 + (cycle % 2) / 10, 1) for _ in range(4)]
+        return {'voltage': round(53.0 + bat_id / 100, 2), 'current': -2.5, 'power': -132.5,
+                'soc': 80.0, 'cycle': 100 + bat_id, 'cells': cells, 'temps': temps,
+                'mos': 26.0, 'env': 24.5}
+
+    samples = [[battery_data(i, c) for i in range(1, batteries + 1)] for c in range(cycles)]
+
+    def run_tables(client):
+        for cycle in samples:
+            for index, data in enumerate(cycle, 1):
+                publish_sensors(client, index, data, data['mos'], data['env'], 'BAT-5KWH-51.2V')
+            publish_summary_sensors(client, 80.0, 53.07, -37.5, -1987.5, 26.0, 24.5)
+
+    def run_legacy(client):
+        for cycle in samples:
+            for index, data in enumerate(cycle, 1):
+                _legacy_publish_sensors(client, index, data, 'BAT-5KWH-51.2V')
+
+    print(f"MQTT publish path, {batteries} batteries, CPU per polling cycle")
+    client = _NullClient()
+    seconds = timeit.timeit(lambda: run_legacy(client), number=1)
+    print(f"  {'rebuilt topics/configs, json.dumps (before)':<44} {seconds / cycles * 1000:9.2f} ms/cycle"
+          f"  {client.messages // cycles} messages")
+
+    for label, config in (("tables, every state published", {'publish_on_change': False}),
+                          ("tables, publish on change", {}),
+                          ("tables, JSON state document", {'state_json': True})):
+        mqtt_deadband.configure(config)
+        mqtt_core.configure_state_documents(config)
+        client = _NullClient()
+        run_tables(client)      # first cycle announces the discovery configs
+        client.messages = 0
+        seconds = timeit.timeit(lambda: run_tables(client), number=1)
+        print(f"  {label:<44} {seconds / cycles * 1000:9.2f} ms/cycle  {client.messages // cycles} messages")
+    mqtt_core.configure_state_documents({})
+
+
+BENCHMARKS = {
+    'crc': bench_crc,
+    'decode': bench_decode,
+    'cells': bench_cells,
+    'robust': bench_robust,
+    'state': bench_state,
+    'publish': bench_publish,
+}
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark '{name}', choose from: {', '.join(BENCHMARKS)}")
+        BENCHMARKS[name]()
+        print("-" * 112)
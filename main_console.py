@@ -210,3 +210,7 @@ def print_presets_table(presets_dict, total_width=106):
         total_width,
         fixed_col_widths=[col1_width, col2_width, col3_width]
     )
+
+
+def print_read_plan_table(rows, total_width=106):
+    print_table(["Battery read plan", "Value"], rows, total_width)
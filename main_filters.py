@@ -0,0 +1,307 @@
+# main_filters.py
+
+from bisect import bisect_left, insort
+from collections import deque
+
+from main_arrays import history_len as DEFAULT_HISTORY_LEN
+
+# Signals with spike filter history, and the config option overriding each one's length
+HISTORY_OPTIONS = {
+    'soc': 'history_len_soc',
+    'voltage': 'history_len_voltage',
+    'mos': 'history_len_temperature',
+    'env': 'history_len_temperature',
+}
+
+# === Robust filters (config spike_filter) ===
+# mean:   filter_spikes / filter_temperature_spikes against the ring histories (default)
+# median: publish the median of the last spike_filter_window samples
+# hampel: replace a sample with the window median when it is further than
+#         hampel_threshold scaled MADs away from it, pass it through otherwise
+SPIKE_FILTER_MODES = ('mean', 'median', 'hampel')
+DEFAULT_ROBUST_WINDOW = 15
+HAMPEL_THRESHOLD = 3.0
+
+# MAD to standard deviation for normally distributed noise
+MAD_SCALE = 1.4826
+
+# Smallest deviation the Hampel filter treats as an outlier, per signal. Readings
+# are quantised (0.1 % SOC, 0.01 V, 1 mV, 0.1 °C), so a window of identical
+# values has MAD 0 and would otherwise reject the next real step.
+HAMPEL_MIN_DEVIATION = {
+    'soc': 1.0,
+    'voltage': 0.1,
+    'current': 1.0,
+    'cells': 10,
+    'temps': 1.0,
+    'mos': 1.0,
+    'env': 1.0,
+}
+
+_state = None
+
+
+class RingHistory:
+    """
+    Last size values of one signal in a fixed ring, with a running sum.
+
+    append() and mean() are O(1); the sum is recomputed from the ring once per
+    wrap-around so float error cannot pile up over months of uptime. Supports
+    len(), truth testing, iteration (oldest first) and indexing like the
+    plain lists it replaces, so filter functions accept either.
+    """
+    __slots__ = ('_values', '_size', '_pos', '_count', '_total')
+
+    def __init__(self, size: int):
+        self._size = max(1, int(size))
+        self._values = [0.0] * self._size
+        self._pos = 0           # slot the next value goes to
+        self._count = 0
+        self._total = 0.0
+
+    def append(self, value):
+        if self._count == self._size:
+            self._total -= self._values[self._pos]
+        else:
+            self._count += 1
+        self._values[self._pos] = value
+        self._total += value
+        self._pos += 1
+        if self._pos == self._size:
+            self._pos = 0
+            if self._count == self._size:
+                self._total = sum(self._values)
+
+    def mean(self):
+        """Average of the stored values, or None while empty."""
+        return self._total / self._count if self._count else None
+
+    def last(self):
+        """Newest value, or None while empty."""
+        return self._values[self._pos - 1] if self._count else None
+
+    def clear(self):
+        self._pos = 0
+        self._count = 0
+        self._total = 0.0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        start = self._pos - self._count
+        for k in range(start, self._pos):
+            yield self._values[k]       # negative indexes wrap to the end of the ring
+
+    def __getitem__(self, index):
+        if not -self._count <= index < self._count:
+            raise IndexError("history index out of range")
+        if index < 0:
+            index += self._count
+        return self._values[(self._pos - self._count + index) % self._size]
+
+
+class SortedWindow:
+    """
+    Last size samples in arrival order (deque) and in sorted order (list).
+
+    The sorted copy is kept with bisect: finding the slot of the sample that
+    leaves and of the one that arrives is O(log n), and the shift of the list
+    is a memmove that stays far below the cost of a Python level loop for
+    windows of a few hundred samples. median() is O(1) and mad() is
+    O(log n): the absolute deviations from the median are two sorted runs
+    (left and right of the median), and their k-th smallest is found by a
+    binary search over both runs instead of sorting the deviations.
+    """
+    __slots__ = ('size', '_order', '_sorted')
+
+    def __init__(self, size: int):
+        self.size = max(1, int(size))
+        self._order = deque()
+        self._sorted = []
+
+    def append(self, value):
+        if len(self._order) == self.size:
+            old = self._order.popleft()
+            del self._sorted[bisect_left(self._sorted, old)]
+        self._order.append(value)
+        insort(self._sorted, value)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def median(self):
+        s = self._sorted
+        n = len(s)
+        if not n:
+            return None
+        mid = n // 2
+        return s[mid] if n % 2 else (s[mid - 1] + s[mid]) / 2
+
+    def _kth_deviation(self, median, split, k):
+        """k-th smallest (0-based) |x - median|; s[:split] are below the median, s[split:] are not."""
+        s = self._sorted
+        right = len(s) - split
+        # Take i deviations from the left run (m - s[split-1], m - s[split-2], ...)
+        # and k + 1 - i from the right run (s[split] - m, s[split+1] - m, ...)
+        lo, hi = max(0, k + 1 - right), min(k + 1, split)
+        while lo < hi:
+            i = (lo + hi) // 2
+            j = k + 1 - i
+            if median - s[split - 1 - i] < s[split + j - 1] - median:
+                lo = i + 1      # the next left deviation is smaller than the last right one taken
+            else:
+                hi = i
+        j = k + 1 - lo
+        left = median - s[split - lo] if lo else None
+        right_dev = s[split + j - 1] - median if j else None
+        if left is None:
+            return right_dev
+        if right_dev is None:
+            return left
+        return max(left, right_dev)
+
+    def mad(self, median=None):
+        """Median absolute deviation from the median (of the window unless given)."""
+        n = len(self._sorted)
+        if not n:
+            return None
+        if median is None:
+            median = self.median()
+        split = bisect_left(self._sorted, median)
+        mid = n // 2
+        if n % 2:
+            return self._kth_deviation(median, split, mid)
+        return (self._kth_deviation(median, split, mid - 1) + self._kth_deviation(median, split, mid)) / 2
+
+
+class SlidingMedian:
+    """Median of the last size samples, the new one included."""
+    __slots__ = ('window',)
+
+    def __init__(self, size: int = DEFAULT_ROBUST_WINDOW):
+        self.window = SortedWindow(size)
+
+    def filter(self, value):
+        if value is None:
+            return None
+        self.window.append(value)
+        return self.window.median()
+
+
+class HampelFilter:
+    """
+    Online Hampel outlier detector over the last size samples.
+
+    A sample further than threshold * MAD_SCALE * MAD (at least min_deviation)
+    from the window median is replaced by the median and counted. The raw
+    sample still enters the window, so a genuine step passes once it holds
+    for half a window.
+    """
+    __slots__ = ('window', 'threshold', 'min_deviation', 'outliers')
+
+    def __init__(self, size: int = DEFAULT_ROBUST_WINDOW, threshold: float = HAMPEL_THRESHOLD,
+                 min_deviation: float = 0.0):
+        self.window = SortedWindow(size)
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+        self.outliers = 0
+
+    def filter(self, value):
+        if value is None:
+            return None
+        window = self.window
+        result = value
+        if len(window) >= 3:
+            median = window.median()
+            limit = max(self.threshold * MAD_SCALE * window.mad(median), self.min_deviation)
+            if abs(value - median) > limit:
+                result = median
+                self.outliers += 1
+        window.append(value)
+        return result
+
+
+class FilterState:
+    """
+    Spike filter histories, one ring per battery and signal.
+
+    Each battery is judged against its own past only (a stack of batteries at
+    different SOC no longer trips each other's filter). Ring sizes come from
+    history_lens per signal, DEFAULT_HISTORY_LEN otherwise.
+
+    With mode 'median' or 'hampel' robust() hands out one SlidingMedian or
+    HampelFilter per battery, signal and position (cell or sensor number).
+    """
+    def __init__(self, history_lens: dict = None, mode: str = 'mean',
+                 window: int = DEFAULT_ROBUST_WINDOW, threshold: float = HAMPEL_THRESHOLD):
+        self.history_lens = dict(history_lens or {})
+        self.mode = mode if mode in SPIKE_FILTER_MODES else 'mean'
+        self.window = window
+        self.threshold = threshold
+        self._rings = {}
+        self._robust = {}
+
+    @property
+    def robust_enabled(self) -> bool:
+        return self.mode != 'mean'
+
+    def robust(self, signal: str, bat_id: int, pos: int = 0):
+        """The robust filter of one value, or None in 'mean' mode."""
+        if self.mode == 'mean':
+            return None
+        key = (signal, bat_id, pos)
+        flt = self._robust.get(key)
+        if flt is None:
+            if self.mode == 'median':
+                flt = SlidingMedian(self.window)
+            else:
+                flt = HampelFilter(self.window, self.threshold, HAMPEL_MIN_DEVIATION.get(signal, 0.0))
+            self._robust[key] = flt
+        return flt
+
+    def apply(self, signal: str, bat_id: int, value, pos: int = 0):
+        """value through its robust filter; unchanged in 'mean' mode."""
+        flt = self.robust(signal, bat_id, pos)
+        return value if flt is None else flt.filter(value)
+
+    def outliers(self) -> int:
+        """Samples replaced by the Hampel filters so far."""
+        return sum(getattr(flt, 'outliers', 0) for flt in self._robust.values())
+
+    def history(self, signal: str, bat_id: int) -> RingHistory:
+        ring = self._rings.get((signal, bat_id))
+        if ring is None:
+            ring = self._rings[(signal, bat_id)] = RingHistory(
+                self.history_lens.get(signal, DEFAULT_HISTORY_LEN))
+        return ring
+
+
+def get_history_lens(config: dict) -> dict:
+    """Ring size per signal from config: history_len for all, history_len_<signal> per signal."""
+    default = config.get('history_len', DEFAULT_HISTORY_LEN)
+    return {signal: config.get(option, default) for signal, option in HISTORY_OPTIONS.items()}
+
+
+def configure(config: dict) -> FilterState:
+    """Create the shared filter state from config (history lengths and robust filter mode)."""
+    global _state
+    mode = config.get('spike_filter', 'mean')
+    if mode not in SPIKE_FILTER_MODES:
+        print(f"[WARN] Unknown spike_filter '{mode}', using 'mean'")
+    _state = FilterState(
+        get_history_lens(config), mode,
+        config.get('spike_filter_window', DEFAULT_ROBUST_WINDOW),
+        config.get('hampel_threshold', HAMPEL_THRESHOLD),
+    )
+    if _state.robust_enabled:
+        print(f"[INFO] Spike filter: {_state.mode}, window {_state.window} samples")
+    return _state
+
+
+def filter_state() -> FilterState:
+    """The filter state configured at startup; defaults ('mean', history_len) otherwise."""
+    global _state
+    if _state is None:
+        _state = FilterState()
+    return _state
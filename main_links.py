@@ -0,0 +1,161 @@
+# main_links.py
+
+import time
+import random
+import threading
+
+# MQTT reconnect backoff (seconds); paho's network thread waits, never the poller
+MQTT_BACKOFF_INITIAL = 1.0
+MQTT_BACKOFF_MAX = 120.0
+
+# Share of each backoff delay that is randomised, so the addon and other
+# clients do not all hit a restarted broker or Enet-485 in the same instant
+BACKOFF_JITTER = 0.5
+
+# Topics to subscribe again after every (re)connect, with their callbacks
+_subscriptions = {}
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter.
+
+    next() returns a delay drawn from [d * (1 - jitter), d], where d starts at
+    initial and doubles per call up to maximum; reset() after a successful
+    connect starts over.
+    """
+    def __init__(self, initial: float = 0.5, maximum: float = 60.0, jitter: float = BACKOFF_JITTER):
+        self.initial = initial
+        self.maximum = max(initial, maximum)
+        self.jitter = jitter
+        self._delay = initial
+
+    def next(self) -> float:
+        delay = self._delay
+        self._delay = min(self._delay * 2, self.maximum)
+        return delay * (1.0 - self.jitter * random.random())
+
+    def reset(self):
+        self._delay = self.initial
+
+
+class LinkState:
+    """
+    Up/down state of one link (gateway or MQTT) with uptime and counters.
+
+    mark_up()/mark_down() are called by whoever sees the link change; the
+    first mark_up() is a connect, every later one a reconnect.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.up = False
+        self.since = time.monotonic()
+        self.connects = 0
+        self.disconnects = 0
+        self.last_reason = None
+        self.total_up = 0.0
+        self._lock = threading.Lock()
+
+    def mark_up(self):
+        with self._lock:
+            if self.up:
+                return
+            self.up = True
+            self.since = time.monotonic()
+            self.connects += 1
+
+    def mark_down(self, reason=None):
+        with self._lock:
+            if not self.up:
+                return
+            now = time.monotonic()
+            self.total_up += now - self.since
+            self.up = False
+            self.since = now
+            self.disconnects += 1
+            self.last_reason = reason
+
+    @property
+    def reconnects(self) -> int:
+        return max(0, self.connects - 1)
+
+    def uptime(self) -> float:
+        """Seconds of the current connection, 0 while down."""
+        return time.monotonic() - self.since if self.up else 0.0
+
+    def downtime(self) -> float:
+        """Seconds since the link went down, 0 while up."""
+        return 0.0 if self.up else time.monotonic() - self.since
+
+    def stats(self) -> dict:
+        return {
+            'up': self.up,
+            'uptime': self.uptime(),
+            'downtime': self.downtime(),
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'disconnects': self.disconnects,
+        }
+
+    def summary(self) -> str:
+        if self.up:
+            state = f"up {self.uptime():.0f}s"
+        else:
+            state = f"DOWN {self.downtime():.0f}s ({self.last_reason or 'not connected yet'})"
+        return f"{self.name} {state}, reconnects {self.reconnects}"
+
+
+# === MQTT ===
+def subscribe(client, topic: str, callback):
+    """Subscribe topic with callback now and again after every MQTT reconnect."""
+    _subscriptions[topic] = callback
+    client.message_callback_add(topic, callback)
+    client.subscribe(topic)
+
+
+class MqttSupervisor:
+    """
+    Tracks the paho client's connection and reconnects it without blocking.
+
+    Replaces the on_disconnect callback that called reconnect() inline in
+    paho's network thread. With loop_start() paho's own thread reconnects;
+    on every disconnect the supervisor hands it a freshly jittered minimum
+    delay, from which paho doubles up to MQTT_BACKOFF_MAX. The asyncio engine
+    has no such thread and calls next_retry_delay() from its own task.
+    Subscriptions made through subscribe() are renewed on every connect,
+    since the broker forgets them with the clean session.
+    """
+    def __init__(self, client, initial: float = MQTT_BACKOFF_INITIAL, maximum: float = MQTT_BACKOFF_MAX):
+        self.client = client
+        self.state = LinkState("MQTT")
+        self.backoff = Backoff(initial, maximum)
+        self.maximum = maximum
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        self._apply_delay()
+
+    def _apply_delay(self):
+        min_delay = max(1, round(self.backoff.next()))
+        self.client.reconnect_delay_set(min_delay=min_delay, max_delay=int(self.maximum))
+
+    def next_retry_delay(self) -> float:
+        return self.backoff.next()
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc != 0:
+            print(f"[WARN] MQTT connection refused (rc {rc})")
+            return
+        reconnect = self.state.connects > 0
+        self.state.mark_up()
+        self.backoff.reset()
+        for topic in _subscriptions:
+            client.subscribe(topic)
+        if reconnect:
+            print(f"[INFO] MQTT reconnected, {len(_subscriptions)} subscriptions renewed "
+                  f"(reconnects: {self.state.reconnects})")
+
+    def _on_disconnect(self, client, userdata, rc, *args):
+        self.state.mark_down(f"rc {rc}")
+        if rc != 0:
+            self._apply_delay()
+            print("[WARN] MQTT connection lost, paho reconnects in the background")
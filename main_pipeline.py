@@ -0,0 +1,210 @@
+# main_pipeline.py
+
+import time
+import queue
+import threading
+
+# Seconds the decode stage waits for room in the publish queue before dropping a message
+PUBLISH_PUT_TIMEOUT = 1.0
+
+# Frame sets of this many cycles wait for the decode stage before the bus stage hands
+# over a battery as deferred (cached values) instead; cycle markers are never dropped
+DECODE_QUEUE_CYCLES = 3
+
+# Publish queue size (MQTT messages; one battery publishes about 60)
+PUBLISH_QUEUE_SIZE = 2000
+
+_STOP = object()
+
+
+class Stage:
+    """
+    One pipeline stage: a worker thread draining a bounded queue through handler(item).
+
+    put() never blocks unless asked to; a full queue drops the item and counts
+    it. Wait (enqueue to start) and service (handler) times, queue depth and
+    errors are kept per stage, so the slow stage shows up in the console.
+    """
+    def __init__(self, name: str, handler, maxsize: int = 0):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name=f"pipeline-{name}", daemon=True)
+
+        # Counters
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, item, block=False, timeout=None) -> bool:
+        """Queue item; False (and counted as dropped) if the queue is full. maxsize 0 never fills."""
+        try:
+            self.queue.put((time.monotonic(), item), block, timeout)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            queued, item = self.queue.get()
+            if item is _STOP:
+                return
+            started = time.monotonic()
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.errors += 1
+                print(f"[ERROR] Pipeline stage '{self.name}' failed: {e}")
+            done = time.monotonic()
+            wait, service = started - queued, done - started
+            self.processed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_service += service
+            self.max_service = max(self.max_service, service)
+
+    def stop(self, timeout: float = 5.0):
+        """Let the worker finish what is queued (up to timeout), then end it."""
+        try:
+            self.queue.put((time.monotonic(), _STOP), timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        done = self.processed or 1
+        return {
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'avg_wait': self.total_wait / done,
+            'max_wait': self.max_wait,
+            'avg_service': self.total_service / done,
+            'max_service': self.max_service,
+        }
+
+
+class QueuedClient:
+    """
+    Stand-in for the paho client handed to the decode stage: publish() only
+    queues the message for the publish stage, with up to PUBLISH_PUT_TIMEOUT
+    of backpressure before it is dropped.
+    """
+    def __init__(self, stage: Stage):
+        self._stage = stage
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._stage.put((topic, payload, qos, retain), block=True, timeout=PUBLISH_PUT_TIMEOUT)
+
+
+class BatteryPipeline:
+    """
+    Blocking engine split into bus -> decode -> publish.
+
+    The bus stage is the polling thread itself and only moves frames: it
+    reads a battery, copies the frames and hands them over without waiting.
+    The decode stage parses, validates, caches, spike-filters and aggregates
+    (process_battery_frames plus EssAggregator) and publishes through a
+    QueuedClient; it also publishes the ESS summary and link sensors, so the
+    ESS state document is only touched from this thread. The publish stage is the only one calling the real MQTT
+    client. A stalled broker fills the publish queue, then the decode queue,
+    and then costs dropped frame sets, never bus time.
+
+    The decode queue itself is unbounded and never blocks the bus stage:
+    cycle markers (start, finish, links) and deferred batteries always get
+    through, so every cycle is aggregated and published once. Only frame
+    sets are limited (DECODE_QUEUE_CYCLES cycles waiting); a battery over
+    the limit is handed over as deferred, so the ESS summary uses its
+    cached values instead of leaving it out.
+    """
+    def __init__(self, client, process_frames, aggregator, publish_summary_sensors, publish_link_sensors,
+                 num_batteries: int):
+        self.client = client
+        self.process_frames = process_frames
+        self.aggregator = aggregator
+        self.publish_summary_sensors = publish_summary_sensors
+        self.publish_link_sensors = publish_link_sensors
+
+        self.publish = Stage("publish", self._publish, PUBLISH_QUEUE_SIZE)
+        self.decode = Stage("decode", self._decode)
+        self._frame_slots = threading.BoundedSemaphore(DECODE_QUEUE_CYCLES * num_batteries)
+        self.queued_client = QueuedClient(self.publish)
+
+    def start(self):
+        self.publish.start()
+        self.decode.start()
+
+    def stop(self):
+        self.decode.stop()
+        self.publish.stop()
+
+    # --- Bus stage (polling thread) ---
+    def start_cycle(self):
+        self.decode.put(('start',))
+
+    def add_frames(self, index, frames):
+        """
+        Hand over the frames of one battery; copied, since planned reads reuse their buffers.
+        With DECODE_QUEUE_CYCLES of frame sets still waiting, the battery goes over as deferred.
+        """
+        if not self._frame_slots.acquire(blocking=False):
+            self.decode.dropped += 1
+            self.decode.put(('deferred', index))
+            return
+        frames = tuple(None if f is None else bytes(f) for f in frames)
+        self.decode.put(('battery', index, frames))
+
+    def add_deferred(self, index):
+        self.decode.put(('deferred', index))
+
+    def finish_cycle(self, links=()):
+        """End the cycle: the ESS summary (with the link sensors of links) is published by the decode stage."""
+        self.decode.put(('finish', links))
+
+    def publish_links(self, links):
+        """Link sensors of a cycle without a summary, published by the decode stage like the summary."""
+        self.decode.put(('links', links))
+
+    # --- Decode stage ---
+    def _decode(self, item):
+        kind = item[0]
+        if kind == 'battery':
+            _, index, frames = item
+            self._frame_slots.release()
+            mos_t, env_t = self.process_frames(self.queued_client, index, *frames) or (None, None)
+            self.aggregator.add_battery(index, mos_t, env_t)
+        elif kind == 'deferred':
+            self.aggregator.add_deferred(item[1])
+        elif kind == 'start':
+            self.aggregator.start_cycle()
+        elif kind == 'finish':
+            self.publish_summary_sensors(self.queued_client, *self.aggregator.finish_cycle(), links=item[1])
+        elif kind == 'links':
+            self.publish_link_sensors(self.queued_client, item[1])
+
+    # --- Publish stage ---
+    def _publish(self, item):
+        topic, payload, qos, retain = item
+        self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def summary(self) -> str:
+        parts = []
+        for stage in (self.decode, self.publish):
+            s = stage.stats()
+            parts.append(f"{stage.name} queue {s['depth']} (max {s['max_depth']}), "
+                         f"wait avg {s['avg_wait'] * 1000:.1f}ms max {s['max_wait'] * 1000:.1f}ms, "
+                         f"service avg {s['avg_service'] * 1000:.2f}ms max {s['max_service'] * 1000:.1f}ms, "
+                         f"dropped {s['dropped']}, errors {s['errors']}")
+        return "Pipeline: " + "; ".join(parts)
@@ -0,0 +1,176 @@
+# main_scheduler.py
+
+import time
+
+# Share of the period a cycle may spend on the bus before remaining work is deferred
+CYCLE_BUDGET = 0.9
+
+# Weight of the newest sample in the per-battery duration estimate
+UNIT_EWMA_ALPHA = 0.3
+
+# Config options setting the poll interval (seconds) of a query, over its REGISTER_SCHEMA lane
+LANE_OPTIONS = {
+    'get_block_voltage': 'poll_interval_block',
+    'get_cells_voltage': 'poll_interval_cells',
+    'get_temperature': 'poll_interval_temperature',
+    'get_extra_temperature': 'poll_interval_temperature',
+}
+
+
+class CycleScheduler:
+    """
+    Fire polling cycles on fixed wall-clock ticks (multiples of period since the epoch).
+
+    The period does not grow with battery count or link quality: a cycle that
+    runs past its tick skips the missed ticks instead of starting late, and
+    batteries that would not fit in the remaining budget are deferred to the
+    next cycle, which starts with them. Durations, budget use and overruns are
+    kept for the console and for tuning read_timeout.
+    """
+    def __init__(self, period: float, budget: float = CYCLE_BUDGET):
+        self.period = max(float(period), 0.1)
+        self.budget = self.period * budget
+        self._next_tick = None
+        self._cycle_started = None
+        self._resume = None
+
+        # Index of the current tick since the epoch, stable across restarts
+        self.tick = 0
+
+        # Per battery (unit) duration estimate, to decide whether one more fits
+        self.unit_estimate = None
+
+        # Counters
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.deferred_units = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def next_delay(self) -> float:
+        """Seconds until the next tick; ticks already missed are skipped and counted."""
+        now = time.time()
+        if self._next_tick is None:
+            self._next_tick = (now // self.period + 1) * self.period
+        elif now >= self._next_tick:
+            missed = int((now - self._next_tick) // self.period) + 1
+            self.skipped_ticks += missed
+            self._next_tick += missed * self.period
+        # Never wait longer than one period, e.g. after the wall clock was set back
+        return min(self._next_tick - now, self.period)
+
+    def wait(self):
+        """Block until the next tick (blocking engine; main_async awaits next_delay() instead)."""
+        delay = self.next_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def begin_cycle(self):
+        self._cycle_started = time.monotonic()
+        self.tick = round(self._next_tick / self.period)
+        self._next_tick += self.period
+
+    def remaining(self) -> float:
+        """Seconds of budget left in the current cycle."""
+        return self.budget - (time.monotonic() - self._cycle_started)
+
+    def order(self, units: list) -> list:
+        """Units in polling order for this cycle, starting with the first one deferred last time."""
+        if self._resume in units:
+            pos = units.index(self._resume)
+            return units[pos:] + units[:pos]
+        return list(units)
+
+    def fits(self) -> bool:
+        """True if one more unit is expected to finish within the budget."""
+        return self.unit_estimate is None or self.remaining() >= self.unit_estimate
+
+    def unit_done(self, seconds: float):
+        if self.unit_estimate is None:
+            self.unit_estimate = seconds
+        else:
+            self.unit_estimate += UNIT_EWMA_ALPHA * (seconds - self.unit_estimate)
+
+    def defer(self, units: list):
+        """Record units left out of this cycle; the next cycle starts with the first of them."""
+        self.deferred_units += len(units)
+        self._resume = units[0] if units else None
+
+    def end_cycle(self):
+        duration = time.monotonic() - self._cycle_started
+        self.cycles += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        if duration > self.period:
+            self.overruns += 1
+            print(f"[WARN] Polling cycle took {duration:.2f}s, longer than the {self.period:g}s period")
+
+    def stats(self) -> dict:
+        return {
+            'period': self.period,
+            'cycles': self.cycles,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'avg_duration': self.total_duration / self.cycles if self.cycles else 0.0,
+            'utilisation': self.last_duration / self.period,
+            'overruns': self.overruns,
+            'skipped_ticks': self.skipped_ticks,
+            'deferred_units': self.deferred_units,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (f"Polling cycle: {s['last_duration']:.2f}s of {s['period']:g}s ({s['utilisation']:.0%} of period), "
+                f"avg {s['avg_duration']:.2f}s, max {s['max_duration']:.2f}s, overruns {s['overruns']}, "
+                f"skipped ticks {s['skipped_ticks']}, deferred batteries {s['deferred_units']}")
+
+
+class LaneSchedule:
+    """
+    Multi-rate polling lanes: decide which queries of a battery are due in a cycle.
+
+    Each query with an interval longer than the period is read every n-th tick.
+    Batteries (and lanes) get different phase offsets, so slow reads of an
+    8-battery stack are spread over the cycles instead of all landing on the
+    same one. A battery deferred by the CycleScheduler catches up on its next poll.
+    """
+    def __init__(self, intervals: dict, period: float, battery_ids: list):
+        self.every = {
+            key: max(1, round(seconds / period))
+            for key, seconds in intervals.items() if seconds and seconds > period
+        }
+        # Queries sharing an interval form one lane and stay in phase, so the planner can keep them merged
+        lanes = sorted(set(self.every.values()))
+        self._phase = {}
+        for pos, bat_id in enumerate(battery_ids):
+            for key, every in self.every.items():
+                self._phase[(bat_id, key)] = (pos * every // len(battery_ids) + lanes.index(every)) % every
+        self._next_due = {}
+
+    def due(self, bat_id: int, keys, tick: int) -> set:
+        """Queries of bat_id to read in cycle tick; queries without an interval are always due."""
+        return {key for key in keys
+                if key not in self.every or tick >= self._next_due.get((bat_id, key), 0)}
+
+    def polled(self, bat_id: int, keys, tick: int):
+        """Schedule the next slot of each query read in cycle tick."""
+        for key in keys:
+            every = self.every.get(key)
+            if every:
+                self._next_due[(bat_id, key)] = tick + every - (tick + self._phase[(bat_id, key)]) % every
+
+    def describe(self, period: float) -> str:
+        return ", ".join(f"{key} every {every * period:g}s" for key, every in self.every.items())
+
+
+def get_query_intervals(config: dict, intervals: dict) -> dict:
+    """Poll interval per query: its lane, unless a poll_interval_* option sets one (all 0 by default)."""
+    result = dict(intervals or {})
+    for key, option in LANE_OPTIONS.items():
+        seconds = config.get(option)
+        if seconds is not None and key in result:
+            result[key] = seconds
+    return result
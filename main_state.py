@@ -0,0 +1,153 @@
+# main_state.py
+
+import time
+from array import array
+
+from modbus_schema import active_schema
+
+# Slave ids on the Ritar bus are 1..15; one state per id is allocated up front
+MAX_BATTERIES = 15
+
+# Cell value stored for "no valid reading" (cells are unsigned mV)
+NO_CELL = 0
+
+# Scalar fields stamped by BatteryState.updated
+CORE_FIELDS = ('voltage', 'current', 'power', 'soc', 'cycle')
+
+_store = None
+
+
+class BatteryState:
+    """
+    Last valid values of one battery.
+
+    Scalars are plain slots (None until the first valid reading), cells and
+    temperatures live in fixed arrays sized for the battery model, and every
+    group carries the wall-clock time of its last update. parser_battery is
+    the only writer (core values, cells, spike-filtered temperatures);
+    everything else reads.
+    """
+    __slots__ = (
+        'bat_id', 'voltage', 'current', 'power', 'soc', 'cycle', 'temp_mos', 'temp_env',
+        '_cells', '_temps', '_temps_count', 'updated', 'cells_updated', 'temps_updated', 'extra_updated',
+    )
+
+    def __init__(self, bat_id: int, cells: int = 16, temperatures: int = 4):
+        self.bat_id = bat_id
+        self.voltage = None
+        self.current = None
+        self.power = None
+        self.soc = None
+        self.cycle = None
+        self.temp_mos = None
+        self.temp_env = None
+        self._cells = array('H', [NO_CELL] * cells)
+        self._temps = array('d', [float('nan')] * temperatures)
+        self._temps_count = 0
+        self.updated = 0.0
+        self.cells_updated = 0.0
+        self.temps_updated = 0.0
+        self.extra_updated = 0.0
+
+    # --- Cells (mV), None for cells without a valid reading ---
+    @property
+    def cells(self):
+        if not self.cells_updated:
+            return None
+        return [None if v == NO_CELL else v for v in self._cells]
+
+    @cells.setter
+    def cells(self, values):
+        if values is None:
+            return
+        cells = self._cells
+        for pos in range(len(cells)):
+            v = values[pos] if pos < len(values) else None
+            cells[pos] = NO_CELL if v is None else v
+        self.cells_updated = time.time()
+
+    # --- Temperature sensors (°C), None for sensors without a valid reading ---
+    @property
+    def temps(self):
+        if not self.temps_updated:
+            return None
+        return [None if t != t else t for t in self._temps[:self._temps_count]]     # NaN marks a missing value
+
+    @temps.setter
+    def temps(self, values):
+        if values is None:
+            return
+        temps = self._temps
+        self._temps_count = min(len(values), len(temps))
+        for pos in range(self._temps_count):
+            t = values[pos]
+            temps[pos] = float('nan') if t is None else t
+        self.temps_updated = time.time()
+
+    # --- MOS / ENV temperatures as one pair ---
+    @property
+    def extra(self):
+        return self.temp_mos, self.temp_env
+
+    @extra.setter
+    def extra(self, values):
+        self.temp_mos, self.temp_env = values
+        self.extra_updated = time.time()
+
+    def snapshot(self) -> tuple:
+        """(soc, voltage, current, power) as read together, for the ESS aggregation."""
+        return self.soc, self.voltage, self.current, self.power
+
+
+class BatteryStore:
+    """BatteryState for every possible battery id, allocated once and indexed by id."""
+    def __init__(self, cells: int = 16, temperatures: int = 4, max_batteries: int = MAX_BATTERIES):
+        self._states = [None] + [BatteryState(i, cells, temperatures) for i in range(1, max_batteries + 1)]
+
+    def get(self, bat_id: int) -> BatteryState:
+        return self._states[bat_id]
+
+    def __iter__(self):
+        return iter(self._states[1:])
+
+
+class StateView:
+    """
+    Dict-style view of one BatteryState field across all batteries.
+
+    main_arrays exposes the former last_valid_* dicts as these views, so
+    modules (and United BMS overrides) written against the dicts read and
+    write the store. A battery whose field is None counts as missing.
+    """
+    def __init__(self, field: str):
+        self.field = field
+
+    def __contains__(self, bat_id):
+        return self.get(bat_id) is not None
+
+    def __getitem__(self, bat_id):
+        value = self.get(bat_id)
+        if value is None:
+            raise KeyError(bat_id)
+        return value
+
+    def __setitem__(self, bat_id, value):
+        state = battery_store().get(bat_id)
+        setattr(state, self.field, value)
+        if self.field in CORE_FIELDS:
+            state.updated = time.time()
+
+    def get(self, bat_id, default=None):
+        if not isinstance(bat_id, int) or not 1 <= bat_id <= MAX_BATTERIES:
+            return default
+        value = getattr(battery_store().get(bat_id), self.field)
+        return default if value is None or value == (None, None) else value
+
+
+def battery_store() -> BatteryStore:
+    """The store shared by parsers, publisher and aggregation, sized for the model in the register schema."""
+    global _store
+    if _store is None:
+        counts = active_schema().field_counts
+        _store = BatteryStore(counts.get('cells', 16), counts.get('temps', 4))
+    return _store
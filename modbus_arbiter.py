@@ -0,0 +1,103 @@
+# modbus_arbiter.py
+
+import time
+import queue
+import itertools
+from concurrent.futures import Future
+
+# Job priorities, lower runs first
+PRIORITY_WRITE = 0          # commands from MQTT (inverter protocol writes)
+PRIORITY_POLL = 1           # regular battery polling
+PRIORITY_BACKGROUND = 2     # confirmation reads, refreshes; only while the bus is idle
+
+
+class BusArbiter:
+    """
+    Single owner of the Modbus gateway in the blocking engine.
+
+    Only the polling thread touches the gateway. Other threads (paho's network
+    thread running MQTT command handlers) submit jobs and return at once; the
+    polling thread runs them between battery polls (writes) or while waiting
+    for the next cycle (everything), in priority order. Frames of a command and
+    a poll can therefore never interleave on the link.
+    """
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._pause_until = 0.0
+
+        # Counters
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.max_wait = 0.0
+
+    def submit(self, job, priority=PRIORITY_WRITE, name="job") -> Future:
+        """
+        Queue job(gateway) from any thread.
+
+        Returns:
+            Future: Resolves with the job's return value (or exception) once it ran.
+        """
+        future = Future()
+        self._queue.put((priority, next(self._seq), time.monotonic(), name, job, future))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def pause_polling(self, seconds: float):
+        """Hold off battery polls (not queued jobs), e.g. while the BMS applies a written setting."""
+        self._pause_until = max(self._pause_until, time.monotonic() + seconds)
+
+    def polling_paused(self) -> bool:
+        return time.monotonic() < self._pause_until
+
+    def _run(self, item):
+        priority, _, queued, name, job, future = item
+        self.max_wait = max(self.max_wait, time.monotonic() - queued)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(job(self.gateway))
+            self.jobs_done += 1
+        except Exception as e:
+            self.jobs_failed += 1
+            print(f"[ERROR] Bus job '{name}' failed: {e}")
+            future.set_exception(e)
+
+    def run_pending(self, max_priority=PRIORITY_BACKGROUND) -> int:
+        """Run queued jobs up to max_priority in the calling (owner) thread; return how many ran."""
+        ran = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return ran
+            if item[0] > max_priority:
+                # Lower priority work waits for an idle moment
+                self._queue.put(item)
+                return ran
+            self._run(item)
+            ran += 1
+
+    def wait(self, seconds: float):
+        """Sleep for seconds in the owner thread, running every job that arrives meanwhile."""
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                return
+            self._run(item)
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending(),
+            'done': self.jobs_done,
+            'failed': self.jobs_failed,
+            'max_wait': self.max_wait,
+        }
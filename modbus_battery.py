@@ -1,6 +1,7 @@
 # modbus_battery.py
 
 from modbus_gateway import modbus_crc16
+from modbus_schema import active_schema
 
 def build_read_holding_registers_query(slave: int, register: int, count: int, modbus_registers) -> bytes:
     """
@@ -13,17 +14,18 @@ def build_read_holding_registers_query(slave: int, register: int, count: int, mo
 
 def get_all_queries_for_battery(bat_id: int, modbus_registers) -> dict:
     """
-    Return dictionary of queries to perform.
+    Return dictionary of queries to perform, one per telemetry block of
+    modbus_registers.REGISTER_SCHEMA (sized for the configured battery model).
     The main program checks for presence of keys before sending queries,
-    so you can comment out any query here to disable it safely.
+    so you can drop any query here to disable it safely.
+    How often each one is sent is the block's lane in REGISTER_SCHEMA.
     """
 
     if bat_id < 1 or bat_id > 15:
         raise ValueError("Battery ID must be between 1 and 15")
 
+    blocks = active_schema().blocks
     return {
-        'get_block_voltage':      build_read_holding_registers_query(bat_id, modbus_registers.REG_BLOCK_VOLTAGE, modbus_registers.LEN_BLOCK_VOLTAGE, modbus_registers),
-        'get_cells_voltage':      build_read_holding_registers_query(bat_id, modbus_registers.REG_CELLS_VOLTAGE, modbus_registers.LEN_CELLS_VOLTAGE, modbus_registers),
-        'get_temperature':        build_read_holding_registers_query(bat_id, modbus_registers.REG_TEMPERATURE, modbus_registers.LEN_TEMPERATURE, modbus_registers),
-        'get_extra_temperature':  build_read_holding_registers_query(bat_id, modbus_registers.REG_EXTRA_TEMPERATURE, modbus_registers.LEN_EXTRA_TEMPERATURE, modbus_registers),
+        key: build_read_holding_registers_query(bat_id, address, count, modbus_registers)
+        for key, (address, count) in blocks.items()
     }
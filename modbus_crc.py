@@ -0,0 +1,61 @@
+# modbus_crc.py
+
+import struct
+
+# === Modbus RTU CRC16 (poly 0xA001 reflected, init 0xFFFF) ===
+CRC16_INIT = 0xFFFF
+
+def _build_crc16_table():
+    """Precompute the 256-entry lookup table for the reflected 0xA001 polynomial."""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _build_crc16_table()
+
+_pack_crc = struct.Struct('<H').pack
+
+
+def crc16_update(crc: int, data, start: int = 0, end: int = None) -> int:
+    """
+    Fold bytes into a running CRC16 value.
+
+    Works directly on bytes, bytearray or memoryview without copying. Use
+    start/end to checksum a slice of a larger receive buffer, or call it
+    repeatedly as chunks arrive, starting from CRC16_INIT.
+
+    Returns:
+        int: Updated CRC value (not yet packed to wire order).
+    """
+    table = CRC16_TABLE
+    if end is None:
+        end = len(data)
+    for i in range(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xFF]
+    return crc
+
+
+def crc16_value(data, start: int = 0, end: int = None) -> int:
+    """Return the CRC16 of data[start:end] as an integer."""
+    return crc16_update(CRC16_INIT, data, start, end)
+
+
+def modbus_crc16(data) -> bytes:
+    """Return the CRC16 of data packed little-endian, as appended to RTU frames."""
+    return _pack_crc(crc16_update(CRC16_INIT, data))
+
+
+def crc16_check(frame, length: int = None) -> bool:
+    """
+    Check the trailing CRC of an RTU frame held in frame[:length].
+
+    Running the CRC over the whole frame including its CRC bytes yields 0
+    for an intact frame, so no slicing or packing is needed.
+    """
+    if length is None:
+        length = len(frame)
+    return length >= 4 and crc16_update(CRC16_INIT, frame, 0, length) == 0
@@ -1,8 +1,10 @@
 # modbus_eeprom.py
 
 import time
+import asyncio
 from main_console import print_presets_table
 from mqtt_core import publish_presets_in_ritar_device, publish_mqtt_delete
+from modbus_planner import plan_register_runs
 
 def build_safe_preset_registers(modbus_registers):
     """Flatten and return preset registers excluding blocked/dangerous groups and registers."""
@@ -16,27 +18,130 @@ def build_safe_preset_registers(modbus_registers):
             safe_registers[key] = reg
     return safe_registers
 
-def read_and_process_presets(client, gateway, battery_ids, modbus_registers):
+def build_readable_preset_registers(modbus_registers):
+    """Return addresses of every preset register the BMS defines, blocked ones included (read-through only)."""
+    return {reg for regs in modbus_registers.PRESET_GROUPS.values() for reg in regs.values()}
+
+def read_preset_ranges(gateway, bat_id, plan):
+    """
+    Read each coalesced preset range in one request and decode only the safe labels.
+    A range the BMS refuses is retried register by register.
+
+    Returns:
+        tuple: ({label: value or None}, number of requests sent)
+    """
+    preset_data = {}
+    requests = 0
+    for entry in plan:
+        values = None
+        try:
+            requests += 1
+            values = gateway.read_holding_registers(bat_id, entry['address'], entry['count'])
+        except Exception as e:
+            print(f"[ERROR] Reading presets {entry['address']}-{entry['address'] + entry['count'] - 1} for battery {bat_id}: {e}")
+        time.sleep(0.05)
+
+        if values and len(values) == entry['count']:
+            for label, (offset, _) in entry['blocks'].items():
+                preset_data[label] = values[offset]
+            continue
+
+        # Range read failed, fall back to single registers for this run
+        for label, (offset, _) in entry['blocks'].items():
+            try:
+                requests += 1
+                single = gateway.read_holding_registers(bat_id, entry['address'] + offset, 1)
+                preset_data[label] = single[0] if single else None
+            except Exception as e:
+                print(f"[ERROR] Reading preset '{label}' for battery {bat_id}: {e}")
+                preset_data[label] = None
+            time.sleep(0.05)
+    return preset_data, requests
+
+async def read_preset_ranges_async(gateway, bat_id, plan):
+    """read_preset_ranges() for an AsyncModbusGateway."""
+    preset_data = {}
+    requests = 0
+    for entry in plan:
+        values = None
+        try:
+            requests += 1
+            values = await gateway.read_holding_registers(bat_id, entry['address'], entry['count'])
+        except Exception as e:
+            print(f"[ERROR] Reading presets {entry['address']}-{entry['address'] + entry['count'] - 1} for battery {bat_id}: {e}")
+        await asyncio.sleep(0.05)
+
+        if values and len(values) == entry['count']:
+            for label, (offset, _) in entry['blocks'].items():
+                preset_data[label] = values[offset]
+            continue
+
+        # Range read failed, fall back to single registers for this run
+        for label, (offset, _) in entry['blocks'].items():
+            try:
+                requests += 1
+                single = await gateway.read_holding_registers(bat_id, entry['address'] + offset, 1)
+                preset_data[label] = single[0] if single else None
+            except Exception as e:
+                print(f"[ERROR] Reading preset '{label}' for battery {bat_id}: {e}")
+                preset_data[label] = None
+            await asyncio.sleep(0.05)
+    return preset_data, requests
+
+def build_preset_plan(modbus_registers, max_count=64):
+    """
+    Returns:
+        tuple: ({label: address} of safe presets, coalesced read plan), or ({}, []) if nothing is safe to read.
+    """
     preset_registers = build_safe_preset_registers(modbus_registers)
+    if not preset_registers:
+        return {}, []
+    # Contiguous runs are read in one request; blocked/dangerous registers inside a run are read but not decoded
+    return preset_registers, plan_register_runs(
+        preset_registers, build_readable_preset_registers(modbus_registers), max_count)
+
+def read_and_process_presets(client, gateway, battery_ids, modbus_registers, max_count=64):
+    preset_registers, plan = build_preset_plan(modbus_registers, max_count)
     if not preset_registers:
         print("No safe preset registers to read.")
         return
 
     all_presets = {}
+    started = time.monotonic()
+    total_requests = 0
 
     for bat_id in battery_ids:
-        preset_data = {}
-        for label, register in preset_registers.items():
-            try:
-                # Directly call read_holding_registers with explicit slave ID
-                values = gateway.read_holding_registers(bat_id, register, 1)
-                preset_data[label] = values[0] if values else None
-            except Exception as e:
-                print(f"[ERROR] Reading preset '{label}' for battery {bat_id}: {e}")
-                preset_data[label] = None
-            time.sleep(0.05)
-        all_presets[bat_id] = preset_data
+        preset_data, requests = read_preset_ranges(gateway, bat_id, plan)
+        total_requests += requests
+        # Keep the label order of PRESET_GROUPS for tables and MQTT
+        all_presets[bat_id] = {label: preset_data.get(label) for label in preset_registers}
+
+    print(f"[INFO] EEPROM presets read in {time.monotonic() - started:.2f}s: "
+          f"{len(preset_registers)} registers x {len(battery_ids)} batteries in {total_requests} requests")
+    process_presets(client, battery_ids, preset_registers, all_presets)
+
+async def read_and_process_presets_async(client, gateway, battery_ids, modbus_registers, max_count=64):
+    """read_and_process_presets() for an AsyncModbusGateway."""
+    preset_registers, plan = build_preset_plan(modbus_registers, max_count)
+    if not preset_registers:
+        print("No safe preset registers to read.")
+        return
+
+    all_presets = {}
+    started = time.monotonic()
+    total_requests = 0
+
+    for bat_id in battery_ids:
+        preset_data, requests = await read_preset_ranges_async(gateway, bat_id, plan)
+        total_requests += requests
+        all_presets[bat_id] = {label: preset_data.get(label) for label in preset_registers}
+
+    print(f"[INFO] EEPROM presets read in {time.monotonic() - started:.2f}s: "
+          f"{len(preset_registers)} registers x {len(battery_ids)} batteries in {total_requests} requests")
+    process_presets(client, battery_ids, preset_registers, all_presets)
 
+def process_presets(client, battery_ids, preset_registers, all_presets):
+    """Compare the presets read from all batteries, print them and publish (or retract) the common values."""
     # Check if all values for each label match across all batteries
     all_labels = list(preset_registers.keys())
     presets_identical = True
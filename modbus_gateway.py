@@ -4,25 +4,162 @@ import socket
 import serial
 import struct
 import time
+from abc import ABC, abstractmethod
 
-def modbus_crc16(data: bytes) -> bytes:
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos
-        for _ in range(8):
-            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
-    return struct.pack('<H', crc)
+# CRC16 lives in modbus_crc; re-exported here for modules that import it from the gateway
+from modbus_crc import modbus_crc16, crc16_check
+from main_links import Backoff, LinkState
 
-class ModbusGateway:
+# Transaction outcomes that point at a dead or desynchronised link
+LINK_TIMEOUT = 'timeout'        # nothing or too little came back
+LINK_BAD_CRC = 'crc'            # frame arrived but CRC/function code is wrong
+LINK_WRONG_SLAVE = 'slave'      # answer from another battery, stream is shifted
+LINK_IO_ERROR = 'io'            # socket/serial raised, connection is gone
+
+# Transaction result statuses
+RESULT_OK = 'ok'
+RESULT_TIMEOUT = 'timeout'              # no answer before the deadline
+RESULT_SHORT_FRAME = 'short_frame'      # answer stopped before the expected length
+RESULT_BAD_CRC = 'bad_crc'              # CRC or function code mismatch
+RESULT_WRONG_SLAVE = 'wrong_slave'      # answer from another slave id
+RESULT_EXCEPTION = 'exception'          # slave answered with a Modbus exception code
+RESULT_IO_ERROR = 'io_error'            # link could not be used
+
+# Statuses worth retrying; an exception reply will not change on retry
+RETRYABLE_RESULTS = {RESULT_TIMEOUT, RESULT_SHORT_FRAME, RESULT_BAD_CRC, RESULT_WRONG_SLAVE, RESULT_IO_ERROR}
+
+class ModbusResult:
+    """
+    Outcome of one ModbusGateway.transact() call.
+
+    payload is a memoryview of the register data (read replies) or of the
+    echoed address/value (write replies); frame is the whole received frame.
+    Both point into the receive buffer and are only valid until it is reused.
+    """
+    __slots__ = ('status', 'payload', 'frame', 'exception_code')
+
+    def __init__(self, status, payload=None, frame=None, exception_code=None):
+        self.status = status
+        self.payload = payload
+        self.frame = frame
+        self.exception_code = exception_code
+
+    @property
+    def ok(self) -> bool:
+        return self.status == RESULT_OK
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_RESULTS
+
+    def __repr__(self):
+        if self.status == RESULT_EXCEPTION:
+            return f"{self.status} (code {self.exception_code})"
+        if self.frame is not None and self.status != RESULT_OK:
+            return f"{self.status} ({len(self.frame)} bytes: {self.frame.hex()})"
+        return self.status
+
+def rtu_frame_size(function_code: int, byte_count: int = None):
+    """
+    Total length of an RTU response frame as far as the header tells.
+
+    Returns:
+        int: Frame length in bytes, 0 if the byte count is still needed,
+             None if the function code does not define a length.
+    """
+    if function_code & 0x80:
+        return 5                                # slave, fc|0x80, exception code, CRC
+    if function_code in (0x01, 0x02, 0x03, 0x04):
+        if byte_count is None:
+            return 0
+        return 3 + byte_count + 2               # header, byte count, data, CRC
+    if function_code in (0x05, 0x06, 0x0F, 0x10):
+        return 8                                # echo of address/value or address/count
+    return None
+
+
+def classify_response(request, view, n: int):
+    """
+    Validate the response in view[:n] against the request that produced it.
+
+    Returns:
+        tuple: (ModbusResult, link failure reason or None when the link is healthy)
+    """
+    slave, fc = request[0], request[1]
+    if n == 0:
+        return ModbusResult(RESULT_TIMEOUT), LINK_TIMEOUT
+    if n < 5:
+        return ModbusResult(RESULT_SHORT_FRAME, frame=view[:n]), LINK_TIMEOUT
+    if view[0] != slave:
+        return ModbusResult(RESULT_WRONG_SLAVE, frame=view[:n]), LINK_WRONG_SLAVE
+
+    resp_fc = view[1]
+    if resp_fc == fc | 0x80 and n == 5:
+        if not crc16_check(view, n):
+            return ModbusResult(RESULT_BAD_CRC, frame=view[:n]), LINK_BAD_CRC
+        # The link is fine, the request was refused
+        return ModbusResult(RESULT_EXCEPTION, frame=view[:n], exception_code=view[2]), None
+
+    if fc in (0x01, 0x02, 0x03, 0x04):
+        expected = 5 + 2 * int.from_bytes(request[4:6], 'big')
+        payload_start = 3
+    else:
+        expected = 8
+        payload_start = 2
+    if n < expected:
+        return ModbusResult(RESULT_SHORT_FRAME, frame=view[:n]), LINK_TIMEOUT
+    if resp_fc != fc or not crc16_check(view, n):
+        return ModbusResult(RESULT_BAD_CRC, frame=view[:n]), LINK_BAD_CRC
+    return ModbusResult(RESULT_OK, view[payload_start:n - 2], view[:n]), None
+
+
+def read_request(modbus_registers, slave: int, address: int, count: int) -> bytes:
+    """Build a read holding registers request frame including CRC."""
+    payload = struct.pack('>B B H H', slave, modbus_registers.FUNC_READ_HOLDING_REGS, address, count)
+    return payload + modbus_crc16(payload)
+
+
+def write_multiple_request(modbus_registers, slave: int, address: int, values) -> bytes:
+    """Build a write multiple registers request frame including CRC."""
+    count = len(values)
+    payload = struct.pack(f'>B B H H B {count}H', slave, modbus_registers.FUNC_WRITE_MULTIPLE_REGS,
+                          address, count, count * 2, *values)
+    return payload + modbus_crc16(payload)
+
+
+def write_single_request(modbus_registers, slave: int, address: int, value: int) -> bytes:
+    """Build a write single register request frame including CRC; a valid answer echoes it."""
+    payload = struct.pack('>B B H H', slave, modbus_registers.FUNC_WRITE_SINGLE_REG, address, value)
+    return payload + modbus_crc16(payload)
+
+
+class GatewayLink(ABC):
+    """
+    Connection settings, link health tracking and reconnect backoff shared by
+    the blocking ModbusGateway and the asyncio AsyncModbusGateway. Subclasses
+    provide open (blocking or a coroutine), close and _drain for their transport.
+    """
     def __init__(self, config: dict, modbus_registers):
         self.config = config
         self.modbus_registers = modbus_registers
-        self._sock = None
-        self._serial = None
         self.timeout = config.get('connection_timeout', 3)
         self.slave = config.get('slave', 1)
         self.type = config.get('connection_type')
 
+        # Link health and reconnect backoff (exponential, jittered)
+        self.max_failures = config.get('gateway_max_failures', 3)
+        self.backoff = Backoff(0.5, config.get('gateway_backoff_max', 60))
+        self._next_attempt = 0.0
+        self._failures = 0
+
+        # Up/down state and uptime, for the console and the ESS link sensors
+        self.link = LinkState("Gateway")
+
+        # Counters to confirm the link stays up between polling cycles
+        self.connects = 0
+        self.reconnects = 0
+        self.link_errors = {LINK_TIMEOUT: 0, LINK_BAD_CRC: 0, LINK_WRONG_SLAVE: 0, LINK_IO_ERROR: 0}
+
         if self.type == 'ethernet':
             self.host = config['rs485gate_ip']
             self.port = config['rs485gate_port']
@@ -34,6 +171,101 @@ class ModbusGateway:
         else:
             raise ValueError("Invalid connection_type: must be 'ethernet' or 'serial'")
 
+        # RTU inter-frame silence: 3.5 characters of 11 bits, fixed 1.75 ms above 19200 baud
+        if self.type == 'serial':
+            self.t35 = 1.75e-3 if self.baudrate > 19200 else 3.5 * 11 / self.baudrate
+        else:
+            self.t35 = 0.0
+        self._last_rx = 0.0
+
+    @staticmethod
+    def _configure_socket(sock):
+        """Disable Nagle and enable TCP keepalive so a silently dropped gateway is noticed."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Linux-specific tuning, not available on every platform
+        for opt, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, opt):
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+                except OSError:
+                    pass
+
+    def _link_opened(self):
+        self.connects += 1
+        self._failures = 0
+        self.backoff.reset()
+        self.link.mark_up()
+
+    def _reconnect_delay(self) -> float:
+        """Seconds left before the next reconnect attempt is allowed."""
+        return max(0.0, self._next_attempt - time.monotonic())
+
+    def _reconnect_failed(self, error):
+        delay = self.backoff.next()
+        self._next_attempt = time.monotonic() + delay
+        self.link.mark_down(error)
+        print(f"[ERROR] Gateway reconnect failed: {error}, next attempt in {delay:.1f}s")
+
+    def _reconnect_succeeded(self):
+        self.reconnects += 1
+        self._next_attempt = 0.0
+        print(f"[INFO] Gateway reconnected (connects: {self.connects}, reconnects: {self.reconnects})")
+
+    def report_success(self):
+        """Record a transaction that returned a valid frame."""
+        self._failures = 0
+
+    def report_failure(self, reason: str):
+        """
+        Record a failed transaction. Stale bytes are flushed so the next answer
+        lines up again; I/O errors or repeated failures drop the link so the
+        next transaction reconnects.
+        """
+        self.link_errors[reason] = self.link_errors.get(reason, 0) + 1
+        self._failures += 1
+        if reason == LINK_IO_ERROR or self._failures >= self.max_failures:
+            print(f"[WARN] Gateway link unhealthy ({reason}, {self._failures} failures in a row), dropping connection")
+            self.close()
+            self.link.mark_down(reason)
+            self._failures = 0
+        elif reason in (LINK_BAD_CRC, LINK_WRONG_SLAVE):
+            self._drain()
+
+    def report_result(self, reason):
+        """Feed the link failure reason from classify_response() into health tracking."""
+        if reason is None:
+            self.report_success()
+        else:
+            self.report_failure(reason)
+
+    def stats(self) -> dict:
+        return {
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'uptime': self.link.uptime(),
+            **self.link_errors,
+        }
+
+    @abstractmethod
+    def close(self):
+        """Close the transport; the next transaction reconnects."""
+
+    @abstractmethod
+    def _drain(self):
+        """Discard stale bytes of the transport, so the next answer lines up."""
+
+
+class ModbusGateway(GatewayLink):
+    def __init__(self, config: dict, modbus_registers):
+        super().__init__(config, modbus_registers)
+        self._sock = None
+        self._serial = None
+
+        # Preallocated receive buffer (max RTU frame is 256 bytes)
+        self._rx_buf = bytearray(256)
+        self._rx_view = memoryview(self._rx_buf)
+
     def open(self):
         if self.type == 'ethernet':
             if self._sock:
@@ -42,9 +274,15 @@ class ModbusGateway:
                 except Exception:
                     pass
                 self._sock = None
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.settimeout(self.timeout)
-            self._sock.connect((self.host, self.port))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._configure_socket(sock)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect((self.host, self.port))
+            except Exception:
+                sock.close()
+                raise
+            self._sock = sock
         elif self.type == 'serial':
             if self._serial and self._serial.is_open:
                 try:
@@ -56,6 +294,7 @@ class ModbusGateway:
                 baudrate=self.baudrate,
                 timeout=self.timeout
             )
+        self._link_opened()
 
     def close(self):
         if self._sock:
@@ -71,159 +310,218 @@ class ModbusGateway:
                 pass
             self._serial = None
 
-    def ensure_connected(self):
-        """Check if connection is open; reopen if closed."""
+    def is_connected(self) -> bool:
         if self.type == 'ethernet':
-            if not self._sock:
-                print("[WARN] Socket not connected, reopening...")
-                self.open()
-        elif self.type == 'serial':
-            if not self._serial or not self._serial.is_open:
-                print("[WARN] Serial port not opened, reopening...")
-                self.open()
+            return self._sock is not None
+        return self._serial is not None and self._serial.is_open
+
+    def reconnect(self) -> bool:
+        """
+        Reopen the link, honouring exponential backoff between attempts.
+
+        Returns:
+            bool: True if the link is open afterwards, False if still backing off or the attempt failed.
+        """
+        if self._reconnect_delay() > 0:
+            return False
+        self.close()
+        try:
+            self.open()
+        except Exception as e:
+            self._reconnect_failed(e)
+            return False
+        self._reconnect_succeeded()
+        return True
+
+    def ensure_connected(self) -> bool:
+        """Check if connection is open; reopen (with backoff) if closed."""
+        if self.is_connected():
+            return True
+        if self._reconnect_delay() > 0:
+            return False        # Still backing off: skip the bus rather than wait
+        print("[WARN] Gateway link is down, reconnecting...")
+        return self.reconnect()
+
+    def _drain(self):
+        """Discard any bytes already waiting on the link (late or shifted answers)."""
+        try:
+            if self.type == 'ethernet' and self._sock:
+                self._sock.setblocking(False)
+                try:
+                    while self._sock.recv(256):
+                        pass
+                except (BlockingIOError, socket.error):
+                    pass
+                finally:
+                    self._sock.settimeout(self.timeout)
+            elif self.type == 'serial' and self._serial:
+                self._serial.reset_input_buffer()
+        except Exception:
+            pass
 
     def send(self, data: bytes):
-        self.ensure_connected()
-        if self.type == 'ethernet':
-            try:
-                self._sock.sendall(data)
-            except (socket.error, AttributeError) as e:
-                print(f"[ERROR] Send failed: {e}, reconnecting...")
-                self.open()
+        if not self.ensure_connected():
+            raise ConnectionError("Gateway link is down")
+        if self.t35:
+            # Respect the RTU inter-frame gap after the previous answer
+            wait = self._last_rx + self.t35 - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        try:
+            if self.type == 'ethernet':
                 self._sock.sendall(data)
-        elif self.type == 'serial':
-            try:
-                self._serial.write(data)
-            except (serial.SerialException, AttributeError) as e:
-                print(f"[ERROR] Serial send failed: {e}, reopening...")
-                self.open()
+            elif self.type == 'serial':
                 self._serial.write(data)
+        except (socket.error, serial.SerialException, AttributeError) as e:
+            print(f"[ERROR] Send failed: {e}")
+            self.report_failure(LINK_IO_ERROR)
+            raise ConnectionError(f"Send failed: {e}") from e
 
     def recv(self, size: int) -> bytes:
-        self.ensure_connected()
-        if self.type == 'ethernet':
-            return self._recv_all(size)
-        elif self.type == 'serial':
-            return self._serial.read(size)
+        """Up to size bytes within the link timeout; the raw counterpart of send() over _read_into."""
+        if not self.is_connected():
+            return b''
+        buf = bytearray(size)
+        n = self._read_into(memoryview(buf), 0, size, time.monotonic() + self.timeout)
+        return bytes(buf[:n])
 
-    def _recv_all(self, size: int) -> bytes:
-        data = bytearray()
-        deadline = time.time() + self.timeout
-        while len(data) < size and time.time() < deadline:
+    def _read_into(self, view, pos: int, size: int, deadline: float) -> int:
+        """Receive into view[pos:size] until it is filled or the deadline passes; return the new fill level."""
+        while pos < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                chunk = self._sock.recv(size - len(data))
+                if self.type == 'ethernet':
+                    self._sock.settimeout(remaining)
+                    n = self._sock.recv_into(view[pos:size])
+                    if not n:
+                        # Peer closed the connection
+                        self.report_failure(LINK_IO_ERROR)
+                        break
+                else:
+                    self._serial.timeout = remaining
+                    n = self._serial.readinto(view[pos:size])
             except socket.timeout:
                 break
-            except (socket.error, AttributeError) as e:
-                print(f"[ERROR] Receive failed: {e}, reconnecting...")
-                self.open()
-                continue
-            if not chunk:
+            except (socket.error, serial.SerialException, AttributeError) as e:
+                print(f"[ERROR] Receive failed: {e}")
+                self.report_failure(LINK_IO_ERROR)
                 break
-            data.extend(chunk)
-        return bytes(data)
+            if n:
+                pos += n
+                self._last_rx = time.monotonic()
+        return pos
 
-    def _is_valid_response(self, response: bytes, expected_fc: int) -> bool:
-        return (
-            len(response) >= 5 and
-            response[1] == expected_fc and
-            modbus_crc16(response[:-2]) == response[-2:]
-        )
-
-    def read_holding_registers(self, slave: int, address: int, count: int = 1):
-        function_code = self.modbus_registers.FUNC_READ_HOLDING_REGS
-        payload = struct.pack('>B B H H', slave, function_code, address, count)
-        crc = modbus_crc16(payload)
-        frame = payload + crc
-
-        self.send(frame)
-        time.sleep(0.1)
-
-        expected_length = 5 + 2 * count
-        response = bytearray()
-        deadline = time.time() + self.timeout
-        while len(response) < expected_length and time.time() < deadline:
-            chunk = self.recv(expected_length - len(response))
-            if not chunk:
+    def _read_until_silence(self, view, pos: int, deadline: float) -> int:
+        """Read an unknown-length tail until the line is quiet for 3.5 characters (or a short gap on TCP)."""
+        gap = self.t35 or 0.05
+        while pos < len(view) and time.monotonic() < deadline:
+            new_pos = self._read_into(view, pos, len(view), min(deadline, time.monotonic() + gap))
+            if new_pos == pos:
                 break
-            response.extend(chunk)
+            pos = new_pos
+        return pos
 
-        if not self._is_valid_response(response, function_code):
-            print("[ERROR] Invalid Modbus read response")
-            return None
+    def _recv_frame_into(self, view) -> int:
+        """
+        Receive one Modbus RTU response frame into view, returning as soon as it is complete.
+
+        The frame length is learnt from the header: exception replies are 5 bytes,
+        read replies carry a byte count, write echoes are 8 bytes. Unknown function
+        codes are read until inter-frame silence. Returns the number of bytes
+        received; a short count means the deadline (connection_timeout) expired first.
+        """
+        if not self.is_connected():
+            return 0
+        deadline = time.monotonic() + self.timeout
+        try:
+            # Header: slave id + function code
+            pos = self._read_into(view, 0, 2, deadline)
+            if pos < 2:
+                return pos
+            size = rtu_frame_size(view[1])
+            if size == 0:
+                pos = self._read_into(view, pos, 3, deadline)
+                if pos < 3:
+                    return pos
+                size = rtu_frame_size(view[1], view[2])
+            elif size is None:
+                return self._read_until_silence(view, pos, deadline)
+            if size > len(view):
+                # Byte count larger than the buffer: the stream is not aligned on a frame
+                return self._read_until_silence(view, pos, deadline)
+            return self._read_into(view, pos, size, deadline)
+        finally:
+            # Restore the default timeout for plain send()/recv() users
+            if self.type == 'ethernet' and self._sock:
+                self._sock.settimeout(self.timeout)
+            elif self.type == 'serial' and self._serial:
+                self._serial.timeout = self.timeout
+
+    def recv_frame(self) -> bytes:
+        """Receive one complete RTU response frame (see _recv_frame_into) as bytes."""
+        n = self._recv_frame_into(self._rx_view)
+        return bytes(self._rx_view[:n])
+
+    def transact(self, frame: bytes, buffer: bytearray = None) -> 'ModbusResult':
+        """
+        Send a prebuilt RTU request and receive its validated response.
+
+        The response lands in buffer (or the gateway's own preallocated receive
+        buffer) without intermediate copies. CRC, slave id and function code are
+        checked and fed into the link health tracking.
+
+        Args:
+            frame: Complete request frame including CRC.
+            buffer: Optional preallocated bytearray to receive into. Views in the
+                    result stay valid until the same buffer is reused, so callers
+                    that keep several responses at once pass their own buffers.
+
+        Returns:
+            ModbusResult: status RESULT_OK with payload/frame memoryviews, or a typed error.
+        """
+        view = self._rx_view if buffer is None else memoryview(buffer)
 
-        byte_count = response[2]
-        data = response[3:3 + byte_count]
-        return [int.from_bytes(data[i:i+2], 'big') for i in range(0, byte_count, 2)]
+        try:
+            self.send(frame)
+        except ConnectionError:
+            return ModbusResult(RESULT_IO_ERROR)
+
+        n = self._recv_frame_into(view)
+        result, reason = classify_response(frame, view, n)
+        self.report_result(reason)
+        return result
+
+    def read_holding_registers(self, slave: int, address: int, count: int = 1):
+        result = self.transact(read_request(self.modbus_registers, slave, address, count))
+        if not result.ok:
+            print(f"[ERROR] Invalid Modbus read response: {result}")
+            return None
+        return list(struct.unpack_from(f'>{count}H', result.payload))
 
     def write_register(self, slave: int, address: int, value: int) -> bool:
-        function_code = self.modbus_registers.FUNC_WRITE_SINGLE_REG
-        payload = struct.pack('>B B H H', slave, function_code, address, value)
-        crc = modbus_crc16(payload)
-        frame = payload + crc
-
-        self.send(frame)
-        time.sleep(0.2)
-
-        response = bytearray()
-        deadline = time.time() + self.timeout
-        while len(response) < 8 and time.time() < deadline:
-            chunk = self.recv(8 - len(response))
-            if not chunk:
-                break
-            response.extend(chunk)
+        frame = write_single_request(self.modbus_registers, slave, address, value)
 
-        if len(response) == 8:
-            if response[:6] != payload:
-                print(f"[WARN] Write response payload mismatch: {response.hex()} vs sent {payload.hex()}")
-            if modbus_crc16(response[:-2]) != response[-2:]:
-                print("[ERROR] Invalid CRC in Modbus write response")
-                return False
-        else:
-            print(f"[ERROR] Unexpected Modbus write response length: {len(response)}, data: {response.hex()}")
+        result = self.transact(frame)
+        if not result.ok:
+            print(f"[ERROR] Invalid Modbus write response: {result}")
             return False
-
+        if result.frame[:6] != frame[:6]:
+            print(f"[WARN] Write response payload mismatch: {result.frame.hex()} vs sent {frame[:6].hex()}")
         return True
 
     def write_multiple_registers(self, slave: int, address: int, values: list[int], max_retries=10, retry_delay=0.5) -> bool:
-        count = len(values)
-        byte_count = count * 2
-        frame = bytearray()
-        frame.append(slave)
-        frame.append(self.modbus_registers.FUNC_WRITE_MULTIPLE_REGS)
-        frame += address.to_bytes(2, 'big')
-        frame += count.to_bytes(2, 'big')
-        frame.append(byte_count)
-        for v in values:
-            frame += v.to_bytes(2, 'big')
-        crc = modbus_crc16(frame)
-        frame += crc
+        frame = write_multiple_request(self.modbus_registers, slave, address, values)
 
         for attempt in range(1, max_retries + 1):
-            try:
-                self.send(bytes(frame))
-            except Exception as e:
-                print(f"[ERROR] Send failed on attempt {attempt}: {e}, reconnecting...")
-                self.open()
-                continue
-
-            time.sleep(0.2)
-            response = bytearray()
-            deadline = time.time() + self.timeout
-            while len(response) < 8 and time.time() < deadline:
-                try:
-                    chunk = self.recv(8 - len(response))
-                except Exception as e:
-                    print(f"[ERROR] Receive failed on attempt {attempt}: {e}, reconnecting...")
-                    self.open()
-                    break
-                if not chunk:
-                    break
-                response.extend(chunk)
-            if (len(response) == 8 and
-                response[1] == self.modbus_registers.FUNC_WRITE_MULTIPLE_REGS and
-                modbus_crc16(response[:-2]) == response[-2:]):
+            result = self.transact(frame)
+            if result.ok:
                 return True
+            if not result.retryable:
+                print(f"[ERROR] Write multiple registers refused: {result}")
+                return False
+            print(f"[WARN] Write multiple registers attempt {attempt} failed: {result}")
             time.sleep(retry_delay)
 
         print(f"[ERROR] Write multiple registers failed after {max_retries} attempts")
@@ -0,0 +1,236 @@
+# modbus_gateway_async.py
+
+import time
+import struct
+import asyncio
+
+from modbus_gateway import (
+    GatewayLink,
+    ModbusResult,
+    RESULT_IO_ERROR,
+    LINK_IO_ERROR,
+    rtu_frame_size,
+    classify_response,
+    read_request,
+    write_single_request,
+    write_multiple_request,
+)
+
+# Serial transport for asyncio is optional, only needed with connection_type: serial
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+class AsyncModbusGateway(GatewayLink):
+    """
+    Modbus RTU gateway on asyncio streams (RTU over TCP or serial_asyncio).
+
+    Same link health tracking, backoff and response validation as ModbusGateway,
+    but every wait is an await, so several gateways, MQTT command handlers and
+    periodic jobs share one event loop. Transactions on one gateway are
+    serialised by a lock; the connection_timeout is a deadline for the whole
+    response, not a sleep before reading.
+    """
+    def __init__(self, config: dict, modbus_registers):
+        super().__init__(config, modbus_registers)
+        self._reader = None
+        self._writer = None
+        self._lock = None
+        self._drain_pending = False
+        self._rx_count = 0
+
+        # Preallocated receive buffer (max RTU frame is 256 bytes)
+        self._rx_buf = bytearray(256)
+        self._rx_view = memoryview(self._rx_buf)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # Created on first use so it belongs to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def open(self):
+        self.close()
+        if self.type == 'ethernet':
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                self._configure_socket(sock)
+        elif self.type == 'serial':
+            if serial_asyncio is None:
+                raise RuntimeError("pyserial-asyncio is required for serial links with async_engine")
+            reader, writer = await serial_asyncio.open_serial_connection(
+                url=self.serial_port, baudrate=self.baudrate)
+        self._reader, self._writer = reader, writer
+        self._drain_pending = False
+        self._link_opened()
+
+    def close(self):
+        if self._writer:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+        self._reader = None
+        self._writer = None
+
+    async def wait_closed(self):
+        """Close the link and wait until the transport has really let go of it."""
+        writer = self._writer
+        self.close()
+        if writer:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def is_connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def reconnect(self) -> bool:
+        """Reopen the link, honouring exponential backoff between attempts."""
+        if self._reconnect_delay() > 0:
+            return False
+        try:
+            await self.open()
+        except Exception as e:
+            self.close()
+            self._reconnect_failed(e)
+            return False
+        self._reconnect_succeeded()
+        return True
+
+    async def ensure_connected(self) -> bool:
+        """Check if connection is open; reopen (with backoff) if closed."""
+        if self.is_connected():
+            return True
+        if self._reconnect_delay() > 0:
+            return False        # Still backing off: skip the bus rather than wait
+        print("[WARN] Gateway link is down, reconnecting...")
+        return await self.reconnect()
+
+    def _drain(self):
+        # Stream buffers can only be emptied from a coroutine; done before the next request
+        self._drain_pending = True
+
+    async def _discard_buffered(self):
+        """Drop bytes already waiting on the link (late or shifted answers)."""
+        self._drain_pending = False
+        try:
+            while await asyncio.wait_for(self._reader.read(256), 0.01):
+                pass
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+
+    async def _read_exactly(self, view, size: int):
+        """Read view[self._rx_count:size]; the fill level survives a cancellation by wait_for()."""
+        if self._rx_count < size:
+            data = await self._reader.readexactly(size - self._rx_count)
+            view[self._rx_count:size] = data
+            self._rx_count = size
+            self._last_rx = time.monotonic()
+
+    async def _read_until_silence(self, view):
+        gap = self.t35 or 0.05
+        while self._rx_count < len(view):
+            try:
+                data = await asyncio.wait_for(self._reader.read(len(view) - self._rx_count), gap)
+            except asyncio.TimeoutError:
+                return
+            if not data:
+                return
+            view[self._rx_count:self._rx_count + len(data)] = data
+            self._rx_count += len(data)
+            self._last_rx = time.monotonic()
+
+    async def _read_frame(self, view):
+        """Receive one RTU response frame into view; see ModbusGateway._recv_frame_into."""
+        await self._read_exactly(view, 2)
+        size = rtu_frame_size(view[1])
+        if size == 0:
+            await self._read_exactly(view, 3)
+            size = rtu_frame_size(view[1], view[2])
+        elif size is None:
+            return await self._read_until_silence(view)
+        if size > len(view):
+            # Byte count larger than the buffer: the stream is not aligned on a frame
+            return await self._read_until_silence(view)
+        await self._read_exactly(view, size)
+
+    async def transact(self, frame: bytes, buffer: bytearray = None) -> ModbusResult:
+        """
+        Send a prebuilt RTU request and await its validated response (see ModbusGateway.transact).
+
+        Views in the result point into buffer (or the gateway's own receive
+        buffer) and stay valid until the same buffer is reused.
+        """
+        view = self._rx_view if buffer is None else memoryview(buffer)
+        async with self.lock:
+            if not await self.ensure_connected():
+                return ModbusResult(RESULT_IO_ERROR)
+            if self._drain_pending:
+                await self._discard_buffered()
+            if self.t35:
+                # Respect the RTU inter-frame gap after the previous answer
+                wait = self._last_rx + self.t35 - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            self._rx_count = 0
+            try:
+                self._writer.write(frame)
+                await self._writer.drain()
+                await asyncio.wait_for(self._read_frame(view), self.timeout)
+            except asyncio.TimeoutError:
+                # A partial header/body stays in the stream buffer; collect it as a short frame
+                await self._read_until_silence(view)
+            except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+                if isinstance(e, asyncio.IncompleteReadError):
+                    # Peer closed the connection mid-frame; keep what arrived for the log
+                    view[self._rx_count:self._rx_count + len(e.partial)] = e.partial
+                    self._rx_count += len(e.partial)
+                print(f"[ERROR] Gateway I/O failed: {e!r}")
+                self.report_failure(LINK_IO_ERROR)
+                return ModbusResult(RESULT_IO_ERROR, frame=view[:self._rx_count])
+
+            result, reason = classify_response(frame, view, self._rx_count)
+            self.report_result(reason)
+            return result
+
+    async def read_holding_registers(self, slave: int, address: int, count: int = 1):
+        result = await self.transact(read_request(self.modbus_registers, slave, address, count))
+        if not result.ok:
+            print(f"[ERROR] Invalid Modbus read response: {result}")
+            return None
+        return list(struct.unpack_from(f'>{count}H', result.payload))
+
+    async def write_register(self, slave: int, address: int, value: int) -> bool:
+        frame = write_single_request(self.modbus_registers, slave, address, value)
+
+        result = await self.transact(frame)
+        if not result.ok:
+            print(f"[ERROR] Invalid Modbus write response: {result}")
+            return False
+        if result.frame[:6] != frame[:6]:
+            print(f"[WARN] Write response payload mismatch: {result.frame.hex()} vs sent {frame[:6].hex()}")
+        return True
+
+    async def write_multiple_registers(self, slave: int, address: int, values: list, max_retries=10, retry_delay=0.5) -> bool:
+        frame = write_multiple_request(self.modbus_registers, slave, address, values)
+
+        for attempt in range(1, max_retries + 1):
+            result = await self.transact(frame)
+            if result.ok:
+                return True
+            if not result.retryable:
+                print(f"[ERROR] Write multiple registers refused: {result}")
+                return False
+            print(f"[WARN] Write multiple registers attempt {attempt} failed: {result}")
+            await asyncio.sleep(retry_delay)
+
+        print(f"[ERROR] Write multiple registers failed after {max_retries} attempts")
+        return False
@@ -1,6 +1,7 @@
 # modbus_inverter.py
 
 import time
+import asyncio
 import main_console
 
 def get_inverter_protocols_reverse(modbus_registers):
@@ -26,3 +27,25 @@ def read_all_inverter_protocols(client, gateway, battery_ids, modbus_registers):
         results.append((bat, val, protocol))
         time.sleep(0.5)
     return results
+
+# --- asyncio variants for AsyncModbusGateway (main_async engine) ---
+async def read_inverter_protocol_async(gateway, battery_id, modbus_registers):
+    regs = await gateway.read_holding_registers(battery_id, modbus_registers.REG_INVERTER_PROTOCOL, 1)
+    if regs:
+        return regs[0]
+    return None
+
+async def write_inverter_protocol_async(gateway, battery_id, value, modbus_registers, on_write=None):
+    success = await gateway.write_multiple_registers(battery_id, modbus_registers.REG_INVERTER_PROTOCOL, [value])
+    if success and on_write:
+        on_write()
+    return success
+
+async def read_all_inverter_protocols_async(gateway, battery_ids, modbus_registers):
+    results = []
+    for bat in battery_ids:
+        val = await read_inverter_protocol_async(gateway, bat, modbus_registers)
+        protocol = modbus_registers.INVERTER_PROTOCOLS.get(val, "Unknown") if val is not None else "No protocol read"
+        results.append((bat, val, protocol))
+        await asyncio.sleep(0.5)
+    return results
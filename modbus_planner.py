@@ -0,0 +1,249 @@
+# modbus_planner.py
+
+import time
+import asyncio
+
+from modbus_crc import modbus_crc16
+from modbus_gateway import RESULT_EXCEPTION
+
+# Modbus spec limit for a single read holding registers request
+MODBUS_MAX_READ_REGISTERS = 125
+
+# Bytes on the wire besides register data: request (8) + response header and CRC (5)
+FRAME_OVERHEAD_BYTES = 13
+
+# Typical gateway/BMS turnaround per transaction, on top of queries_delay
+TURNAROUND_SECONDS = 0.02
+
+# Merged reads that fail this many times in a row are split back into the original reads
+MAX_MERGED_FAILURES = 3
+
+# === Read merging (config read_merge_gap) ===
+# 0:  only blocks that touch are merged, no register outside the register map is read (default)
+# n:  blocks up to n unmapped registers apart are read in one request, reading through the gap
+# -1: gap derived from the line cost model (auto_merge_gap, from baud rate and queries_delay)
+# Reading through a gap needs firmware that answers unmapped registers; some BMS answer
+# with an exception or garbage, and the read is only split after it failed
+DEFAULT_MERGE_GAP = 0
+
+
+def query_range(frame: bytes):
+    """Return (address, count) encoded in a prebuilt read holding registers query."""
+    return int.from_bytes(frame[2:4], 'big'), int.from_bytes(frame[4:6], 'big')
+
+
+def auto_merge_gap(config: dict, queries_delay: float) -> int:
+    """
+    Number of unwanted registers worth reading to save one round trip.
+
+    One extra transaction costs its frame overhead on the RS485 line plus
+    queries_delay and the gateway turnaround; each skipped-over register
+    costs two bytes of line time.
+    """
+    byte_time = 11 / config.get('serial_baudrate', 9600)
+    round_trip = FRAME_OVERHEAD_BYTES * byte_time + queries_delay + TURNAROUND_SECONDS
+    return int(round_trip / byte_time) // 2
+
+
+def get_merge_settings(config: dict, queries_delay: float):
+    """Return (max_gap, max_count) from config; read_merge_gap -1 means derive it from the cost model."""
+    max_count = min(config.get('max_read_registers', 64), MODBUS_MAX_READ_REGISTERS)
+    max_gap = config.get('read_merge_gap', DEFAULT_MERGE_GAP)
+    if max_gap is None:
+        max_gap = DEFAULT_MERGE_GAP
+    elif max_gap < 0:
+        max_gap = auto_merge_gap(config, queries_delay)
+    return max_gap, max_count
+
+
+def plan_reads(blocks: dict, max_gap: int, max_count: int) -> list:
+    """
+    Merge logical register blocks into as few read transactions as possible.
+
+    Args:
+        blocks (dict): {key: (address, count)} of logical blocks the parsers need.
+        max_gap (int): Largest run of unwanted registers to read through when merging.
+        max_count (int): Upper bound of registers in one read.
+
+    Returns:
+        list of dict: Planned reads with 'address', 'count' and 'blocks'
+                      ({key: (offset_in_registers, count)}).
+    """
+    plan = []
+    for key, (address, count) in sorted(blocks.items(), key=lambda kv: kv[1]):
+        if plan:
+            last = plan[-1]
+            end = last['address'] + last['count']
+            new_end = max(end, address + count)
+            if address - end <= max_gap and new_end - last['address'] <= max_count:
+                last['count'] = new_end - last['address']
+                last['blocks'][key] = (address - last['address'], count)
+                continue
+        plan.append({'address': address, 'count': count, 'blocks': {key: (0, count)}})
+    return plan
+
+
+def plan_register_runs(wanted: dict, readable, max_count: int) -> list:
+    """
+    Coalesce single registers into contiguous range reads.
+
+    Two wanted registers end up in the same read when every register between
+    them is known to be readable (e.g. defined in PRESET_GROUPS), so the BMS
+    answers the range; unwanted registers inside a run are just not decoded.
+
+    Args:
+        wanted (dict): {label: address} of registers to decode.
+        readable (set): Addresses that may be read through.
+        max_count (int): Upper bound of registers in one read.
+
+    Returns:
+        list of dict: Planned reads with 'address', 'count' and 'blocks' ({label: (offset, 1)}).
+    """
+    plan = []
+    for label, address in sorted(wanted.items(), key=lambda kv: kv[1]):
+        if plan:
+            last = plan[-1]
+            end = last['address'] + last['count']
+            bridged = all(reg in readable for reg in range(end, address))
+            if bridged and address + 1 - last['address'] <= max_count:
+                last['count'] = max(end, address + 1) - last['address']
+                last['blocks'][label] = (address - last['address'], 1)
+                continue
+        plan.append({'address': address, 'count': 1, 'blocks': {label: (0, 1)}})
+    return plan
+
+
+def build_plan_for_battery(bat_id: int, queries: dict, modbus_registers, max_gap: int, max_count: int,
+                           intervals: dict = None) -> list:
+    """
+    Plan the reads for one battery from its query dict (as built by modbus_battery,
+    including user overrides) and attach the prebuilt query frame to each read.
+    With intervals ({key: seconds}, the lanes of REGISTER_SCHEMA) only
+    queries polled at the same rate are merged, so a fast read never drags a
+    slow block along.
+    """
+    lanes = {}
+    for key, frame in queries.items():
+        lanes.setdefault((intervals or {}).get(key, 0), {})[key] = query_range(frame)
+    plan = []
+    for lane in sorted(lanes):
+        plan += plan_reads(lanes[lane], max_gap, max_count)
+    for entry in plan:
+        if len(entry['blocks']) == 1:
+            # Unmerged read: reuse the original frame as is
+            entry['query'] = queries[next(iter(entry['blocks']))]
+        else:
+            frame = bytes([bat_id, modbus_registers.FUNC_READ_HOLDING_REGS]) + \
+                entry['address'].to_bytes(2, 'big') + entry['count'].to_bytes(2, 'big')
+            entry['query'] = frame + modbus_crc16(frame)
+        entry['failures'] = 0
+        # Receive buffer for this read; responses are views into it until the next poll
+        entry['buffer'] = bytearray(5 + 2 * entry['count'])
+    return plan
+
+
+def split_entry(plan: list, entry: dict, queries: dict):
+    """Replace a merged read in the plan with the original per-block reads."""
+    pos = plan.index(entry)
+    plan[pos:pos + 1] = [
+        {'address': entry['address'] + offset, 'count': count, 'blocks': {key: (0, count)},
+         'query': queries[key], 'failures': 0, 'buffer': bytearray(5 + 2 * count)}
+        for key, (offset, count) in entry['blocks'].items()
+    ]
+
+
+def slice_response(frame, entry: dict) -> dict:
+    """
+    Cut a merged read response into per-block RTU frames (header, data, CRC),
+    identical to what the original separate queries would have returned.
+    """
+    header = bytes(frame[0:2])
+    result = {}
+    for key, (offset, count) in entry['blocks'].items():
+        start = 3 + offset * 2
+        payload = header + bytes([count * 2]) + frame[start:start + count * 2]
+        result[key] = payload + modbus_crc16(payload)
+    return result
+
+
+def apply_plan_result(bat_id: int, plan: list, entry: dict, result, queries: dict,
+                      responses: dict, warnings_enabled=False):
+    """Store the frames of one planned read in responses, or count the failure (splitting merged reads)."""
+    if result.ok:
+        entry['failures'] = 0
+        if len(entry['blocks']) == 1:
+            responses.update(dict.fromkeys(entry['blocks'], result.frame))
+        else:
+            responses.update(slice_response(result.frame, entry))
+        return
+
+    if len(entry['blocks']) > 1:
+        entry['failures'] += 1
+        if result.status == RESULT_EXCEPTION or entry['failures'] >= MAX_MERGED_FAILURES:
+            print(f"[WARN] Battery {bat_id} merged read at {entry['address']} x{entry['count']} "
+                  f"failed ({result}), falling back to separate reads")
+            split_entry(plan, entry, queries)
+    elif warnings_enabled:
+        print(f"[WARN] Battery {bat_id} read at {entry['address']} x{entry['count']} failed: {result}")
+
+
+def is_due(entry: dict, due) -> bool:
+    """True if a planned read carries a block due this cycle (due None means every block)."""
+    return due is None or any(key in due for key in entry['blocks'])
+
+
+def execute_plan(gateway, bat_id: int, plan: list, queries: dict, queries_delay: float,
+                 warnings_enabled=False, due=None) -> dict:
+    """
+    Run the planned reads for one battery and return {key: response frame}.
+    Keys whose read failed are missing from the result. Unmerged reads are
+    returned as memoryviews into the plan's own receive buffers. With due
+    (a set of query keys), reads without a due block are skipped.
+    """
+    responses = {}
+    for entry in [e for e in plan if is_due(e, due)]:
+        time.sleep(queries_delay)
+        result = gateway.transact(entry['query'], entry['buffer'])
+        apply_plan_result(bat_id, plan, entry, result, queries, responses, warnings_enabled)
+    return responses
+
+
+async def execute_plan_async(gateway, bat_id: int, plan: list, queries: dict, queries_delay: float,
+                             warnings_enabled=False, due=None) -> dict:
+    """execute_plan() for an AsyncModbusGateway; other tasks run while waiting on the bus."""
+    responses = {}
+    for entry in [e for e in plan if is_due(e, due)]:
+        await asyncio.sleep(queries_delay)
+        result = await gateway.transact(entry['query'], entry['buffer'])
+        apply_plan_result(bat_id, plan, entry, result, queries, responses, warnings_enabled)
+    return responses
+
+
+def plan_cost(plan: list) -> tuple:
+    """Return (transactions, bytes on the wire) for one pass over a plan."""
+    return len(plan), sum(FRAME_OVERHEAD_BYTES + 2 * entry['count'] for entry in plan)
+
+
+def plan_report(queries: dict, plan: list, num_batteries: int, max_gap: int, max_count: int,
+                config: dict, queries_delay: float) -> list:
+    """Rows comparing transactions, bytes and estimated bus time per polling cycle without and with merging."""
+    byte_time = 11 / config.get('serial_baudrate', 9600)
+    separate = [{'count': query_range(frame)[1]} for frame in queries.values()]
+    rows = [
+        ["Merge gap / max registers per read", f"{max_gap} / {max_count}"],
+        ["Reads per battery", " + ".join(
+            f"{e['address']}-{e['address'] + e['count'] - 1}" for e in plan)],
+        None,
+    ]
+    totals = []
+    for reads in (separate, plan):
+        transactions, wire_bytes = plan_cost(reads)
+        bus_time = wire_bytes * byte_time + transactions * (queries_delay + TURNAROUND_SECONDS)
+        totals.append((transactions * num_batteries, wire_bytes * num_batteries, bus_time * num_batteries))
+    (t0, b0, s0), (t1, b1, s1) = totals
+    rows += [
+        ["Transactions per cycle (separate -> planned)", f"{t0} -> {t1}"],
+        ["Bytes per cycle (separate -> planned)", f"{b0} -> {b1}"],
+        ["Estimated bus time per cycle (separate -> planned)", f"{s0:.2f}s -> {s1:.2f}s"],
+    ]
+    return rows
@@ -13,6 +13,72 @@ LEN_CELLS_VOLTAGE       = 0x10      # decimal count 16
 LEN_TEMPERATURE         = 0x04      # decimal count 4
 LEN_EXTRA_TEMPERATURE   = 0x0A      # decimal count 10
 
+# Register layout per battery model; counts in REGISTER_SCHEMA may name these keys.
+# All Ritar 51.2 V packs are 16S LFP with 4 cell temperature sensors.
+BATTERY_MODELS = {
+    "BAT-5KWH-51.2V":    {"cells": 16, "temperatures": 4},
+    "BAT-10KWH-51.2V":   {"cells": 16, "temperatures": 4},
+    "BAT-15KWH-51.2V":   {"cells": 16, "temperatures": 4},
+    "United BMS Custom": {"cells": 16, "temperatures": 4},
+}
+
+# Declarative telemetry schema, compiled once at startup by modbus_schema into
+# the battery queries, poll lanes, frame decoders and MQTT sensor entries.
+# One entry per query (the names parser_battery asks for):
+#   address, count   block read in one request; count may be a BATTERY_MODELS key
+#   lane             poll interval in seconds, 0 = every cycle (see main_scheduler.LaneSchedule);
+#                    e.g. 30 for cells and 60 for temperatures, or per install with the
+#                    poll_interval_* options (main_scheduler.LANE_OPTIONS)
+#   safety           "telemetry" blocks are polled; other classes are documentation only
+#   fields           name -> offset (registers into the block), count (array length, default 1
+#                    or a BATTERY_MODELS key), signed, raw_offset and divisor
+#                    (value = (raw + raw_offset) / divisor, integers when both are unset)
+#                    and entity: MQTT sensor (suffix, name, device_class, unit, state_class),
+#                    "{n}" in suffix/name is the 1-based array position
+REGISTER_SCHEMA = {
+    "get_block_voltage": {
+        "address": REG_BLOCK_VOLTAGE, "count": LEN_BLOCK_VOLTAGE, "lane": 0, "safety": "telemetry",
+        "fields": {
+            "current": {"offset": 0, "signed": True, "divisor": 100,
+                        "entity": {"suffix": "current", "name": "Current", "device_class": "current", "unit": "A"}},
+            "voltage": {"offset": 1, "divisor": 100,
+                        "entity": {"suffix": "voltage", "name": "Voltage", "device_class": "voltage", "unit": "V"}},
+            "soc":     {"offset": 2, "divisor": 10,
+                        "entity": {"suffix": "soc", "name": "SOC", "device_class": "battery", "unit": "%"}},
+            "cycle":   {"offset": 7,
+                        "entity": {"suffix": "cycle", "name": "Cycle Count", "state_class": "total_increasing"}},
+        },
+    },
+    "get_cells_voltage": {
+        "address": REG_CELLS_VOLTAGE, "count": "cells", "lane": 0, "safety": "telemetry",
+        "fields": {
+            "cells": {"offset": 0, "count": "cells",
+                      "entity": {"suffix": "cell_{n}", "name": "Cell {n}", "device_class": "voltage", "unit": "mV"}},
+        },
+    },
+    "get_temperature": {
+        "address": REG_TEMPERATURE, "count": "temperatures", "lane": 0, "safety": "telemetry",
+        "fields": {
+            "temps": {"offset": 0, "count": "temperatures", "raw_offset": -500, "divisor": 10,
+                      "entity": {"suffix": "temp_{n}", "name": "Temp {n}", "device_class": "temperature", "unit": "°C"}},
+        },
+    },
+    "get_extra_temperature": {
+        "address": REG_EXTRA_TEMPERATURE, "count": LEN_EXTRA_TEMPERATURE, "lane": 0, "safety": "telemetry",
+        "fields": {
+            "temp_mos": {"offset": 0, "raw_offset": -500, "divisor": 10,
+                         "entity": {"suffix": "temp_mos", "name": "T MOS", "device_class": "temperature", "unit": "°C"}},
+            "temp_env": {"offset": 1, "raw_offset": -500, "divisor": 10,
+                         "entity": {"suffix": "temp_env", "name": "T ENV", "device_class": "temperature", "unit": "°C"}},
+        },
+    },
+}
+
+# Sensors computed from decoded fields rather than read
+DERIVED_ENTITIES = {
+    "power": {"suffix": "power", "name": "Power", "device_class": "power", "unit": "W"},
+}
+
 # Inverter register addresses
 REG_INVERTER_PROTOCOL = 0x0020      # decimal register 32
 
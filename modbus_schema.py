@@ -0,0 +1,148 @@
+# modbus_schema.py
+
+import os
+import struct
+import importlib
+import importlib.util
+
+# Layout used when the configured battery_model is not in BATTERY_MODELS
+DEFAULT_MODEL_LAYOUT = {"cells": 16, "temperatures": 4}
+
+# RTU response header before the register data: slave id, function code, byte count
+HEADER_BYTES = 3
+
+_active = None
+
+
+def _builtin_registers():
+    """The modbus_registers shipped with the addon, even when an override shadows the name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "modbus_registers.py")
+    spec = importlib.util.spec_from_file_location("modbus_registers_builtin", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CompiledSchema:
+    """
+    REGISTER_SCHEMA from modbus_registers resolved for one battery model.
+
+    Everything the polling loop needs is derived here once: register blocks
+    and lanes for the queries, one struct decoder per block, and the ordered
+    MQTT sensor entries per battery.
+    """
+    def __init__(self, modbus_registers, model: str):
+        if getattr(modbus_registers, "REGISTER_SCHEMA", None) is None:
+            print("[WARN] modbus_registers override has no REGISTER_SCHEMA, using the built-in telemetry schema")
+            modbus_registers = _builtin_registers()
+        schema = modbus_registers.REGISTER_SCHEMA
+        models = getattr(modbus_registers, "BATTERY_MODELS", {})
+        self.model = model
+        self.layout = dict(models.get(model, DEFAULT_MODEL_LAYOUT))
+
+        self.blocks = {}            # query name -> (address, count)
+        self.intervals = {}         # query name -> poll interval in seconds
+        self.frame_lengths = {}     # query name -> expected response length in bytes
+        self.field_counts = {}      # field name -> number of values
+        self._decoders = {}         # query name -> decode(frame) -> {field: value}
+        self.entities = {}          # field name -> entity description
+        for key, block in schema.items():
+            if block.get("safety", "telemetry") != "telemetry":
+                continue
+            count = self._resolve(block["count"])
+            self.blocks[key] = (block["address"], count)
+            self.intervals[key] = block.get("lane", 0)
+            self.frame_lengths[key] = HEADER_BYTES + 2 * count + 2
+            self._decoders[key] = self._compile_block(key, count, block["fields"])
+            for name, field in block["fields"].items():
+                self.field_counts[name] = self._resolve(field.get("count", 1))
+                if "entity" in field:
+                    self.entities[name] = field["entity"]
+        self.entities.update(getattr(modbus_registers, "DERIVED_ENTITIES", {}))
+
+    def _resolve(self, count):
+        return self.layout[count] if isinstance(count, str) else count
+
+    def _compile_block(self, key, count, fields):
+        """Build one struct covering every field of the block (gaps skipped) and its converter."""
+        fmt = ">"
+        pos = 0                     # registers consumed by the struct so far
+        index = 0                   # position in the unpacked tuple
+        steps = []
+        for name, field in sorted(fields.items(), key=lambda kv: kv[1]["offset"]):
+            offset = field["offset"]
+            n = self._resolve(field.get("count", 1))
+            if offset < pos or offset + n > count:
+                raise ValueError(f"Schema field '{name}' does not fit block '{key}'")
+            if offset > pos:
+                fmt += f"{2 * (offset - pos)}x"
+            fmt += f"{n}{'h' if field.get('signed') else 'H'}"
+            raw_offset = field.get("raw_offset", 0)
+            divisor = field.get("divisor", 1)
+            steps.append((name, index, n, "count" in field, raw_offset, divisor))
+            pos = offset + n
+            index += n
+        decoder = struct.Struct(fmt)
+        length = HEADER_BYTES + 2 * count + 2
+
+        def decode(frame):
+            if frame is None or len(frame) != length:
+                return None
+            raw = decoder.unpack_from(frame, HEADER_BYTES)
+            values = {}
+            for name, start, n, is_array, raw_offset, divisor in steps:
+                if is_array:
+                    part = raw[start:start + n]
+                    if divisor != 1:
+                        values[name] = [(v + raw_offset) / divisor for v in part]
+                    else:
+                        values[name] = [v + raw_offset for v in part] if raw_offset else list(part)
+                elif divisor != 1:
+                    values[name] = (raw[start] + raw_offset) / divisor
+                else:
+                    values[name] = raw[start] + raw_offset
+            return values
+
+        return decode
+
+    def decode(self, key, frame):
+        """
+        Decode a response frame of query key into {field: value}.
+
+        Returns:
+            dict or None: None if the query is unknown or the frame has the wrong length.
+        """
+        decoder = self._decoders.get(key)
+        return decoder(frame) if decoder else None
+
+    def entity_list(self, zero_pad_cells=False):
+        """
+        Ordered MQTT sensor entries of one battery.
+
+        Returns:
+            list of tuple: (field, position or None, suffix, entity) with '{n}' filled in.
+        """
+        result = []
+        for name, entity in self.entities.items():
+            if "{n}" not in entity["suffix"]:
+                result.append((name, None, entity["suffix"], entity))
+                continue
+            for n in range(1, self.field_counts.get(name, 1) + 1):
+                label = f"{n:02}" if zero_pad_cells and name == "cells" else str(n)
+                filled = dict(entity, suffix=entity["suffix"].format(n=label), name=entity["name"].format(n=label))
+                result.append((name, n - 1, filled["suffix"], filled))
+        return result
+
+
+def load(modbus_registers, model: str) -> CompiledSchema:
+    """Compile the schema for the configured battery model and make it the active one."""
+    global _active
+    _active = CompiledSchema(modbus_registers, model)
+    return _active
+
+
+def active_schema() -> CompiledSchema:
+    """The schema compiled at startup; compiled from modbus_registers (or its override) on first use otherwise."""
+    if _active is None:
+        load(importlib.import_module("modbus_registers"), None)
+    return _active
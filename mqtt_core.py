@@ -5,6 +5,11 @@ import time
 import sys
 import importlib
 import main_console
+from modbus_arbiter import PRIORITY_WRITE, PRIORITY_BACKGROUND
+from modbus_schema import active_schema
+from mqtt_discovery import registry as discovery
+from mqtt_deadband import change_filter
+from main_links import subscribe
 
 # --- Dynamic imports to support overrides like in main.py ---
 custom_dir = "/config/united_bms"
@@ -46,28 +51,109 @@ INVERTER_PROTOCOL_OBJECT_ID = main_settings.INVERTER_PROTOCOL_OBJECT_ID
 
 filter_temperature_spikes = parser_temperature.filter_temperature_spikes
 
-from main_arrays import (
-    last_valid_voltage,
-    last_valid_current,
-    last_valid_power,
-    last_valid_cycle_count,
-    last_valid_temps,
-    last_valid_extra,
-)
+from main_state import battery_store
 
 
-# --- Helper to publish a single sensor config & state ---
+# --- State format: one topic per sensor (default) or one JSON document per device (config state_json) ---
+json_state = False
+
+# Topic of the JSON state document, under the device's base topic
+STATE_DOCUMENT_SUFFIX = "state"
+
+
+def configure_state_documents(config: dict) -> bool:
+    """Select per-sensor state topics or one JSON state document per battery and ESS."""
+    global json_state
+    json_state = bool(config.get('state_json', False))
+    if json_state:
+        print("[INFO] Publishing one JSON state document per battery and ESS")
+    return json_state
+
+
+class StateDocument:
+    """
+    Retained JSON state of one device, fields keyed by entity suffix.
+
+    Sensors read their field with value_template '{{ value_json.<suffix> }}'.
+    set() only updates the field; flush() publishes the whole document once
+    per cycle if any field passed the change filter, so a device costs one
+    message instead of one per sensor. Fields not set in a cycle (slow lane
+    values, averages without enough readings) keep their last value; fields
+    never set are left out, so their entities stay as they were instead of
+    turning unknown.
+    """
+    def __init__(self, topic: str):
+        self.topic = topic
+        self.base = topic.rsplit('/', 1)[0]
+        self.values = {}
+        self.changed = False
+
+    def set(self, suffix, value, cfg=None):
+        self.values[suffix] = value
+        if change_filter().should_publish(f"{self.base}/{suffix}", value, cfg):
+            self.changed = True
+
+    def flush(self, client):
+        if self.changed:
+            client.publish(self.topic, json.dumps(self.values), retain=True)
+            self.changed = False
+
+
+_state_documents = {}
+
+
+def state_document(base) -> StateDocument:
+    doc = _state_documents.get(base)
+    if doc is None:
+        doc = _state_documents[base] = StateDocument(f"{base}/{STATE_DOCUMENT_SUFFIX}")
+    return doc
+
+
+def state_topic_and_template(base, suffix):
+    """Discovery state_topic and value_template of an entity for the selected state format."""
+    if json_state:
+        return f"{base}/{STATE_DOCUMENT_SUFFIX}", f"{{{{ value_json.{suffix} }}}}"
+    return f"{base}/{suffix}", '{{ value_json.state }}'
+
+
+# --- {"state": value} payloads without json.dumps for plain numbers ---
+_INT_STATE_CACHE_LIMIT = 8192      # cell mV, SOC, cycles: few distinct values, encoded once each
+_int_states = {}
+
+
+def encode_state(value) -> bytes:
+    """Same bytes as json.dumps({'state': value}).encode() for ints, finite floats and None."""
+    kind = type(value)
+    if kind is int:
+        payload = _int_states.get(value)
+        if payload is None:
+            payload = b'{"state": %d}' % value
+            if len(_int_states) < _INT_STATE_CACHE_LIMIT:
+                _int_states[value] = payload
+        return payload
+    if kind is float and value - value == 0.0:      # NaN / inf go through json for its spelling
+        return b'{"state": %r}' % value
+    if value is None:
+        return b'{"state": null}'
+    return json.dumps({'state': value}).encode()
+
+
+# --- Helper to publish a single sensor config (announced once) & state (on change) ---
 def publish_sensor(client, cfg_topic, state_topic, cfg_dict, value):
-    client.publish(cfg_topic, json.dumps(cfg_dict), retain=True)
-    client.publish(state_topic, json.dumps({'state': value}), retain=True)
+    discovery.announce(client, cfg_topic, cfg_dict)
+    if change_filter().should_publish(state_topic, value, cfg_dict):
+        client.publish(state_topic, encode_state(value), retain=True)
 
 
 # --- Delete only battery cell MQTT topics when zero_pad_cells changes ---
-def delete_battery_cell_topics_on_zeropad_change(client, num_batteries, zero_pad_cells, max_cells=16):
+def delete_battery_cell_topics_on_zeropad_change(client, num_batteries, zero_pad_cells, max_cells=None):
     """
     Publishes empty retained messages to delete cell topics that would change format
     if zero_pad_cells setting changes (e.g., cell_1 <-> cell_01).
+    max_cells defaults to the cell count of the configured battery model.
     """
+    if max_cells is None:
+        max_cells = active_schema().field_counts.get('cells', 16)
     for index in range(1, num_batteries + 1):
         base = BATTERY_BASE_TOPIC_TEMPLATE.format(index=index)
         for i in range(1, max_cells + 1):
@@ -76,12 +162,27 @@ def delete_battery_cell_topics_on_zeropad_change(client, num_batteries, zero_pad
             # If zero_pad_cells enabled, delete unpadded topics; else delete padded topics
             cell_id = cell_id_unpadded if zero_pad_cells else cell_id_padded
 
-            client.publish(f"{base}/cell_{cell_id}/config", "", retain=True)
+            discovery.remove(client, f"{base}/cell_{cell_id}/config")
             client.publish(f"{base}/cell_{cell_id}", "", retain=True)
 
 
-# --- Batteries MQTT sensors publisher ---
-def publish_sensors(client, index, data, mos_temp, env_temp, model, zero_pad_cells=False):
+# --- Battery sensor discovery configs, built once per battery from the register schema ---
+_battery_sensor_tables = {}
+
+
+def battery_sensor_table(index, model, zero_pad_cells=False):
+    """
+    Discovery configs of battery index for every entity in the register schema.
+
+    Returns:
+        tuple: ({suffix: (cfg_topic, state_topic, cfg)}, {field: [suffix, ...]})
+               where the second dict lists the suffixes of array fields (cells, temps) by position.
+    """
+    key = (index, model, zero_pad_cells, json_state)
+    table = _battery_sensor_tables.get(key)
+    if table is not None:
+        return table
+
     base = BATTERY_BASE_TOPIC_TEMPLATE.format(index=index)
     device_info = {
         'identifiers': [id_.format(index=index) for id_ in BATTERY_DEVICE_IDENTIFIERS_TEMPLATE],
@@ -89,118 +190,149 @@ def publish_sensors(client, index, data, mos_temp, env_temp, model, zero_pad_cel
         'model': model,
         'manufacturer': MANUFACTURER
     }
-
-    def pub(suffix, name, dev_class, unit, value, state_class=None):
-        cfg_topic = f"{base}/{suffix}/config"
-        state_topic = f"{base}/{suffix}"
+    configs = {}
+    arrays = {}
+    for field, pos, suffix, entity in active_schema().entity_list(zero_pad_cells):
+        state_topic, value_template = state_topic_and_template(base, suffix)
         cfg = {
-            'name': name,
+            'name': entity['name'],
             'state_topic': state_topic,
             'unique_id': BATTERY_UNIQUE_ID_TEMPLATE.format(index=index, suffix=suffix),
             'object_id': BATTERY_OBJECT_ID_TEMPLATE.format(index=index, suffix=suffix),
-            'device_class': dev_class,
-            'unit_of_measurement': unit,
-            'value_template': '{{ value_json.state }}',
+            'device_class': entity.get('device_class'),
+            'unit_of_measurement': entity.get('unit'),
+            'value_template': value_template,
             'device': device_info
         }
-        if state_class:
-            cfg['state_class'] = state_class
+        if entity.get('state_class'):
+            cfg['state_class'] = entity['state_class']
+        configs[suffix] = (sys.intern(f"{base}/{suffix}/config"), sys.intern(state_topic), cfg)
+        if pos is not None:
+            arrays.setdefault(field, []).append(suffix)
+
+    table = _battery_sensor_tables[key] = (configs, arrays)
+    return table
 
-        publish_sensor(client, cfg_topic, state_topic, cfg, value)
 
-    # Core sensors with caching fallback
+# --- Batteries MQTT sensors publisher ---
+def publish_sensors(client, index, data, mos_temp, env_temp, model, zero_pad_cells=False):
+    configs, arrays = battery_sensor_table(index, model, zero_pad_cells)
+    doc = state_document(BATTERY_BASE_TOPIC_TEMPLATE.format(index=index)) if json_state else None
+
+    def pub(suffix, value):
+        entry = configs.get(suffix)
+        if entry is None:
+            return  # Entity not in the register schema
+        cfg_topic, state_topic, cfg = entry
+        if doc is None:
+            publish_sensor(client, cfg_topic, state_topic, cfg, value)
+        else:
+            discovery.announce(client, cfg_topic, cfg)
+            doc.set(suffix, value, cfg)
+
+    # Core sensors, falling back to the last valid values the parser stored in the battery state
+    state = battery_store().get(index)
     voltage = data['voltage']
-    if voltage is not None and volt_min_limit <= voltage <= volt_max_limit:
-        last_valid_voltage[index] = voltage
-    elif index in last_valid_voltage:
-        voltage = last_valid_voltage[index]
+    if (voltage is None or not volt_min_limit <= voltage <= volt_max_limit) and state.voltage is not None:
+        voltage = state.voltage
 
     current = data['current']
-    if current is not None:
-        last_valid_current[index] = current
-    elif index in last_valid_current:
-        current = last_valid_current[index]
+    if current is None:
+        current = state.current
 
     power = data['power']
-    if power is not None:
-        last_valid_power[index] = power
-    elif index in last_valid_power:
-        power = last_valid_power[index]
+    if power is None:
+        power = state.power
 
-    pub('voltage', 'Voltage', 'voltage', 'V', voltage)
-    pub('soc', 'SOC', 'battery', '%', data['soc'])
-    pub('current', 'Current', 'current', 'A', current)
-    pub('power', 'Power', 'power', 'W', power)
+    pub('voltage', voltage)
+    pub('soc', data['soc'])
+    pub('current', current)
+    pub('power', power)
 
     cycle = data['cycle']
-    if isinstance(cycle, int):
-        last_valid_cycle_count[index] = cycle
-        pub('cycle', 'Cycle Count', None, None, cycle, state_class='total_increasing')
-    elif index in last_valid_cycle_count:
-        pub('cycle', 'Cycle Count', None, None, last_valid_cycle_count[index], state_class='total_increasing')
+    if not isinstance(cycle, int):
+        cycle = state.cycle
+    if cycle is not None:
+        pub('cycle', cycle)
 
-    # Cell voltages
+    # Cell voltages (robust-filtered by parser_battery when spike_filter selects median / hampel)
     if data['cells']:
-        for i, v in enumerate(data['cells'], start=1):
-            cell_id = f'{i:02}' if zero_pad_cells else str(i)
-            pub(f'cell_{cell_id}', f'Cell {cell_id}', 'voltage', 'mV', v)
+        for suffix, v in zip(arrays.get('cells', ()), data['cells']):
+            pub(suffix, v)
 
-    # Temperatures with spike filtering and caching
+    # Temperatures, spike-filtered and cached by parser_battery
     if data['temps']:
-        last_temps = last_valid_temps.get(index, [])
-        valid_temps = filter_temperature_spikes(
-            data['temps'],
-            last_temps,
-            main_settings.temp_min_limit,
-            main_settings.temp_max_limit,
-            delta_limit=10
-        )
-        last_valid_temps[index] = valid_temps
-        for i, t in enumerate(valid_temps, start=1):
-            pub(f'temp_{i}', f'Temp {i}', 'temperature', '°C', t)
+        for suffix, t in zip(arrays.get('temps', ()), data['temps']):
+            pub(suffix, t)
+    if mos_temp is not None:
+        pub('temp_mos', mos_temp)
+    if env_temp is not None:
+        pub('temp_env', env_temp)
 
-    last_mos, last_env = last_valid_extra.get(index, (None, None))
+    discovery.flush(client)
+    if doc is not None:
+        doc.flush(client)
 
-    def within_delta(new, old, limit=10):
-        return old is None or abs(new - old) <= limit
 
-    if mos_temp is not None and within_delta(mos_temp, last_mos):
-        last_mos = mos_temp
-        pub('temp_mos', 'T MOS', 'temperature', '°C', mos_temp)
-    if env_temp is not None and within_delta(env_temp, last_env):
-        last_env = env_temp
-        pub('temp_env', 'T ENV', 'temperature', '°C', env_temp)
+# --- Summary Ritar ESS sensor discovery configs, built once per entity ---
+_ess_sensor_configs = {}
 
-    last_valid_extra[index] = (last_mos, last_env)
 
+def ess_sensor_config(suffix, name, dev_class, unit, state_class=None):
+    """
+    Returns:
+        tuple: (cfg_topic, state_topic, cfg) of a Ritar ESS summary sensor.
+    """
+    entry = _ess_sensor_configs.get((suffix, json_state))
+    if entry is not None:
+        return entry
 
-# --- Summary Ritar ESS MQTT sensors publisher ---
-def publish_summary_sensors(client, soc_avg, volt_avg, current_sum, power_sum, mos_avg=None, env_avg=None):
     base = ESS_BASE_TOPIC
-    device_info = {
-        'identifiers': ESS_DEVICE_IDENTIFIERS,
-        'name': ESS_DEVICE_NAME,
-        'model': ESS_DEVICE_MODEL,
-        'manufacturer': MANUFACTURER
+    state_topic, value_template = state_topic_and_template(base, suffix)
+    cfg = {
+        'name': name,
+        'state_topic': state_topic,
+        'unique_id': ESS_UNIQUE_ID_TEMPLATE.format(suffix=suffix),
+        'object_id': ESS_OBJECT_ID_TEMPLATE.format(suffix=suffix),
+        'device_class': dev_class,
+        'unit_of_measurement': unit,
+        'value_template': value_template,
+        'device': {
+            'identifiers': ESS_DEVICE_IDENTIFIERS,
+            'name': ESS_DEVICE_NAME,
+            'model': ESS_DEVICE_MODEL,
+            'manufacturer': MANUFACTURER
+        }
     }
+    if state_class:
+        cfg['state_class'] = state_class
+
+    entry = _ess_sensor_configs[(suffix, json_state)] = (f"{base}/{suffix}/config", state_topic, cfg)
+    return entry
+
+
+# --- Summary Ritar ESS MQTT sensors publisher ---
+def _ess_publisher(client):
+    """
+    Returns:
+        tuple: (pub(suffix, name, dev_class, unit, value, state_class=None), JSON state document or None)
+    """
+    doc = state_document(ESS_BASE_TOPIC) if json_state else None
 
     def pub(suffix, name, dev_class, unit, value, state_class=None):
-        cfg_topic = f"{base}/{suffix}/config"
-        state_topic = f"{base}/{suffix}"
-        cfg = {
-            'name': name,
-            'state_topic': state_topic,
-            'unique_id': ESS_UNIQUE_ID_TEMPLATE.format(suffix=suffix),
-            'object_id': ESS_OBJECT_ID_TEMPLATE.format(suffix=suffix),
-            'device_class': dev_class,
-            'unit_of_measurement': unit,
-            'value_template': '{{ value_json.state }}',
-            'device': device_info
-        }
-        if state_class:
-            cfg['state_class'] = state_class
+        cfg_topic, state_topic, cfg = ess_sensor_config(suffix, name, dev_class, unit, state_class)
+        if doc is None:
+            publish_sensor(client, cfg_topic, state_topic, cfg, value)
+        else:
+            discovery.announce(client, cfg_topic, cfg)
+            doc.set(suffix, value, cfg)
+
+    return pub, doc
+
 
-        publish_sensor(client, cfg_topic, state_topic, cfg, value)
+def publish_summary_sensors(client, soc_avg, volt_avg, current_sum, power_sum, mos_avg=None, env_avg=None, links=()):
+    """ESS summary sensors, and the link sensors of links (main_links.LinkState) in the same state document."""
+    pub, doc = _ess_publisher(client)
 
     if soc_avg is not None:
         pub('soc_avg', 'SOC Average', 'battery', '%', soc_avg, state_class='measurement')
@@ -213,10 +345,43 @@ def publish_summary_sensors(client, soc_avg, volt_avg, current_sum, power_sum, m
 
     pub('current_total', 'Total Current', 'current', 'A', round(current_sum, 2), state_class='measurement')
     pub('power_total', 'Total Power', 'power', 'W', round(power_sum, 2), state_class='measurement')
+    _publish_links(pub, links)
+
+    discovery.flush(client)
+    if doc is not None:
+        doc.flush(client)
+
+
+# --- Gateway / MQTT link sensors on the Ritar ESS device ---
+def _publish_links(pub, links):
+    for link in links:
+        key = link.name.lower()
+        pub(f"{key}_uptime", f"{link.name} Uptime", 'duration', 's', round(link.uptime()), state_class='measurement')
+        pub(f"{key}_reconnects", f"{link.name} Reconnects", None, None, link.reconnects, state_class='total_increasing')
+
+
+def publish_link_sensors(client, links):
+    """
+    Uptime and reconnect counter of each main_links.LinkState (gateway, MQTT), on
+    their own for cycles without a summary (gateway down); publish_summary_sensors
+    takes them otherwise, so the ESS state document goes out once per cycle.
+    """
+    pub, doc = _ess_publisher(client)
+    _publish_links(pub, links)
+
+    discovery.flush(client)
+    if doc is not None:
+        doc.flush(client)
 
 
 # --- Batteries inverter protocol MQTT publisher ---
-def publish_inverter_protocol(client, gateway, battery_ids, modbus_registers, on_write=None):
+def publish_inverter_protocol_config(client):
+    """
+    Publish the inverter protocol select entity config.
+
+    Returns:
+        tuple: (state topic, command topic)
+    """
     base = INVERTER_PROTOCOL_BASE_TOPIC
     device_info = {
         'identifiers': ESS_DEVICE_IDENTIFIERS,
@@ -239,7 +404,34 @@ def publish_inverter_protocol(client, gateway, battery_ids, modbus_registers, on
         "device": device_info
     }
 
-    client.publish(topic_cfg, json.dumps(cfg), retain=True)
+    discovery.announce(client, topic_cfg, cfg)
+    discovery.flush(client)
+    return topic_state, topic_cmd
+
+
+def publish_inverter_protocol_state(client, topic_state, types, warn=False):
+    """Publish the common inverter protocol of all batteries, or Unknown if they differ or none was read."""
+    if types:
+        common = types[0]
+        if all(t == common for t in types):
+            client.publish(topic_state, json.dumps({"state": INVERTER_PROTOCOLS.get(common, "Unknown")}), retain=True)
+            return
+        if warn:
+            print("Mixed inverter protocols detected among batteries !!! SET INVERTER PROTOCOL IN MQTT **RITAR ESS** DEVICE !!!")
+    elif warn:
+        print("[WARN] No inverter protocols read from any batteries")
+    client.publish(topic_state, json.dumps({"state": "Unknown"}), retain=True)
+
+
+def publish_inverter_protocol(client, gateway, battery_ids, modbus_registers, on_write=None, arbiter=None):
+    """
+    Publish the inverter protocol select entity and handle its commands.
+
+    With a modbus_arbiter.BusArbiter, the MQTT handler only queues the write
+    (and a lower priority confirmation read) and returns; the polling thread
+    runs them on the gateway. Without one, the handler talks to the gateway itself.
+    """
+    topic_state, topic_cmd = publish_inverter_protocol_config(client)
 
     types = []
     for bat in battery_ids:
@@ -250,55 +442,51 @@ def publish_inverter_protocol(client, gateway, battery_ids, modbus_registers, on
             print(f"[WARN] No inverter protocol read from battery {bat}")
         time.sleep(0.5)
 
-    if types:
-        common = types[0]
-        if all(t == common for t in types):
-            client.publish(topic_state, json.dumps({"state": INVERTER_PROTOCOLS.get(common, "Unknown")}), retain=True)
-        else:
-            print("Mixed inverter protocols detected among batteries !!! SET INVERTER PROTOCOL IN MQTT **RITAR ESS** DEVICE !!!")
-            client.publish(topic_state, json.dumps({"state": "Unknown"}), retain=True)
-    else:
-        print("[WARN] No inverter protocols read from any batteries")
-        client.publish(topic_state, json.dumps({"state": "Unknown"}), retain=True)
+    publish_inverter_protocol_state(client, topic_state, types, warn=True)
+
+    def write_protocol(gateway, payload, value):
+        for bat in battery_ids:
+            write_inverter_protocol(gateway, bat, value, modbus_registers, on_write=on_write)
+            time.sleep(2)
+        client.publish(topic_state, json.dumps({"state": payload}), retain=True)
+        print("[INFO] Please wait result confirmation...")
+
+    def confirm_protocol(gateway):
+        updated_protocols = read_all_inverter_protocols(client, gateway, battery_ids, modbus_registers)
+        main_console.print_inverter_protocols_table_batteries(updated_protocols)
+        # Report what the batteries actually use now
+        publish_inverter_protocol_state(client, topic_state, [val for _, val, _ in updated_protocols if val is not None])
+        print("[INFO] Next change available after 10 seconds !")
+        print("-" * 112)
 
     def on_message(client, userdata, msg):
         payload = msg.payload.decode().strip()
         value = INVERTER_PROTOCOLS_REVERSE.get(payload)
-        if value is not None:
-            print(f"[MQTT] Changing inverter protocol to: {payload} ({value})")
-            if on_write:
-                on_write()
-            for bat in battery_ids:
-                write_inverter_protocol(gateway, bat, value, modbus_registers, on_write=on_write)
-                time.sleep(2)
-            client.publish(topic_state, json.dumps({"state": payload}), retain=True)
-
-            print("[INFO] Please wait result confirmation...")
-            updated_protocols = read_all_inverter_protocols(client, gateway, battery_ids, modbus_registers)
-            main_console.print_inverter_protocols_table_batteries(updated_protocols)
-            print("[INFO] Next change available after 10 seconds !")
-        else:
+        if value is None:
             print(f"[WARN] Unknown inverter protocol: {payload}")
-        print("-" * 112)
-
-    client.message_callback_add(topic_cmd, on_message)
-    client.subscribe(topic_cmd)
-
-    def refresh():
+            print("-" * 112)
+            return
+        print(f"[MQTT] Changing inverter protocol to: {payload} ({value})")
+        if on_write:
+            on_write()
+        if arbiter is None:
+            write_protocol(gateway, payload, value)
+            confirm_protocol(gateway)
+            return
+        arbiter.submit(lambda gw: write_protocol(gw, payload, value),
+                       PRIORITY_WRITE, "inverter protocol write")
+        arbiter.submit(confirm_protocol, PRIORITY_BACKGROUND, "inverter protocol confirm")
+
+    subscribe(client, topic_cmd, on_message)
+
+    def refresh(gateway=gateway):
         types = []
         for bat in battery_ids:
             val = read_inverter_protocol(gateway, bat, modbus_registers)
             if val is not None:
                 types.append(val)
             time.sleep(0.5)
-        if types:
-            common = types[0]
-            if all(t == common for t in types):
-                client.publish(topic_state, json.dumps({"state": INVERTER_PROTOCOLS.get(common, "Unknown")}), retain=True)
-            else:
-                client.publish(topic_state, json.dumps({"state": "Unknown"}), retain=True)
-        else:
-            client.publish(topic_state, json.dumps({"state": "Unknown"}), retain=True)
+        publish_inverter_protocol_state(client, topic_state, types)
 
     return refresh
 
@@ -342,8 +530,9 @@ def publish_mqtt_delete(client, label_keys):
     base = ESS_BASE_TOPIC
     for key in label_keys:
         key_clean = key.lower().replace(" ", "_").replace("(", "").replace(")", "").replace("%", "pct")
-        topic = f"{base}/x_{key_clean}/config"
-        client.publish(topic, "", retain=True)
+        discovery.remove(client, f"{base}/x_{key_clean}/config")
+        change_filter().forget(f"{base}/x_{key_clean}")
+    discovery.flush(client)
 
 
 # --- BMS EEPROM preset values MQTT Publisher ---
@@ -376,11 +565,13 @@ def publish_presets_in_ritar_device(client, preset: dict):
         if device_class:
             cfg['device_class'] = device_class
 
-        client.publish(cfg_topic, json.dumps(cfg), retain=True)
-        client.publish(state_topic, json.dumps({'state': formatted_value}), retain=True)  # numeric value!
+        discovery.announce(client, cfg_topic, cfg)
+        if change_filter().should_publish(state_topic, formatted_value, cfg):
+            client.publish(state_topic, encode_state(formatted_value), retain=True)  # numeric value!
 
     for label, value in preset.items():
         if value is None:
             continue
         key = label.lower().replace(" ", "_").replace("(", "").replace(")", "").replace("%", "pct")
         pub(key, label, value)
+    discovery.flush(client)
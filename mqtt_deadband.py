@@ -0,0 +1,113 @@
+# mqtt_deadband.py
+
+import time
+
+# Seconds after which an unchanged value is published anyway, so Home
+# Assistant sees the sensor alive (config publish_heartbeat)
+DEFAULT_HEARTBEAT = 300
+
+# Largest change that is not published, by device class or "device_class:unit"
+# (the unit-specific key wins). Classes not listed only skip identical values.
+# main_settings.PUBLISH_DEADBANDS replaces this table.
+DEFAULT_DEADBANDS = {
+    'voltage:mV': 2,        # cells
+    'voltage': 0.01,
+    'current': 0.1,
+    'power': 5,
+    'battery': 0.1,         # SOC %
+    'temperature': 0.1,
+    'duration': 60,         # link uptime
+}
+
+# Float readings are scaled from integers, so 0.1 °C may come out as 0.10000000000000142
+EPSILON = 1e-9
+
+_filter = None
+
+
+class ChangeFilter:
+    """
+    Last published value and time per state topic.
+
+    should_publish() lets a value through when it moved more than the
+    deadband of its entity since the last published value, when it is not a
+    number and differs, or when the topic was last published heartbeat
+    seconds ago or more. Comparing with the last published value (not the
+    last reading) means a slow drift is still published once it adds up to
+    more than the deadband.
+    """
+    def __init__(self, deadbands: dict = None, heartbeat: float = DEFAULT_HEARTBEAT, enabled: bool = True):
+        self.deadbands = DEFAULT_DEADBANDS if deadbands is None else dict(deadbands)
+        self.heartbeat = heartbeat
+        self.enabled = enabled
+        self._last = {}         # state topic -> (value, monotonic time published)
+        self._topic_deadband = {}
+
+        # Counters
+        self.published = 0
+        self.suppressed = 0
+
+    def deadband(self, device_class=None, unit=None):
+        if device_class is None:
+            return 0
+        return self.deadbands.get(f"{device_class}:{unit}", self.deadbands.get(device_class, 0))
+
+    def _deadband_of(self, topic, cfg):
+        db = self._topic_deadband.get(topic)
+        if db is None:
+            db = 0 if cfg is None else self.deadband(cfg.get('device_class'), cfg.get('unit_of_measurement'))
+            self._topic_deadband[topic] = db
+        return db
+
+    def should_publish(self, topic: str, value, cfg: dict = None) -> bool:
+        """True if value is to be published on topic; cfg is the entity's discovery config (deadband lookup)."""
+        if not self.enabled:
+            self.published += 1
+            return True
+        now = time.monotonic()
+        last = self._last.get(topic)
+        if last is not None:
+            old, stamp = last
+            if now - stamp < self.heartbeat:
+                if old == value:
+                    self.suppressed += 1
+                    return False
+                if (isinstance(value, (int, float)) and isinstance(old, (int, float))
+                        and not isinstance(value, bool)
+                        and abs(value - old) <= self._deadband_of(topic, cfg) + EPSILON):
+                    self.suppressed += 1
+                    return False
+        self._last[topic] = (value, now)
+        self.published += 1
+        return True
+
+    def forget(self, topic: str):
+        """Publish the next value of topic whatever it is (topic deleted or state lost)."""
+        self._last.pop(topic, None)
+
+    def summary(self) -> str:
+        total = self.published + self.suppressed
+        share = 100.0 * self.suppressed / total if total else 0.0
+        return (f"State publishes: {self.published} sent, {self.suppressed} unchanged within deadband "
+                f"skipped ({share:.0f}%), heartbeat {self.heartbeat}s")
+
+
+def configure(config: dict, deadbands: dict = None) -> ChangeFilter:
+    """Create the shared change filter from config (publish_on_change, publish_heartbeat)."""
+    global _filter
+    _filter = ChangeFilter(
+        deadbands,
+        config.get('publish_heartbeat', DEFAULT_HEARTBEAT),
+        config.get('publish_on_change', True),
+    )
+    if _filter.enabled:
+        print(f"[INFO] Publishing on change, heartbeat every {_filter.heartbeat}s")
+    return _filter
+
+
+def change_filter() -> ChangeFilter:
+    """The change filter configured at startup; defaults otherwise."""
+    global _filter
+    if _filter is None:
+        _filter = ChangeFilter()
+    return _filter
@@ -0,0 +1,283 @@
+# mqtt_discovery.py
+
+import os
+import json
+import threading
+
+from main_links import subscribe
+
+# Home Assistant birth / last will topic ("online" after every HA start)
+HA_STATUS_TOPIC = "homeassistant/status"
+
+# === Discovery modes (config discovery_mode) ===
+# entity: one retained config per entity, <prefix>/<platform>/<node>/<object>/config
+# device: one retained config per device, <prefix>/device/<device id>/config,
+#         listing every entity as a component (Home Assistant 2024.11 and later)
+DISCOVERY_MODES = ('entity', 'device')
+
+# Mode of the previous run, so configs are migrated only when the mode changed
+MODE_PATH = "/data/discovery_mode"
+
+# Abbreviated keys of device payloads
+ABBREVIATIONS = {
+    'state_topic': 'stat_t',
+    'command_topic': 'cmd_t',
+    'unique_id': 'uniq_id',
+    'object_id': 'obj_id',
+    'device_class': 'dev_cla',
+    'unit_of_measurement': 'unit_of_meas',
+    'value_template': 'val_tpl',
+    'state_class': 'stat_cla',
+    'options': 'ops',
+}
+DEVICE_ABBREVIATIONS = {
+    'identifiers': 'ids',
+    'manufacturer': 'mf',
+    'model': 'mdl',
+}
+ORIGIN = {'name': "Ritar BMS"}
+
+
+def _compact(cfg: dict, abbreviations: dict) -> dict:
+    """cfg with abbreviated keys, without the options left unset."""
+    return {abbreviations.get(k, k): v for k, v in cfg.items() if v is not None}
+
+
+def _topic_parts(cfg_topic: str):
+    """(prefix, platform, node, component key) of <prefix>/<platform>/<node>/.../<object>/config."""
+    parts = cfg_topic.split('/')
+    return parts[0], parts[1], parts[2], parts[-2]
+
+
+class DiscoveryRegistry:
+    """
+    Home Assistant discovery configs announced by this addon, by config topic.
+
+    announce() publishes a config the first time and again only when its
+    content changed; the unchanged config of an entity costs a dict identity
+    check (configs built once and reused) or a string compare, never a
+    retained publish. When Home Assistant comes back online (birth message on
+    homeassistant/status) every known config is published again, so steady
+    state traffic is state messages only.
+
+    In 'device' mode announce() files the entity as a component of its
+    device instead, keyed by its object id, and flush() publishes one
+    compact payload per device whose components changed: a battery with
+    its 27 entities, or the ESS with all presets, is one retained message.
+    Switching modes is detected from MODE_PATH: entity configs are handed
+    over with migrate_discovery and then cleared, or the device payloads of
+    the previous run are cleared, so Home Assistant keeps the entities.
+    """
+    def __init__(self):
+        self.mode = 'entity'
+        self.migrate = False        # the previous run used the other mode
+        self._payloads = {}         # config topic -> JSON announced, encoded once
+        self._objects = {}          # config topic -> dict it was built from
+        self._lock = threading.Lock()
+
+        # Device mode
+        self._devices = {}          # device id -> {'topic', 'dev', 'cmps': {key: component}}
+        self._nodes = {}            # node id of the entity topics -> device id
+        self._removals = []         # entity config topics to remove from their device
+        self._dirty = set()         # device ids to publish on the next flush()
+        self._legacy = []           # entity config topics to clear after the next flush()
+        self._handled = set()       # entity topics migrated, device ids cleared
+
+        # Counters
+        self.announced = 0
+        self.suppressed = 0
+        self.reannounced = 0
+        self.births = 0
+
+    def configure(self, config: dict, path: str = MODE_PATH) -> str:
+        """Select the discovery mode (discovery_mode) and compare it with the previous run's."""
+        mode = config.get('discovery_mode', 'entity')
+        if mode not in DISCOVERY_MODES:
+            print(f"[WARN] Unknown discovery_mode '{mode}', using 'entity'")
+            mode = 'entity'
+        self.mode = mode
+        try:
+            with open(path) as f:
+                previous = f.read().strip()
+        except OSError:
+            previous = 'entity'     # the only mode before discovery_mode existed
+        self.migrate = previous != mode
+        try:
+            with open(path, 'w') as f:
+                f.write(mode)
+        except OSError as e:
+            print(f"[WARN] Could not store discovery mode in {path}: {e}")
+        if mode == 'device':
+            print(f"[INFO] Home Assistant discovery: one config per device"
+                  f"{', migrating entity configs' if self.migrate else ''}")
+        return mode
+
+    def announce(self, client, cfg_topic: str, cfg) -> bool:
+        """
+        Publish a discovery config (dict, JSON string or bytes) unless this exact config is already announced.
+
+        Returns:
+            bool: True if it was published (device mode: filed for the next flush()).
+        """
+        if isinstance(cfg, dict) and 'device' in cfg:
+            if self.mode == 'device':
+                return self._file_component(client, cfg_topic, cfg)
+            if self.migrate:
+                self._clear_device(client, cfg_topic, cfg)
+        with self._lock:
+            if self._objects.get(cfg_topic) is cfg:
+                self.suppressed += 1
+                return False
+            payload = cfg if isinstance(cfg, bytes) else (cfg if isinstance(cfg, str) else json.dumps(cfg)).encode()
+            if self._payloads.get(cfg_topic) == payload:
+                self._objects[cfg_topic] = cfg
+                self.suppressed += 1
+                return False
+            self._payloads[cfg_topic] = payload
+            self._objects[cfg_topic] = cfg
+            self.announced += 1
+        client.publish(cfg_topic, payload, retain=True)
+        return True
+
+    # --- Device mode ---
+    def _file_component(self, client, cfg_topic, cfg) -> bool:
+        prefix, platform, node, key = _topic_parts(cfg_topic)
+        migrate = False
+        with self._lock:
+            if self._objects.get(cfg_topic) is cfg:
+                self.suppressed += 1
+                return False
+            self._objects[cfg_topic] = cfg
+            ids = cfg['device'].get('identifiers')
+            device_id = ids[0] if isinstance(ids, (list, tuple)) else ids
+            device = self._devices.get(device_id)
+            if device is None:
+                device = self._devices[device_id] = {
+                    'topic': f"{prefix}/device/{device_id}/config",
+                    'dev': _compact(cfg['device'], DEVICE_ABBREVIATIONS),
+                    'cmps': {},
+                }
+            self._nodes[node] = device_id
+            component = _compact({k: v for k, v in cfg.items() if k != 'device'}, ABBREVIATIONS)
+            component['p'] = platform
+            if device['cmps'].get(key) == component:
+                self.suppressed += 1
+                return False
+            device['cmps'][key] = component
+            self._dirty.add(device_id)
+            if self.migrate and cfg_topic not in self._handled:
+                self._handled.add(cfg_topic)
+                self._legacy.append(cfg_topic)
+                migrate = True
+        if migrate:
+            # Home Assistant keeps the entity when its config is handed over instead of deleted
+            client.publish(cfg_topic, json.dumps({'migrate_discovery': True}), retain=True)
+        return True
+
+    def _resolve_removals(self):
+        """File removals of entities whose device is known by now: a component with its platform only."""
+        pending = []
+        for cfg_topic in self._removals:
+            if cfg_topic in self._objects:
+                continue    # announced again since
+            _, platform, node, key = _topic_parts(cfg_topic)
+            device_id = self._nodes.get(node)
+            if device_id is None:
+                pending.append(cfg_topic)
+                continue
+            self._devices[device_id]['cmps'][key] = {'p': platform}
+            self._dirty.add(device_id)
+        self._removals = pending
+
+    @staticmethod
+    def _device_payload(device) -> bytes:
+        cmps = device['cmps']
+        payload = {'dev': device['dev'], 'o': ORIGIN}
+        # state_json: every sensor reads the one state document, named once for the device
+        topics = {c.get('stat_t') for c in cmps.values() if len(c) > 1}
+        if len(topics) == 1 and None not in topics:
+            payload['stat_t'] = topics.pop()
+            cmps = {k: {n: v for n, v in c.items() if n != 'stat_t'} for k, c in cmps.items()}
+        payload['cmps'] = cmps
+        return json.dumps(payload, separators=(',', ':')).encode()
+
+    def flush(self, client) -> int:
+        """Device mode: publish the payload of every device with changed components; returns how many."""
+        if self.mode != 'device':
+            return 0
+        with self._lock:
+            if self._removals:
+                self._resolve_removals()
+            if not self._dirty:
+                return 0
+            messages = []
+            for device_id in self._dirty:
+                device = self._devices[device_id]
+                payload = self._device_payload(device)
+                # Removed components are announced once, then left out
+                device['cmps'] = {k: c for k, c in device['cmps'].items() if len(c) > 1}
+                if self._payloads.get(device['topic']) != payload:
+                    self._payloads[device['topic']] = payload
+                    messages.append((device['topic'], payload))
+                    self.announced += 1
+            self._dirty.clear()
+            legacy, self._legacy = self._legacy, []
+        for topic, payload in messages:
+            client.publish(topic, payload, retain=True)
+        for topic in legacy:
+            client.publish(topic, "", retain=True)
+        return len(messages)
+
+    def _clear_device(self, client, cfg_topic, cfg):
+        """Entity mode after a 'device' run: clear the device payload of cfg's device, once."""
+        ids = cfg['device'].get('identifiers')
+        device_id = ids[0] if isinstance(ids, (list, tuple)) else ids
+        with self._lock:
+            if device_id in self._handled:
+                return
+            self._handled.add(device_id)
+        client.publish(f"{_topic_parts(cfg_topic)[0]}/device/{device_id}/config", "", retain=True)
+
+    def remove(self, client, cfg_topic: str):
+        """Delete an entity (empty retained config) and forget it, so a later announce publishes again."""
+        with self._lock:
+            self._payloads.pop(cfg_topic, None)
+            self._objects.pop(cfg_topic, None)
+            if self.mode == 'device':
+                self._removals.append(cfg_topic)
+        client.publish(cfg_topic, "", retain=True)
+
+    def reannounce(self, client) -> int:
+        """Publish every known config again; returns how many."""
+        with self._lock:
+            items = list(self._payloads.items())
+            self.reannounced += len(items)
+        for cfg_topic, payload in items:
+            client.publish(cfg_topic, payload, retain=True)
+        return len(items)
+
+    def on_ha_status(self, client, userdata, msg):
+        """paho callback for homeassistant/status."""
+        if msg.payload.decode(errors='replace').strip().lower() != "online":
+            return
+        self.births += 1
+        count = self.reannounce(client)
+        print(f"[INFO] Home Assistant online, re-announced {count} discovery configs")
+
+    def subscribe(self, client):
+        """Listen for Home Assistant birth messages (renewed after MQTT reconnects)."""
+        subscribe(client, HA_STATUS_TOPIC, self.on_ha_status)
+
+    def summary(self) -> str:
+        if self.mode == 'device':
+            entities = sum(len(d['cmps']) for d in self._devices.values())
+            known = f"{len(self._devices)} devices with {entities} entities"
+        else:
+            known = f"{len(self._payloads)} entities"
+        return (f"Discovery: {known}, announced {self.announced}, "
+                f"unchanged skipped {self.suppressed}, re-announced {self.reannounced} "
+                f"after {self.births} HA restarts")
+
+
+# Shared by mqtt_core, modbus_eeprom and both engines
+registry = DiscoveryRegistry()
@@ -0,0 +1,196 @@
+# mqtt_publisher.py
+
+import time
+import threading
+from collections import deque
+
+# Messages kept while paho or the broker cannot take them (config publish_queue_size)
+DEFAULT_QUEUE_SIZE = 5000
+
+# Messages handed to paho per burst, and handed but not yet written to the socket
+BURST_SIZE = 200
+MAX_IN_FLIGHT = 500
+
+# Seconds between checks while waiting for the broker or for in-flight messages
+POLL_INTERVAL = 0.05
+
+# Seconds after which an unwritten message is counted lost (paho drops QoS 0
+# messages of a connection that went away without completing their info)
+IN_FLIGHT_TIMEOUT = 30.0
+
+
+class MqttPublisher:
+    """
+    Bounded publish queue between the addon and the paho client.
+
+    publish() only appends to a queue and returns, so the polling thread
+    never waits for the broker. A worker thread hands queued messages to
+    paho in bursts of BURST_SIZE while the client is connected and fewer
+    than MAX_IN_FLIGHT earlier messages are still unwritten, and follows
+    each MQTTMessageInfo until paho wrote it (publish latency).
+
+    Memory stays bounded: when the queue reaches maxsize it is coalesced to
+    the newest message per topic (every topic is a retained state or
+    config, so only the latest value matters); only if it is still full,
+    because there are more distinct topics than room, the oldest message is
+    dropped. Everything else (subscribe, callbacks, loop_stop) is passed
+    through to the wrapped client, so this can stand in for it.
+
+    With an mqtt_spool.MqttSpool, messages published while the client is
+    disconnected (and whatever was still queued, or left of a burst the
+    connection dropped under) go to the spool instead, stamped with their
+    publish time; after reconnecting the worker replays the spool before the
+    messages queued since, so older values never overwrite newer retained ones.
+    """
+    def __init__(self, client, maxsize: int = DEFAULT_QUEUE_SIZE, spool=None):
+        self._client = client
+        self.spool = spool
+        self.maxsize = max(1, int(maxsize))
+        self._queue = deque()           # (topic, payload, qos, retain, time queued)
+        self._in_flight = deque()       # (MQTTMessageInfo, time queued)
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+
+        # Counters
+        self.queued = 0
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lost = 0
+        self.max_depth = 0
+        self.max_in_flight = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Give the worker up to timeout to hand over what is queued, then end it."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queue and self._connected() and time.monotonic() < deadline:
+                self._cond.wait(POLL_INTERVAL)
+            self._running = False
+            self._cond.notify()
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+
+    # --- Producer side (any thread) ---
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.spool is not None and not self._connected():
+            with self._cond:
+                self._spool_queue()
+                self.spool.append(topic, payload, retain)
+            return
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                self._coalesce()
+            queue = self._queue
+            if len(queue) >= self.maxsize:
+                queue.popleft()
+                self.dropped += 1
+            queue.append((topic, payload, qos, retain, time.monotonic()))
+            self.queued += 1
+            self.max_depth = max(self.max_depth, len(queue))
+            self._cond.notify()
+
+    def _spool_queue(self):
+        """Move everything queued to the spool, stamped with the time it was published (lock held)."""
+        queue = self._queue
+        offset = time.time() - time.monotonic()
+        while queue:
+            topic, payload, _, retain, queued = queue.popleft()
+            self.spool.append(topic, payload, retain, queued + offset)
+
+    def _coalesce(self):
+        """Keep the newest message per topic, in the order topics were first queued."""
+        latest = {}
+        for message in self._queue:
+            latest[message[0]] = message
+        self.coalesced += len(self._queue) - len(latest)
+        self._queue = deque(latest.values())
+
+    # --- Worker ---
+    def _connected(self) -> bool:
+        is_connected = getattr(self._client, 'is_connected', None)
+        return is_connected() if is_connected else True
+
+    def _collect_published(self):
+        in_flight = self._in_flight
+        now = time.monotonic()
+        while in_flight:
+            info, queued = in_flight[0]
+            latency = now - queued
+            if info.is_published():
+                self.published += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            elif latency > IN_FLIGHT_TIMEOUT:
+                self.lost += 1
+            else:
+                break
+            in_flight.popleft()
+
+    def _take_burst(self):
+        with self._cond:
+            while self._running and not (self._queue and self._connected()
+                                         and len(self._in_flight) < MAX_IN_FLIGHT):
+                self._cond.wait(POLL_INTERVAL)
+                self._collect_published()
+            burst = []
+            queue = self._queue
+            while queue and len(burst) < BURST_SIZE:
+                burst.append(queue.popleft())
+            return burst
+
+    def _run(self):
+        while self._running:
+            burst = self._take_burst()
+            if self.spool is not None and self.spool.pending() and self._connected():
+                self.spool.replay(self._client, self._connected)
+            for n, (topic, payload, qos, retain, queued) in enumerate(burst):
+                info = self._client.publish(topic, payload, qos=qos, retain=retain)
+                if info.rc != 0:
+                    # Connection lost mid-burst: put the rest back for the next connection. With a
+                    # spool it goes there with its publish time, as publish() does with the queue,
+                    # so the replay never lets it overwrite newer messages spooled meanwhile
+                    with self._cond:
+                        self._queue.extendleft(reversed(burst[n:]))
+                        if self.spool is not None:
+                            self._spool_queue()
+                        self.failed += 1
+                    time.sleep(POLL_INTERVAL)
+                    break
+                self._in_flight.append((info, queued))
+            self.max_in_flight = max(self.max_in_flight, len(self._in_flight))
+            self._collect_published()
+
+    def stats(self) -> dict:
+        done = self.published or 1
+        return {
+            'depth': len(self._queue),
+            'max_depth': self.max_depth,
+            'in_flight': len(self._in_flight),
+            'max_in_flight': self.max_in_flight,
+            'queued': self.queued,
+            'published': self.published,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'lost': self.lost,
+            'avg_latency': self.total_latency / done,
+            'max_latency': self.max_latency,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (f"MQTT publisher: queue {s['depth']} (max {s['max_depth']} of {self.maxsize}), "
+                f"in flight {s['in_flight']} (max {s['max_in_flight']}), published {s['published']}, "
+                f"latency avg {s['avg_latency'] * 1000:.1f}ms max {s['max_latency'] * 1000:.1f}ms, "
+                f"coalesced {s['coalesced']}, dropped {s['dropped']}, refused {s['failed']}, lost {s['lost']}")
@@ -0,0 +1,209 @@
+# mqtt_spool.py
+
+import os
+import json
+import time
+import threading
+
+# Spool segments under the addon's persistent /data (kept across addon restarts)
+SPOOL_PATH = "/data/mqtt_spool"
+
+# Limits (config mqtt_spool_max_mb, mqtt_spool_max_age in seconds)
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_AGE = 24 * 3600
+
+# Replay after reconnect (config mqtt_spool_replay, mqtt_spool_rate in messages per second)
+REPLAY_MODES = ('latest', 'history')
+DEFAULT_REPLAY_RATE = 100
+
+# Non-retained time series topic of the history replay mode
+HISTORY_TOPIC = "ritar_bms/history"
+
+
+class MqttSpool:
+    """
+    Append-only spool of the messages published while the broker is unreachable.
+
+    One line per message (time, flags, topic, payload; payloads are JSON
+    without raw tabs or newlines) in two segments: when the current one
+    reaches half of max_bytes it replaces the older one, so the spool never
+    takes more than max_bytes and the oldest samples go first. Samples older
+    than max_age are skipped on replay.
+
+    replay() publishes what was spooled, rate limited:
+      latest:  the newest message per topic, retained as published
+      history: every state sample in order as {"time", "topic", "value"} on
+               HISTORY_TOPIC (not retained), then the newest per topic
+
+    When the connection drops mid-replay, the samples not yet sent go back
+    into the spool with their original time, so they still age out after
+    max_age and the history left is rebuilt from them on the next replay.
+    """
+    def __init__(self, path: str = SPOOL_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: float = DEFAULT_MAX_AGE, mode: str = 'latest', rate: float = DEFAULT_REPLAY_RATE):
+        self.path = path
+        self.old_path = path + ".1"
+        self.max_bytes = max(1024, int(max_bytes))
+        self.max_age = max_age
+        self.mode = mode if mode in REPLAY_MODES else 'latest'
+        self.rate = max(1.0, float(rate))
+        self._file = None
+        self._lock = threading.Lock()
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        # Counters
+        self.spooled = 0
+        self.replayed = 0
+        self.expired = 0
+        self.errors = 0
+
+    def pending(self) -> bool:
+        """True if there is anything to replay (also spool left over from before a restart)."""
+        return self._size > 0 or os.path.exists(self.old_path)
+
+    def append(self, topic: str, payload, retain: bool = False, ts: float = None):
+        """Spool one message; ts is the wall-clock time it was published (now by default)."""
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8', errors='replace')
+        elif payload is None:
+            payload = ""
+        line = self._line(time.time() if ts is None else ts, retain, topic, payload)
+        with self._lock:
+            self._write(line)
+
+    @staticmethod
+    def _line(ts: float, retain: bool, topic: str, payload: str, history_sent: bool = False) -> bytes:
+        # Flags: 1/0 retained, h = already replayed on HISTORY_TOPIC
+        flags = f"{1 if retain else 0}{'h' if history_sent else ''}"
+        return f"{ts:.3f}\t{flags}\t{topic}\t{payload}\n".encode('utf-8')
+
+    def _write(self, line: bytes):
+        try:
+            if self._size + len(line) > self.max_bytes // 2:
+                self._rotate()
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(line)
+            self._file.flush()
+        except OSError as e:
+            self.errors += 1
+            if self.errors == 1:
+                print(f"[ERROR] MQTT spool write failed: {e}")
+            return
+        self._size += len(line)
+        self.spooled += 1
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        self._close()
+        if os.path.exists(self.path):
+            os.replace(self.path, self.old_path)
+        self._size = 0
+
+    def take(self) -> list:
+        """
+        Read and remove everything spooled.
+
+        Returns:
+            list: (time, retain, topic, payload, history_sent) oldest first, expired samples left out.
+        """
+        with self._lock:
+            return self._take()
+
+    def _take(self) -> list:
+        self._close()
+        samples = []
+        oldest = time.time() - self.max_age
+        for path in (self.old_path, self.path):
+            try:
+                with open(path, 'rb') as f:
+                    lines = f.read().decode('utf-8', errors='replace').splitlines()
+                os.remove(path)
+            except OSError:
+                continue
+            for line in lines:
+                parts = line.split('\t', 3)
+                if len(parts) != 4:
+                    continue
+                ts, flags, topic, payload = parts
+                try:
+                    ts = float(ts)
+                except ValueError:
+                    continue
+                if ts < oldest:
+                    self.expired += 1
+                    continue
+                samples.append((ts, flags.startswith('1'), topic, payload, flags.endswith('h')))
+        self._size = 0
+        # Samples put back after a broken replay or a broken burst follow newer ones in the file
+        samples.sort(key=lambda sample: sample[0])
+        return samples
+
+    def _restore(self, samples, pending: list, history_pending: set):
+        """Spool samples[n] for n in pending again, with their original time."""
+        with self._lock:
+            for n in pending:
+                ts, retain, topic, payload, history_sent = samples[n]
+                if self.mode == 'history' and n not in history_pending:
+                    history_sent = True
+                self._write(self._line(ts, retain, topic, payload, history_sent))
+
+    def _messages(self, samples):
+        """(topic, payload, retain, sample index) to publish for the replay mode."""
+        latest = {}
+        for n, sample in enumerate(samples):
+            latest[sample[2]] = n
+        messages = []
+        if self.mode == 'history':
+            for n, (ts, retain, topic, payload, history_sent) in enumerate(samples):
+                if history_sent or topic.endswith('/config') or not payload:
+                    continue
+                try:
+                    value = json.loads(payload)
+                except ValueError:
+                    value = payload
+                if isinstance(value, dict) and set(value) == {'state'}:
+                    value = value['state']
+                messages.append((HISTORY_TOPIC, json.dumps({'time': ts, 'topic': topic, 'value': value}), False, n))
+        for n in latest.values():
+            ts, retain, topic, payload, _ = samples[n]
+            messages.append((topic, payload, retain, n))
+        return messages
+
+    def replay(self, client, is_connected) -> int:
+        """
+        Publish the spooled messages at up to rate per second.
+
+        Stops when is_connected() turns false or paho refuses a message; the
+        samples behind the rest go back into the spool for the next connection.
+        """
+        samples = self.take()
+        if not samples:
+            return 0
+        messages = self._messages(samples)
+        print(f"[INFO] Replaying {len(messages)} spooled MQTT messages ({self.mode}) from {len(samples)} samples")
+        interval = 1.0 / self.rate
+        next_send = time.monotonic()
+        sent = 0
+        for k, (topic, payload, retain, _) in enumerate(messages):
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+            info = client.publish(topic, payload, retain=retain) if is_connected() else None
+            if info is None or info.rc != 0:
+                rest = messages[k:]
+                history_pending = {n for rest_topic, _, _, n in rest if rest_topic == HISTORY_TOPIC}
+                self._restore(samples, sorted({n for _, _, _, n in rest}), history_pending)
+                break
+            sent += 1
+        self.replayed += sent
+        return sent
+
+    def summary(self) -> str:
+        return (f"MQTT spool ({self.mode}): {self._size} bytes pending, spooled {self.spooled}, "
+                f"replayed {self.replayed}, expired {self.expired}, write errors {self.errors}")
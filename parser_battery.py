@@ -1,23 +1,22 @@
 # parser_battery.py
 
 import time
-import binascii
 
 from parser_temperature import (
-    hex_to_temperature,         # Function to convert hex string to temperature values
-    valid_len,                  # Helper to check if buffer length is valid
     process_extra_temperature,  # Function to process additional temperature info
+    filter_temperature_spikes,  # Keeps the last stable value when a sensor jumps
 )
 
 from mqtt_core import publish_sensors  # Function to publish data to MQTT broker
+from modbus_planner import execute_plan  # Runs merged register reads and slices them per block
+from modbus_schema import active_schema  # Frame decoders compiled from modbus_registers.REGISTER_SCHEMA
+from parser_cells import cell_stack  # Cell voltages of all batteries in one preallocated (NumPy) array
 
-from main_arrays import (
-    last_valid_voltage,     # Lists to cache last valid readings for filtering spikes
-    last_valid_current,
-    last_valid_power,
-    last_valid_soc,
-    last_valid_cycle_count,
-)
+from main_state import battery_store  # Last valid values per battery (BatteryState)
+from main_filters import filter_state  # Median / Hampel filter per sensor (spike_filter)
+
+# Largest accepted change between two readings of a temperature sensor (°C)
+TEMP_MAX_DELTA = 10
 
 # === Spike filter helper ===
 def filter_spikes(new_value, last_values, max_delta):
@@ -25,17 +24,40 @@ def filter_spikes(new_value, last_values, max_delta):
     Filter out spikes in sensor data that differ too much from recent history.
     If no history, accept new_value. If difference exceeds max_delta, return average of last_values.
     Otherwise, return new_value as valid.
+
+    last_values is a main_filters.RingHistory (running mean, O(1)) or a plain list.
     """
     if new_value is None:
         return None
     if not last_values:
         return new_value
-    last_avg = sum(last_values) / len(last_values)
+    mean = getattr(last_values, 'mean', None)
+    last_avg = mean() if mean else sum(last_values) / len(last_values)
     if abs(new_value - last_avg) > max_delta:
         return last_avg
     return new_value
 
 
+def decode_cells(index, cells_buf, cell_min_limit, cell_max_limit):
+    """
+    Decode the cell voltages (mV) of a cells frame; cells outside the limits become None.
+    The frame lands in the stack-wide cell array (parser_cells), which also feeds the cell statistics.
+
+    Returns:
+        list or None: Cell voltages, or None if the frame is invalid, from another
+                      battery, or has fewer than half of the model's cells valid.
+    """
+    return cell_stack().decode(index, cells_buf, cell_min_limit, cell_max_limit)
+
+
+def decode_temps(temp_buf, temp_min_limit, temp_max_limit):
+    """Decode a temperature frame into the temperatures within the limits, or None if the frame is invalid."""
+    values = active_schema().decode('get_temperature', temp_buf)
+    if values is None:
+        return None
+    return [t for t in values['temps'] if temp_min_limit <= t <= temp_max_limit]
+
+
 def process_battery_data(index, block_buf, cells_buf, temp_buf,
                          cell_min_limit, cell_max_limit,
                          volt_min_limit, volt_max_limit,
@@ -61,24 +83,14 @@ def process_battery_data(index, block_buf, cells_buf, temp_buf,
         'temps': None
     }
 
-    if valid_len(block_buf, 37):
-        # Convert bytes to hex string for easier slicing
-        hb = binascii.hexlify(block_buf).decode()
-
-        # Parse current (2 bytes), signed integer (16-bit)
-        cur_raw = int(hb[6:10], 16)
-        if cur_raw >= 0x8000:  # Adjust for 2's complement negative numbers
-            cur_raw -= 0x10000
-        current = round(cur_raw / 100, 2)
-
-        # Parse voltage (2 bytes), unsigned integer scaled by 100
-        voltage = round(int(hb[10:14], 16) / 100, 2)
-
-        # Parse SOC (state of charge) (2 bytes), scaled by 10
-        soc = round(int(hb[14:18], 16) / 10, 1)
-
-        # Parse cycle count (2 bytes)
-        cycle = int(hb[34:38], 16)
+    # Decode current, voltage, SOC and cycle count in one pass, straight from the frame
+    # (dividing the integers already gives the 0.01 / 0.1 rounded value)
+    block = active_schema().decode('get_block_voltage', block_buf)
+    if block is not None:
+        current = block['current']
+        voltage = block['voltage']
+        soc = block['soc']
+        cycle = block['cycle']
 
         # Calculate power as voltage * current
         power = round(current * voltage, 2)
@@ -111,32 +123,77 @@ def process_battery_data(index, block_buf, cells_buf, temp_buf,
         pass
 
     # Process cell voltages if buffer valid and matches battery index
-    if valid_len(cells_buf, 37) and cells_buf[0] == index:
-        hv = binascii.hexlify(cells_buf).decode()
-        # Extract 16 cell voltages (2 bytes each)
-        raw_cells = [int(hv[6 + 4*i:10 + 4*i], 16) for i in range(16)]
-        # Filter cells to only valid voltages within configured range, else None
-        filtered = [v if cell_min_limit <= v <= cell_max_limit else None for v in raw_cells]
-        # Require at least 8 valid cells to consider valid data
-        if len([v for v in filtered if v is not None]) >= 8:
-            result['cells'] = filtered
+    result['cells'] = decode_cells(index, cells_buf, cell_min_limit, cell_max_limit)
 
     # Process temperature buffer if valid
-    if valid_len(temp_buf, 13):
-        hx = binascii.hexlify(temp_buf).decode()
-        temps = hex_to_temperature(hx)
-        # Filter temps within configured limits
-        result['temps'] = [t for t in temps if temp_min_limit <= t <= temp_max_limit]
+    result['temps'] = decode_temps(temp_buf, temp_min_limit, temp_max_limit)
 
     return result
 
 
+def read_battery_frames(index, queries, gateway, queries_delay, warnings_enabled=False, read_plan=None, due=None):
+    """
+    Bus part of handle_battery: send the queries of one battery and return its response frames.
+
+    Args:
+        index, queries, gateway, queries_delay, warnings_enabled, read_plan, due: As for handle_battery.
+
+    Returns:
+        Tuple (block, cells, temperature, extra temperature) of frames or None; planned reads
+        return memoryviews into the plan's receive buffers, valid until the next poll of this battery.
+    """
+
+    q = queries[index]
+
+    def safe_query(key):
+        """
+        Sends a Modbus query through the gateway's validated transaction layer.
+
+        Args:
+            key: Query name to send.
+
+        Returns:
+            Response frame bytes (CRC, slave id and function code checked) or None if query fails or missing.
+        """
+        if key not in q:
+            if warnings_enabled:
+                print(f"[INFO] Battery {index} skipping missing query '{key}'")
+            return None
+        if due is not None and key not in due:
+            return None  # Slow lane, not due this cycle
+        time.sleep(queries_delay)  # Prevent flooding device with requests
+        result = gateway.transact(q[key])
+        if not result.ok:
+            if warnings_enabled:
+                print(f"[WARN] Battery {index} {key} read error: {result}")
+            return None
+        # Copy out of the shared gateway buffer, the next query reuses it
+        return bytes(result.frame)
+
+    if read_plan:
+        # Merged reads; each block comes back as its own frame, same as a separate query
+        responses = execute_plan(gateway, index, read_plan, q, queries_delay, warnings_enabled, due)
+        bv, cv = responses.get('get_block_voltage'), responses.get('get_cells_voltage')
+        tv, et = responses.get('get_temperature'), responses.get('get_extra_temperature')
+    else:
+        # Perform all Modbus queries safely, capturing raw data or None
+        bv = safe_query('get_block_voltage')          # Core battery telemetry
+        cv = safe_query('get_cells_voltage')          # Individual cell voltages
+        tv = safe_query('get_temperature')            # Temperature sensors data
+        et = safe_query('get_extra_temperature')      # Extra temperature info (MOSFET, environment)
+
+    # Cells were due but not read: keep the battery's old row out of the stack-wide cell statistics
+    if cv is None and 'get_cells_voltage' in q and (due is None or 'get_cells_voltage' in due):
+        cell_stack().clear(index)
+    return bv, cv, tv, et
+
+
 def handle_battery(
     client, index, queries, gateway, model, zero_pad_cells, queries_delay,
     cell_min_limit, cell_max_limit,
     volt_min_limit, volt_max_limit,
     temp_min_limit, temp_max_limit,
-    warnings_enabled=False, console_output_enabled=False
+    warnings_enabled=False, console_output_enabled=False, read_plan=None, due=None
 ):
     """
     Main function to query a battery, parse and validate data, update caches, and publish MQTT sensors.
@@ -154,44 +211,83 @@ def handle_battery(
         temp_min_limit, temp_max_limit: Valid temperature range (°C).
         warnings_enabled: Enable printing warnings/info.
         console_output_enabled: Enable detailed console logging.
+        read_plan: Optional merged read plan for this battery from modbus_planner;
+                   when given, queries are sent as planned and sliced back per block.
+        due: Optional set of query keys due this cycle (multi-rate polling lanes);
+             None reads every query.
 
     Returns:
         Tuple of (mos_temperature, environment_temperature) if available, else (None, None).
         Returns None if data invalid or skipped.
     """
 
-    q = queries[index]
+    bv, cv, tv, et = read_battery_frames(index, queries, gateway, queries_delay, warnings_enabled, read_plan, due)
 
-    def safe_query(key, expected_len=None):
-        """
-        Sends a Modbus query safely with error handling.
+    return process_battery_frames(
+        client, index, bv, cv, tv, et, model, zero_pad_cells,
+        cell_min_limit, cell_max_limit,
+        volt_min_limit, volt_max_limit,
+        temp_min_limit, temp_max_limit,
+        warnings_enabled=warnings_enabled,
+        console_output_enabled=console_output_enabled
+    )
 
-        Args:
-            key: Query name to send.
-            expected_len: Expected response length in bytes for validation.
 
-        Returns:
-            Response bytes or None if query fails or missing.
-        """
-        if key not in q:
-            if warnings_enabled:
-                print(f"[INFO] Battery {index} skipping missing query '{key}'")
-            return None
-        time.sleep(queries_delay)  # Prevent flooding device with requests
-        try:
-            gateway.send(q[key])
-            response = gateway.recv(expected_len) if expected_len else gateway.recv()
-            return response
-        except Exception as e:
-            if warnings_enabled:
-                print(f"[WARN] Battery {index} {key} read error: {e}")
-            return None
+def cache_temperatures(state, temps, mos_t, env_t, temp_min_limit, temp_max_limit):
+    """
+    Filter one battery's temperatures and store the accepted ones in its BatteryState.
 
-    # Perform all Modbus queries safely, capturing raw data or None
-    bv = safe_query('get_block_voltage', 37)      # Core battery telemetry
-    cv = safe_query('get_cells_voltage', 37)      # Individual cell voltages
-    tv = safe_query('get_temperature', 13)        # Temperature sensors data
-    et = safe_query('get_extra_temperature', 25)  # Extra temperature info (MOSFET, environment)
+    Sensor temperatures go through the robust filter (spike_filter) and then
+    filter_temperature_spikes against the stored values; MOS/ENV readings
+    (robust-filtered by the caller) further than TEMP_MAX_DELTA from the
+    stored ones are rejected.
+
+    Returns:
+        Tuple of (temps, mos_temperature, environment_temperature) to publish,
+        None for values not read or rejected.
+    """
+    if temps:
+        filters = filter_state()
+        if filters.robust_enabled:
+            temps = [filters.apply('temps', state.bat_id, t, pos) for pos, t in enumerate(temps)]
+        temps = filter_temperature_spikes(
+            temps, state.temps or [], temp_min_limit, temp_max_limit, delta_limit=TEMP_MAX_DELTA)
+        state.temps = temps
+
+    last_mos, last_env = state.extra
+    if mos_t is not None and (last_mos is None or abs(mos_t - last_mos) <= TEMP_MAX_DELTA):
+        last_mos = mos_t
+    else:
+        mos_t = None
+    if env_t is not None and (last_env is None or abs(env_t - last_env) <= TEMP_MAX_DELTA):
+        last_env = env_t
+    else:
+        env_t = None
+    if mos_t is not None or env_t is not None:
+        state.extra = (last_mos, last_env)
+
+    return temps, mos_t, env_t
+
+
+def process_battery_frames(
+    client, index, bv, cv, tv, et, model, zero_pad_cells,
+    cell_min_limit, cell_max_limit,
+    volt_min_limit, volt_max_limit,
+    temp_min_limit, temp_max_limit,
+    warnings_enabled=False, console_output_enabled=False
+):
+    """
+    Parse and validate the response frames of one battery, update caches, and publish MQTT sensors.
+    Bus I/O is done by the caller (handle_battery, or the asyncio engine in main_async).
+
+    Args:
+        bv, cv, tv, et: Block, cells, temperature and extra temperature response frames, or None.
+        Other arguments as for handle_battery.
+
+    Returns:
+        Tuple of (mos_temperature, environment_temperature) if available, else (None, None).
+        Returns None if data invalid or skipped.
+    """
 
     # Parse and validate core battery data if block voltage buffer is valid
     if bv is not None:
@@ -216,21 +312,19 @@ def handle_battery(
             'cells': None,
             'temps': None
         }
-        if valid_len(cv, 37) and cv[0] == index:
-            hv = binascii.hexlify(cv).decode()
-            raw_cells = [int(hv[6 + 4*i:10 + 4*i], 16) for i in range(16)]
-            filtered = [v if cell_min_limit <= v <= cell_max_limit else None for v in raw_cells]
-            if len([v for v in filtered if v is not None]) >= 8:
-                data['cells'] = filtered
-        if tv is not None and valid_len(tv, 13):
-            hx = binascii.hexlify(tv).decode()
-            temps = hex_to_temperature(hx)
-            data['temps'] = [t for t in temps if temp_min_limit <= t <= temp_max_limit]
+        data['cells'] = decode_cells(index, cv, cell_min_limit, cell_max_limit)
+        data['temps'] = decode_temps(tv, temp_min_limit, temp_max_limit)
+
+    # Median / Hampel filter (spike_filter), applied once here to values read this cycle, before
+    # they are cached; publishing and the ESS summary use the filtered values
+    filters = filter_state()
 
     # Process extra temperature data such as MOSFET and environmental temps
     mos_t, env_t = None, None
     if et:
         mos_t, env_t = process_extra_temperature(et, temp_min_limit, temp_max_limit)
+        mos_t = filters.apply('mos', index, mos_t)
+        env_t = filters.apply('env', index, env_t)
 
     # Helper to validate numeric values before caching and publishing
     def is_valid_number(val, minv=None, maxv=None):
@@ -242,35 +336,59 @@ def handle_battery(
             return False
         return True
 
+    # The battery's state keeps the last valid values: store valid ones, fall back to the stored ones
+    state = battery_store().get(index)
+    updated = False
+
     # Cache last valid voltage if valid, else fallback to previous cached value
-    if is_valid_number(data['voltage'], volt_min_limit, volt_max_limit):
-        last_valid_voltage[index] = data['voltage']
+    fresh_voltage = is_valid_number(data['voltage'], volt_min_limit, volt_max_limit)
+    if fresh_voltage:
+        state.voltage = data['voltage'] = filters.apply('voltage', index, data['voltage'])
+        updated = True
     else:
-        data['voltage'] = last_valid_voltage.get(index)
+        data['voltage'] = state.voltage
 
     # Cache last valid current similarly
-    if is_valid_number(data['current']):
-        last_valid_current[index] = data['current']
+    fresh_current = is_valid_number(data['current'])
+    if fresh_current:
+        state.current = data['current'] = filters.apply('current', index, data['current'])
+        updated = True
     else:
-        data['current'] = last_valid_current.get(index)
+        data['current'] = state.current
 
-    # Cache last valid power similarly
+    # Cache last valid power similarly; with a robust filter it follows the filtered voltage and current
     if is_valid_number(data['power']):
-        last_valid_power[index] = data['power']
+        if filters.robust_enabled and fresh_voltage and fresh_current:
+            data['power'] = round(data['current'] * data['voltage'], 2)
+        state.power = data['power']
+        updated = True
     else:
-        data['power'] = last_valid_power.get(index)
+        data['power'] = state.power
 
     # Cache last valid SOC if valid
     if is_valid_number(data['soc'], 0, 100):
-        last_valid_soc[index] = data['soc']
+        state.soc = data['soc'] = filters.apply('soc', index, data['soc'])
+        updated = True
     else:
-        data['soc'] = last_valid_soc.get(index)
+        data['soc'] = state.soc
 
     # Cache last valid cycle count if integer
     if isinstance(data['cycle'], int):
-        last_valid_cycle_count[index] = data['cycle']
+        state.cycle = data['cycle']
+        updated = True
     else:
-        data['cycle'] = last_valid_cycle_count.get(index)
+        data['cycle'] = state.cycle
+
+    if updated:
+        state.updated = time.time()
+    if data['cells']:
+        if filters.robust_enabled:
+            data['cells'] = [filters.apply('cells', index, v, pos) for pos, v in enumerate(data['cells'])]
+        state.cells = data['cells']
+
+    # Spike-filter temperatures against the stored ones; publish only what was accepted
+    data['temps'], pub_mos, pub_env = cache_temperatures(
+        state, data['temps'], mos_t, env_t, temp_min_limit, temp_max_limit)
 
     # Optional console output for debugging battery data
     if console_output_enabled:
@@ -291,6 +409,6 @@ def handle_battery(
             return None
 
     # Publish all collected sensor data via MQTT
-    publish_sensors(client, index, data, mos_t, env_t, model, zero_pad_cells)
+    publish_sensors(client, index, data, pub_mos, pub_env, model, zero_pad_cells)
 
     return mos_t, env_t
@@ -0,0 +1,195 @@
+# parser_cells.py
+
+import struct
+
+from modbus_schema import active_schema, HEADER_BYTES
+
+# NumPy is optional; without it the same CellStack API runs on plain lists
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Slave ids on the Ritar bus are 1..15; one row per id is allocated up front
+MAX_BATTERIES = 15
+
+_stack = None
+
+
+class CellStack:
+    """
+    Cell voltages (mV) of the whole stack, one preallocated row per battery id.
+
+    A cells frame is copied as raw big-endian registers into its battery's row
+    of one fixed bytearray; per battery validation (the "at least half the
+    cells valid" rule) and the per battery / stack wide statistics read the
+    rows from there, so memory use stays fixed however fast the stack is polled.
+
+    This is the pure Python version; NumpyCellStack views the same bytearray as
+    a (batteries x cells) uint16 array and computes the statistics of the whole
+    stack as array operations.
+    """
+    def __init__(self, cells: int = 16, max_batteries: int = MAX_BATTERIES):
+        self.cells = cells
+        self.max_batteries = max_batteries
+        self.min_valid = cells // 2             # 8 of 16
+        self.frame_length = HEADER_BYTES + 2 * cells + 2
+        self._stride = 2 * cells
+        self._decoder = struct.Struct(f'>{cells}H')
+        self.buffer = bytearray(max_batteries * self._stride)
+        self.loaded = [False] * max_batteries
+
+    def load(self, bat_id: int, frame) -> bool:
+        """Copy the registers of a cells response frame (bytes or memoryview) into the row of bat_id."""
+        if frame is None or len(frame) != self.frame_length or frame[0] != bat_id:
+            return False
+        if not 1 <= bat_id <= self.max_batteries:
+            return False
+        start = (bat_id - 1) * self._stride
+        self.buffer[start:start + self._stride] = frame[HEADER_BYTES:HEADER_BYTES + self._stride]
+        self.loaded[bat_id - 1] = True
+        return True
+
+    def clear(self, bat_id: int):
+        """Drop the row of bat_id from the statistics until its next valid cells frame."""
+        if 1 <= bat_id <= self.max_batteries:
+            self.loaded[bat_id - 1] = False
+
+    def row(self, bat_id: int) -> tuple:
+        """Raw cell voltages of bat_id."""
+        return self._decoder.unpack_from(self.buffer, (bat_id - 1) * self._stride)
+
+    def cells_of(self, bat_id: int, cell_min_limit, cell_max_limit):
+        """
+        Cells of bat_id with values outside the limits as None.
+
+        Returns:
+            list or None: None if fewer than min_valid cells are within the limits.
+        """
+        filtered = [v if cell_min_limit <= v <= cell_max_limit else None for v in self.row(bat_id)]
+        if self.cells - filtered.count(None) >= self.min_valid:
+            return filtered
+        return None
+
+    def decode(self, bat_id: int, frame, cell_min_limit, cell_max_limit):
+        """load() and cells_of() in one call; the drop-in for parser_battery.decode_cells."""
+        if not self.load(bat_id, frame):
+            if frame is not None:
+                self.clear(bat_id)      # invalid or foreign frame, the old row is no longer current
+            return None
+        return self.cells_of(bat_id, cell_min_limit, cell_max_limit)
+
+    def stats(self, cell_min_limit, cell_max_limit) -> dict:
+        """
+        Per battery and stack wide statistics over the valid cells of every loaded row.
+
+        Returns:
+            dict: {'batteries': {bat_id: {'min', 'max', 'delta', 'mean', 'valid'}},
+                   'stack': {'min', 'max', 'delta', 'mean', 'min_battery', 'max_battery'} or None}
+        """
+        batteries = {}
+        total = 0
+        count = 0
+        for pos, loaded in enumerate(self.loaded):
+            if not loaded:
+                continue
+            valid = [v for v in self.row(pos + 1) if cell_min_limit <= v <= cell_max_limit]
+            if len(valid) < self.min_valid:
+                continue
+            low, high, valid_sum = min(valid), max(valid), sum(valid)
+            batteries[pos + 1] = {'min': low, 'max': high, 'delta': high - low,
+                                  'mean': valid_sum / len(valid), 'valid': len(valid)}
+            total += valid_sum
+            count += len(valid)
+        return {'batteries': batteries, 'stack': _stack_stats(batteries, total, count)}
+
+    def summary(self, cell_min_limit, cell_max_limit):
+        """Console line with the stack wide cell figures, or None before the first valid cells frame."""
+        stack = self.stats(cell_min_limit, cell_max_limit)['stack']
+        if stack is None:
+            return None
+        return (f"Cells: min {stack['min']} mV (battery {stack['min_battery']}), "
+                f"max {stack['max']} mV (battery {stack['max_battery']}), "
+                f"delta {stack['delta']} mV, mean {stack['mean']:.1f} mV")
+
+
+class NumpyCellStack(CellStack):
+    """
+    CellStack whose statistics run on a (batteries x cells) uint16 view of the row buffer.
+
+    Frames are still copied in and handed out per battery exactly like the
+    pure Python version (that is the cheapest way for 16 values); the stack
+    wide part is a handful of array operations on preallocated scratch arrays.
+    """
+    def __init__(self, cells: int = 16, max_batteries: int = MAX_BATTERIES):
+        super().__init__(cells, max_batteries)
+        # Zero-copy view of the big-endian registers; loaded rows are seen at once
+        self.raw = np.frombuffer(self.buffer, dtype='>u2').reshape(max_batteries, cells)
+        self.loaded = np.zeros(max_batteries, dtype=bool)
+
+        # Scratch arrays, reused every cycle
+        self._values = np.zeros((max_batteries, cells), dtype=np.uint16)
+        self._mask = np.zeros((max_batteries, cells), dtype=bool)
+        self._work = np.zeros((max_batteries, cells), dtype=bool)
+
+    def stats(self, cell_min_limit, cell_max_limit) -> dict:
+        values = self._values
+        mask = self._mask
+        values[...] = self.raw                  # native byte order for the arithmetic below
+        np.greater_equal(values, cell_min_limit, out=mask)
+        np.less_equal(values, cell_max_limit, out=self._work)
+        mask &= self._work
+        mask &= self.loaded[:, None]
+
+        counts = np.count_nonzero(mask, axis=1)
+        rows = np.flatnonzero(counts >= self.min_valid).tolist()
+        if not rows:
+            return {'batteries': {}, 'stack': None}
+
+        # Reductions over the valid cells only
+        low = values.min(axis=1, where=mask, initial=0xFFFF).tolist()
+        high = values.max(axis=1, where=mask, initial=0).tolist()
+        sums = values.sum(axis=1, where=mask, dtype=np.uint32).tolist()
+        counts = counts.tolist()
+
+        batteries = {}
+        total = 0
+        count = 0
+        for pos in rows:
+            n = counts[pos]
+            batteries[pos + 1] = {'min': low[pos], 'max': high[pos], 'delta': high[pos] - low[pos],
+                                  'mean': sums[pos] / n, 'valid': n}
+            total += sums[pos]
+            count += n
+        return {'batteries': batteries, 'stack': _stack_stats(batteries, total, count)}
+
+
+def _stack_stats(batteries, total, count):
+    """Stack wide figures from the per battery statistics."""
+    if not batteries:
+        return None
+    low = min(batteries, key=lambda b: batteries[b]['min'])
+    high = max(batteries, key=lambda b: batteries[b]['max'])
+    return {
+        'min': batteries[low]['min'],
+        'max': batteries[high]['max'],
+        'delta': batteries[high]['max'] - batteries[low]['min'],
+        'mean': total / count,
+        'min_battery': low,
+        'max_battery': high,
+    }
+
+
+def new_cell_stack(cells: int = 16, max_batteries: int = MAX_BATTERIES) -> CellStack:
+    """NumpyCellStack when NumPy is installed, the pure Python CellStack otherwise."""
+    if np is not None:
+        return NumpyCellStack(cells, max_batteries)
+    return CellStack(cells, max_batteries)
+
+
+def cell_stack() -> CellStack:
+    """The stack shared by the parsers and the main loop, sized for the model in the register schema."""
+    global _stack
+    if _stack is None:
+        _stack = new_cell_stack(active_schema().field_counts.get('cells', 16))
+    return _stack
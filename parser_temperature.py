@@ -1,6 +1,11 @@
 # parser_temperature.py
 
-import binascii
+import struct
+
+from modbus_schema import active_schema
+
+# Decoders for temperature frames, by number of sensors
+_temperature_structs = {}
 
 def valid_len(buf, length):
     """
@@ -15,72 +20,70 @@ def valid_len(buf, length):
     """
     return buf is not None and len(buf) == length
 
+def raw_to_temperature(raw):
+    """Convert a raw sensor value to degrees Celsius, rounded to 0.1 degree."""
+    # Former round((raw - 726) * 0.1 + 22.6, 1): the same line, and dividing the integer
+    # offset by 10 already gives the nearest float to the 0.1 degree value, without round()
+    return (raw - 500) / 10
+
+def decode_temperatures(buf):
+    """
+    Decode all temperature sensors of a response frame (bytes or memoryview) without copying.
+
+    The registers sit between the 3 byte header and the 2 byte CRC; a trailing
+    odd byte is ignored.
+
+    Args:
+        buf: Complete Modbus RTU response frame.
+
+    Returns:
+        list of float: Temperatures in degrees Celsius.
+    """
+    count = (len(buf) - 5) // 2
+    if count <= 0:
+        return []
+    decoder = _temperature_structs.get(count)
+    if decoder is None:
+        decoder = _temperature_structs[count] = struct.Struct(f'>{count}H')
+    return [raw_to_temperature(raw) for raw in decoder.unpack_from(buf, 3)]
+
 def hex_to_temperature(hex_str):
     """
-    Convert a hex string containing raw temperature sensor data into a list of temperatures.
-    
-    The input hex string is expected to contain multiple temperature readings encoded in pairs of bytes.
-    The function:
-    - Splits the hex string into byte pairs.
-    - Extracts the relevant subset of pairs (skipping some header and footer bytes).
-    - Converts each temperature raw value from hex to integer.
-    - Applies a linear transformation to convert the raw sensor value into degrees Celsius.
-    
+    Convert a hex string containing a raw temperature response frame into a list of temperatures.
+
+    Kept for custom parsers that still hexlify frames; decode_temperatures()
+    works on the frame directly.
+
     Args:
         hex_str (str): Hexadecimal string representing raw temperature data.
-    
+
     Returns:
         list of float: List of converted temperatures rounded to 1 decimal place.
     """
-    # Split hex string into byte-sized pairs (2 chars each)
-    pairs = [hex_str[i:i+2] for i in range(0, len(hex_str), 2)]
-    
-    # Remove header (first 3 pairs) and footer (last 2 pairs)
-    data = pairs[3:-2]
-    
-    # If the data length is odd, remove the last byte to make pairs complete
-    if len(data) % 2:
-        data = data[:-1]
-    
-    temps = []
-    # Process pairs two bytes at a time (each temperature uses 2 bytes)
-    for i in range(0, len(data), 2):
-        # Combine two hex byte strings into one raw hex number
-        raw = int(data[i] + data[i+1], 16)
-        # Convert raw sensor value to temperature using formula, round to 0.1 degree
-        temps.append(round((raw - 726) * 0.1 + 22.6, 1))
-    return temps
+    return decode_temperatures(bytes.fromhex(hex_str))
 
 def process_extra_temperature(data, temp_min_limit, temp_max_limit):
     """
     Parse extra temperature data from a binary buffer and validate the MOS and ENV temperatures.
     
     The buffer should be exactly 25 bytes long.
-    The MOS and ENV temperature raw values are extracted from specific byte offsets,
-    converted to Celsius, and validated against min/max limits.
+    The MOS and ENV temperatures are decoded by the get_extra_temperature entry
+    of the register schema and validated against min/max limits.
     
     Args:
-        data (bytes): Binary buffer containing raw temperature data.
+        data (bytes or memoryview): Binary buffer containing raw temperature data.
         temp_min_limit (float): Minimum valid temperature limit.
         temp_max_limit (float): Maximum valid temperature limit.
     
     Returns:
         tuple: (mos_valid, env_valid) where each is a float temperature or None if invalid.
     """
-    # Validate buffer length
-    if not valid_len(data, 25):
+    # Decode MOS and ENV in place; None if the buffer length is wrong
+    values = active_schema().decode('get_extra_temperature', data)
+    if values is None:
         return None, None
-    
-    # Convert binary data to hex string for easier slicing
-    hx = binascii.hexlify(data).decode()
-    
-    # Extract raw MOS and ENV temperature hex strings (bytes 3-4 and 4-5)
-    mos_raw = int(hx[6:10], 16)
-    env_raw = int(hx[10:14], 16)
-    
-    # Convert raw values to temperature in Celsius using the known formula
-    mos = round((mos_raw - 726) * 0.1 + 22.6, 1)
-    env = round((env_raw - 726) * 0.1 + 22.6, 1)
+    mos = values['temp_mos']
+    env = values['temp_env']
     
     # Validate temperatures within acceptable limits, else assign None
     mos_valid = mos if temp_min_limit <= mos <= temp_max_limit else None
@@ -113,7 +116,7 @@ def filter_temperature_spikes(new_vals, last_vals, temp_min_limit, temp_max_limi
         if val is None or not (temp_min_limit <= val <= temp_max_limit):
             filtered.append(None)
         # If last value exists and difference is too big, reject new value as spike
-        elif i < len(last_vals):
+        elif i < len(last_vals) and last_vals[i] is not None:
             if abs(val - last_vals[i]) > delta_limit:
                 filtered.append(last_vals[i])  # keep previous stable value
             else:
@@ -5,16 +5,29 @@ import serial
 import struct
 import time
 
-def modbus_crc16(data: bytes) -> bytes:
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos
+def _build_crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
         for _ in range(8):
             if crc & 1:
                 crc = (crc >> 1) ^ 0xA001
             else:
                 crc >>= 1
-    return struct.pack('<H', crc)
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _build_crc16_table()
+
+def crc16_update(crc: int, data) -> int:
+    # Table-driven CRC16, works on bytes/bytearray/memoryview without copying
+    table = CRC16_TABLE
+    for pos in data:
+        crc = (crc >> 8) ^ table[(crc ^ pos) & 0xFF]
+    return crc
+
+def modbus_crc16(data: bytes) -> bytes:
+    return struct.pack('<H', crc16_update(0xFFFF, data))
 
 class ModbusGateway:
     def __init__(self, config):